@@ -9,6 +9,7 @@ setup(
     entry_points={
     'console_scripts': [
         'tmule=tmule:main',
+        'tmuled=tmule.daemon:main',
 		    ],
 		},
     #scripts=['tmule.py'],
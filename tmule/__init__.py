@@ -1 +1,19 @@
-from .tmule import *
\ No newline at end of file
+
+
+def main():
+    # imported on demand, so that "tmule" starts without loading anything
+    # the chosen sub-command does not need
+    from .tmule import main
+    return main()
+
+
+def __getattr__(name):
+    # the names of tmule.tmule (like TMux) are still available from the
+    # package, imported on first use
+    if name.startswith('_'):
+        raise AttributeError(name)
+    from importlib import import_module
+    try:
+        return getattr(import_module('.tmule', __name__), name)
+    except AttributeError:
+        raise AttributeError("module 'tmule' has no attribute %r" % name)
@@ -0,0 +1,170 @@
+"""Resource-aware admission of windows during a launch.
+
+With a ``throttle`` section in the configuration, the next window is only
+launched once the machine has headroom for the ``cost`` it declares
+(``cost: {cpu: 2, mem: 1G}``; cpu in cores). Recently launched windows keep
+their declared cost reserved for ``settle`` seconds (fading out linearly),
+as their load typically shows up only after a while.
+"""
+from __future__ import absolute_import
+
+import asyncio
+from logging import info, warning
+from threading import Lock
+from time import time
+
+_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+def parse_size(size):
+    """Convert sizes like 512M or 1.5G (or plain bytes) into bytes."""
+    if isinstance(size, (int, float)):
+        return int(size)
+    s = str(size).strip().upper().rstrip('B').rstrip('I')
+    unit = s[-1:] if s[-1:] in _UNITS else ''
+    return int(float(s[:len(s) - len(unit)]) * _UNITS[unit])
+
+
+def _cpu_split(times):
+    # (busy, total) seconds; guest time is already counted as user time
+    idle = times.idle + getattr(times, 'iowait', 0)
+    total = sum(times) - getattr(times, 'guest', 0) - getattr(
+        times, 'guest_nice', 0)
+    return total - idle, total
+
+
+class AdmissionController(object):
+
+    def __init__(self, max_cpu=0.9, min_free_mem='256M', settle=10.0,
+                 timeout=120.0, poll=0.25, default_cost=None):
+        import psutil
+        self.psutil = psutil
+        self.ncpu = psutil.cpu_count() or 1
+        self.max_cpu = float(max_cpu)
+        self.min_free_mem = parse_size(min_free_mem)
+        self.settle = float(settle)
+        self.timeout = float(timeout)
+        self.poll = poll
+        self.default_cost = self.parse_cost(default_cost or {'cpu': 1})
+        # (time, cpu, mem) of windows admitted recently
+        self.reservations = []
+        # launches of a plan are admitted concurrently
+        self._lock = Lock()
+        # cpu usage is measured by this controller alone, from the cpu
+        # times between its own samples (not psutil.cpu_percent, which
+        # every caller in the process resets)
+        self._times = _cpu_split(psutil.cpu_times())
+        self._sampled = time()
+        self._busy = None
+
+    @classmethod
+    def from_config(cls, throttle):
+        return cls(**dict((k, throttle[k]) for k in [
+            'max_cpu', 'min_free_mem', 'settle', 'timeout', 'default_cost'
+        ] if k in throttle))
+
+    def parse_cost(self, cost):
+        return (float(cost.get('cpu', 0)), parse_size(cost.get('mem', 0)))
+
+    def _reserved(self, now):
+        cpu = mem = 0.0
+        alive = []
+        for t, c, m in self.reservations:
+            left = 1.0 - (now - t) / self.settle if self.settle > 0 else 0
+            if left > 0:
+                cpu += c * left
+                mem += m * left
+                alive.append((t, c, m))
+        self.reservations = alive
+        return cpu, mem
+
+    def _busy_cpu(self, now):
+        # cpu usage over a too short period is meaningless: the previous
+        # sample is used until it is ``poll`` seconds old
+        if now - self._sampled >= self.poll:
+            busy, total = _cpu_split(self.psutil.cpu_times())
+            if total > self._times[1]:
+                self._busy = (busy - self._times[0]) / (
+                    total - self._times[1]) * self.ncpu
+            self._times = (busy, total)
+            self._sampled = now
+        return self._busy
+
+    def headroom(self):
+        """Free cores and bytes, after subtracting pending reservations
+        (None before the cpu usage was measured)."""
+        with self._lock:
+            return self._headroom(time())
+
+    def _headroom(self, now):
+        busy = self._busy_cpu(now)
+        if busy is None:
+            return None
+        rcpu, rmem = self._reserved(now)
+        free_cpu = self.ncpu * self.max_cpu - busy - rcpu
+        free_mem = (self.psutil.virtual_memory().available - rmem -
+                    self.min_free_mem)
+        return free_cpu, free_mem
+
+    def try_admit(self, cpu, mem, force=False):
+        """Reserve ``cpu`` and ``mem`` if they fit now (or ``force``)."""
+        with self._lock:
+            now = time()
+            free = self._headroom(now)
+            fits = force or free is not None and (
+                cpu <= free[0] and mem <= free[1] or
+                # it will never fit, do not wait forever for nothing
+                not self.reservations and (
+                    cpu > self.ncpu * self.max_cpu or
+                    mem > self.psutil.virtual_memory().total))
+            if fits:
+                self.reservations.append((now, cpu, mem))
+            return fits
+
+    async def admit(self, name, cost=None):
+        """Wait until a window with ``cost`` can be launched, then reserve it.
+
+        A window that does not fit even into an idle machine is admitted
+        once nothing else is pending; after ``timeout`` seconds a window is
+        admitted regardless.
+        """
+        cpu, mem = self.parse_cost(cost) if cost else self.default_cost
+        start = time()
+        waited = False
+        while not self.try_admit(cpu, mem):
+            if time() - start > self.timeout:
+                warning('no headroom for %s after %.0f seconds, launching '
+                        'anyway' % (name, self.timeout))
+                self.try_admit(cpu, mem, force=True)
+                return
+            # (not while measuring the cpu usage for the first time)
+            if not waited and self._busy is not None:
+                info('waiting for headroom to launch %s (cpu %.1f, mem %d)'
+                     % (name, cpu, mem))
+                waited = True
+            await asyncio.sleep(self.poll)
+
+
+def test_parse_size():
+    assert parse_size('1G') == 1 << 30
+    assert parse_size('512M') == 512 << 20
+    assert parse_size('1.5k') == 1536
+    assert parse_size('2GiB') == 2 << 30
+    assert parse_size(1000) == 1000
+
+
+def test_admit():
+    import psutil
+    controller = AdmissionController(max_cpu=1.0, min_free_mem=0, poll=0.05)
+    # nothing is admitted before the cpu usage was measured
+    assert controller.headroom() is None
+    cpu = psutil.cpu_count() * 0.6
+    loop = asyncio.new_event_loop()
+    start = time()
+    loop.run_until_complete(controller.admit('a', {'cpu': cpu}))
+    assert time() - start >= 0.05 and len(controller.reservations) == 1
+    # the reservation of the first leaves no room for the second
+    controller.timeout = 0.2
+    loop.run_until_complete(controller.admit('b', {'cpu': cpu}))
+    assert time() - start >= 0.25 and len(controller.reservations) == 2
+    loop.close()
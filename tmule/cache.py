@@ -0,0 +1,109 @@
+from __future__ import absolute_import
+
+import os
+import pickle
+from logging import debug, warning
+from tempfile import NamedTemporaryFile
+
+from .paths import cache_dir, config_key, include_path
+
+# bump whenever the layout of the compiled configuration changes
+CACHE_VERSION = 3
+
+
+def _stat(filename):
+    st = os.stat(filename)
+    return (st.st_mtime_ns, st.st_size)
+
+
+class ConfigCache(object):
+    """Cache of compiled (parsed, substituted and validated) configurations.
+
+    An entry is valid as long as none of the files it was compiled from
+    (the config file and everything it includes) changed, and the includes
+    naming files by environment variables still name the same files, so
+    warm loads neither parse YAML nor validate.
+    """
+
+    def __init__(self, configfile, session_name=None):
+        self.path = os.path.join(
+            cache_dir(), 'config-%s.pickle'
+            % config_key(configfile, session_name))
+        # of the configuration loaded or stored last
+        self.dependencies = {}
+        self.expansions = {}
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                entry = pickle.load(f)
+        except (IOError, OSError):
+            return None
+        except Exception as e:
+            warning('ignoring broken config cache %s: %s' % (self.path, e))
+            return None
+        if entry.get('version') != CACHE_VERSION:
+            return None
+        self.dependencies = entry['dependencies']
+        self.expansions = entry['expansions']
+        if self.changed():
+            return None
+        return entry['config']
+
+    def changed(self):
+        """Whether any file the configuration loaded or stored last was
+        compiled from changed, or an include now refers to another file."""
+        try:
+            for filename, stat in self.dependencies.items():
+                if _stat(filename) != stat:
+                    debug('%s changed, recompiling config' % filename)
+                    return True
+        except (IOError, OSError):
+            return True
+        for (spec, root), filename in self.expansions.items():
+            if include_path(spec, root) != filename:
+                debug('!include %s now refers to another file, recompiling '
+                      'config' % spec)
+                return True
+        return False
+
+    def store(self, config, dependencies, expansions=None):
+        self.dependencies = dict((f, _stat(f)) for f in dependencies)
+        self.expansions = dict(expansions or {})
+        entry = {
+            'version': CACHE_VERSION,
+            'dependencies': self.dependencies,
+            'expansions': self.expansions,
+            'config': config
+        }
+        try:
+            with NamedTemporaryFile('wb', dir=os.path.dirname(self.path),
+                                    prefix='.config-', delete=False) as f:
+                pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(f.name, self.path)
+        except (IOError, OSError) as e:
+            warning('could not cache compiled config: %s' % e)
+
+
+def test_include_variables():
+    import tempfile
+    from .tmule import TMux
+    d = tempfile.mkdtemp()
+    for robot in ('r1', 'r2'):
+        with open(os.path.join(d, '%s.yaml' % robot), 'w') as f:
+            f.write('- name: %s\n  panes: [htop]\n' % robot)
+    configfile = os.path.join(d, 'tmule.yaml')
+    with open(configfile, 'w') as f:
+        f.write('windows: !include $TMULE_TEST_ROBOT.yaml\n')
+    try:
+        for robot in ('r1', 'r2', 'r1'):
+            os.environ['TMULE_TEST_ROBOT'] = robot
+            tmux = TMux(session_name='nose_test', configfile=configfile)
+            assert [w['name'] for w in tmux.config['windows']] == [robot]
+        # as the daemon sees it, included files count as well
+        assert not tmux.config_cache.changed()
+        with open(os.path.join(d, 'r1.yaml'), 'a') as f:
+            f.write('- name: r1b\n  panes: [htop]\n')
+        assert tmux.config_cache.changed()
+    finally:
+        os.environ.pop('TMULE_TEST_ROBOT')
@@ -0,0 +1,63 @@
+"""Capturing and searching the output of many panes at once.
+
+All panes of a session are listed with one tmux call, their scrollback
+(limited to the last ``tail`` lines) is captured concurrently, one
+``capture-pane`` per pane, and searched with a single compiled regex.
+"""
+from __future__ import absolute_import
+
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_TAIL = 1000
+
+
+def list_panes(server, session_name):
+    """(window name, pane index, pane id) of all panes in the session."""
+    r = server.cmd('list-panes', '-s', '-t', session_name,
+                   '-F', '#{pane_index} #{pane_id} #{window_name}')
+    panes = []
+    for line in r.stdout:
+        index, pane_id, window = line.split(' ', 2)
+        panes.append((window, int(index), pane_id))
+    return panes
+
+
+def capture_panes(server, panes, tail=DEFAULT_TAIL, workers=16):
+    """Capture the last ``tail`` lines of ``panes`` concurrently.
+
+    Returns (window, pane index, lines) in the order of ``panes``.
+    """
+    def capture(pane):
+        window, index, pane_id = pane
+        # -J joins wrapped lines, so that matches are not cut in two
+        r = server.cmd('capture-pane', '-p', '-J', '-S', '-%d' % tail,
+                       '-t', pane_id)
+        return window, index, r.stdout
+
+    if not panes:
+        return []
+    with ThreadPoolExecutor(max_workers=min(workers, len(panes))) as pool:
+        return list(pool.map(capture, panes))
+
+
+def grep_captures(regex, captures):
+    """Lines of ``captures`` matching ``regex``, annotated by origin."""
+    if not hasattr(regex, 'search'):
+        regex = re.compile(regex)
+    matches = []
+    for window, pane, lines in captures:
+        for no, text in enumerate(lines, 1):
+            if regex.search(text):
+                matches.append({
+                    'window': window, 'pane': pane, 'line': no, 'text': text
+                })
+    return matches
+
+
+def test_grep_captures():
+    captures = [('a', 0, ['starting', 'ERROR: no map']),
+                ('b', 1, ['error in line 3', 'ok'])]
+    found = grep_captures(re.compile('error', re.I), captures)
+    assert [(m['window'], m['pane'], m['line']) for m in found] == [
+        ('a', 0, 2), ('b', 1, 1)]
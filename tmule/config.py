@@ -0,0 +1,106 @@
+"""Containers for compiled configurations.
+
+Kept free of YAML so that loading a cached configuration does not need to
+import the YAML parser.
+"""
+from .schema import WINDOW_KEYS
+
+
+class ConfigDict(dict):
+    """A dict that remembers where (file, line, column) it was defined.
+
+    ``marks`` maps each key to the location of its value.
+    """
+    mark = None
+
+    def where(self, key=None):
+        return getattr(self, 'marks', {}).get(key, self.mark)
+
+
+class ConfigList(list):
+    """A list that remembers where (file, line, column) it was defined.
+
+    ``marks`` holds the location of each item.
+    """
+    mark = None
+
+    def where(self, index=None):
+        marks = getattr(self, 'marks', [])
+        if index is not None and index < len(marks):
+            return marks[index]
+        return self.mark
+
+
+def _plain(value):
+    # the locations are only needed for validation, do not keep them around
+    if isinstance(value, dict):
+        return dict((k, _plain(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return [_plain(v) for v in value]
+    return value
+
+
+class Window(object):
+    """A validated window definition.
+
+    Each window key is a slot instead of an entry in a per-window dict,
+    which keeps configurations with thousands of windows compact. For the
+    code using them, windows behave like (read/write) mappings. Keys
+    starting with ``_`` other than the known ones go to ``_extra``.
+    """
+    __slots__ = tuple(sorted(WINDOW_KEYS)) + ('_running', '_extra')
+
+    def __init__(self, conf=()):
+        for key, value in dict(conf).items():
+            self[key] = _plain(value)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key) if key in self.__slots__ \
+                else self._extra[key]
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self.__slots__ and key != '_extra':
+            setattr(self, key, value)
+        else:
+            if getattr(self, '_extra', None) is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __contains__(self, key):
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        keys = [k for k in self.__slots__
+                if k != '_extra' and hasattr(self, k)]
+        return keys + list(getattr(self, '_extra', None) or [])
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def __getstate__(self):
+        return dict(self.items())
+
+    def __setstate__(self, state):
+        self.__init__(state)
+
+    def __repr__(self):
+        return 'Window(%r)' % dict(self.items())
@@ -0,0 +1,96 @@
+"""Environment variables and working directory of panes.
+
+``env`` (a mapping of variables) and ``cwd`` can be given globally, per
+window and per pane, a pane being given as ``{cmd: ..., env: ..., cwd:
+...}`` instead of just its command. They are merged when the configuration
+is compiled (a pane's over its window's over the global ones, ``env``
+variable by variable; a relative ``cwd`` is relative to the configuration
+file) into ``_context`` of each window, and passed to tmux where panes are
+created (``new-window``/``split-window -c DIR -e VAR=VALUE``) or, in
+``launch_mode: direct``, respawned: no ``cd`` or ``export`` is typed into
+any pane.
+"""
+from __future__ import absolute_import
+
+import os
+
+
+def _merge(*confs):
+    env = {}
+    cwd = None
+    for conf in confs:
+        env.update((k, _value(v)) for k, v in (conf.get('env') or {}).items())
+        cwd = conf.get('cwd', cwd)
+    return env, cwd
+
+
+def _value(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    return str(value)
+
+
+def _directory(cwd, base):
+    if cwd is None:
+        return None
+    return os.path.normpath(os.path.join(base, os.path.expanduser(cwd)))
+
+
+def compile_contexts(config, base='.'):
+    """Replace panes given as mappings by their commands, and store the
+    environment and directory of every pane of a window in ``_context``."""
+    for win in config['windows']:
+        commands = []
+        contexts = []
+        for pane in win['panes']:
+            own = pane if isinstance(pane, dict) else {}
+            env, cwd = _merge(config, win, own)
+            commands.append(own['cmd'] if own else pane)
+            contexts.append({'env': env, 'cwd': _directory(cwd, base)})
+        win['panes'] = commands
+        if any(c['env'] or c['cwd'] for c in contexts):
+            win['_context'] = contexts
+    return config
+
+
+def pane_context(winconf, pane_no):
+    """(environment, directory) a pane is created with."""
+    contexts = winconf.get('_context') or []
+    if pane_no < len(contexts):
+        return contexts[pane_no]['env'], contexts[pane_no]['cwd']
+    return {}, None
+
+
+def window_context(config, winconf, base='.'):
+    """(environment, directory) of a window as a whole, e.g. its check."""
+    env, cwd = _merge(config, winconf)
+    return env, _directory(cwd, base)
+
+
+def context_args(env, cwd):
+    """Options of new-window, split-window and respawn-pane for them."""
+    args = ['-c', cwd] if cwd else []
+    for name, value in sorted(env.items()):
+        args.extend(['-e', '%s=%s' % (name, value)])
+    return args
+
+
+def test_compile_contexts():
+    config = {'env': {'ROS_MASTER_URI': 'http://robot:11311', 'DEBUG': 0},
+              'cwd': '/opt/robot', 'windows': [
+                  {'name': 'nav', 'env': {'DEBUG': True}, 'panes': [
+                      'roslaunch nav nav.launch',
+                      {'cmd': 'rviz', 'cwd': 'rviz', 'env': {'DISPLAY': ':0'}},
+                  ]},
+                  {'name': 'plain', 'panes': ['top']}]}
+    compile_contexts(config, '/etc')
+    nav, plain = config['windows']
+    assert nav['panes'] == ['roslaunch nav nav.launch', 'rviz']
+    assert pane_context(nav, 0) == (
+        {'ROS_MASTER_URI': 'http://robot:11311', 'DEBUG': '1'}, '/opt/robot')
+    env, cwd = pane_context(nav, 1)
+    assert env['DISPLAY'] == ':0' and cwd == '/etc/rviz'
+    assert pane_context(plain, 0)[1] == '/opt/robot'
+    assert pane_context({'panes': ['top']}, 0) == ({}, None)
+    assert context_args({'A': '1 2'}, '/tmp') == ['-c', '/tmp', '-e', 'A=1 2']
+    assert window_context(config, nav)[0]['DEBUG'] == '1'
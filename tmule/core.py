@@ -0,0 +1,652 @@
+"""The asynchronous core running TMuLE's operations.
+
+A process has one asyncio event loop, on which plans are executed, windows
+stopped and their processes cleaned up: waits are ``asyncio.sleep``s,
+checks are asynchronous subprocesses and processes are waited for by
+polling, so that everything in progress can be cancelled (e.g. the other
+launches of a batch when one window fails). Calls that block (libtmux,
+hooks) run on one bounded pool of worker threads; what is running, queued
+and busy can be seen with ``Core.stats``. Locks are waited for on the
+loop, so that operations waiting for a busy session or window do not take
+up the workers the one holding it needs.
+
+Each operation owns the locks it takes (see :mod:`tmule.locks`) on all
+the threads and tasks it uses: one submitted from a thread owns them with
+that thread, one spawned in the loop on its own.
+
+The CLI and ``tmuled`` run the loop in a thread of its own and call the
+blocking wrappers of :class:`tmule.tmule.TMux` (``execute``,
+``stop_window``, ...); the web server runs Twisted on the same loop
+(the asyncio reactor) and awaits the coroutines directly.
+"""
+from __future__ import absolute_import
+
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, Future
+from logging import info, warning, error, debug
+from threading import Thread, Lock, active_count
+
+from .locks import lock_owner, set_lock_owner
+
+# size of the pool for blocking calls
+WORKERS = 8
+# seconds a plan or terminate waits for a busy session (unless the
+# lock_timeout of the TMux says otherwise), before failing
+LOCK_TIMEOUT = 120.0
+
+
+# set in the tasks of an operation
+_OWNED = contextvars.ContextVar('tmule_owned', default=None)
+
+
+async def _owned(coro):
+    # a new operation, with locks of its own
+    set_lock_owner(object())
+    _OWNED.set(True)
+    return await coro
+
+
+class Core(object):
+
+    def __init__(self, loop=None, workers=WORKERS):
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(
+            workers, thread_name_prefix='tmule-worker')
+        self.tasks = set()
+        self.busy = 0
+        self.queued = 0
+        self._lock = Lock()
+        self.thread = None
+        self.loop = loop
+        if loop is None:
+            self.loop = asyncio.new_event_loop()
+            self.thread = Thread(target=self.loop.run_forever,
+                                 name='tmule-core', daemon=True)
+            self.thread.start()
+
+    def in_loop(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def spawn(self, coro):
+        """Run ``coro`` as a task of the loop (called in the loop)."""
+        if _OWNED.get() is None:
+            coro = _owned(coro)
+        task = self.loop.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self._done)
+        return task
+
+    def _done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            error('task failed: %s' % task.exception())
+
+    def submit(self, coro):
+        """Run ``coro`` on the loop, from any other thread."""
+        owner = lock_owner()
+
+        async def tracked():
+            # the locks of the calling thread are the operation's
+            set_lock_owner(owner)
+            _OWNED.set(True)
+            return await self.spawn(coro)
+        return asyncio.run_coroutine_threadsafe(tracked(), self.loop)
+
+    def run(self, coro):
+        """Run ``coro`` on the loop and wait for its result."""
+        if self.in_loop():
+            raise RuntimeError('cannot block the loop, await instead')
+        return self.submit(coro).result()
+
+    def future(self, task):
+        """A ``concurrent.futures.Future`` done when ``task`` is."""
+        future = Future()
+
+        def done(task):
+            if task.cancelled():
+                future.cancel()
+            elif task.exception():
+                future.set_exception(task.exception())
+            else:
+                future.set_result(task.result())
+        self.loop.call_soon_threadsafe(task.add_done_callback, done)
+        return future
+
+    async def blocking(self, fn, *args, **kwargs):
+        """Call ``fn`` on the worker pool."""
+        with self._lock:
+            self.queued += 1
+
+        def call():
+            with self._lock:
+                self.queued -= 1
+                self.busy += 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.busy -= 1
+        if _OWNED.get() is None:
+            # a task not started by the core is an operation of its own too
+            set_lock_owner(object())
+            _OWNED.set(True)
+        # in the context (lock owner) of the calling task
+        context = contextvars.copy_context()
+        return await self.loop.run_in_executor(self.executor, context.run, call)
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'busy': self.busy,
+            'queued': self.queued,
+            'tasks': len(self.tasks),
+            'threads': active_count(),
+        }
+
+    async def drain(self):
+        """Wait for the tasks in progress (but the calling one)."""
+        current = asyncio.current_task()
+        while any(t is not current for t in self.tasks):
+            await asyncio.gather(*[t for t in self.tasks if t is not current],
+                                 return_exceptions=True)
+
+    def close(self):
+        """Let the tasks in progress (like clean-ups) finish, then stop."""
+        if self.thread is not None:
+            self.run(self.drain())
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+        self.executor.shutdown(wait=True)
+
+
+_core = None
+_core_lock = Lock()
+
+
+def get_core():
+    """The core of this process, with a loop of its own unless set up."""
+    global _core
+    with _core_lock:
+        if _core is None:
+            _core = Core()
+        return _core
+
+
+def use_loop(loop):
+    """Run the core on ``loop`` (run by someone else, e.g. Twisted)."""
+    global _core
+    with _core_lock:
+        _core = Core(loop)
+        return _core
+
+
+def shutdown():
+    global _core
+    with _core_lock:
+        core, _core = _core, None
+    if core is not None:
+        core.close()
+
+
+async def check(tmux, winconf):
+    """Run the ``check`` of a window; killed if cancelled."""
+    if getattr(tmux, 'tracing', False):
+        # recorded or replayed as a whole
+        return await get_core().blocking(tmux._run_check, winconf)
+    script, env = tmux._check_script(winconf)
+    proc = await asyncio.create_subprocess_exec(
+        '/bin/bash', '-c', script, env=env)
+    try:
+        return await proc.wait() == 0
+    except asyncio.CancelledError:
+        proc.kill()
+        raise
+
+
+def _alive(proc):
+    from psutil import NoSuchProcess, STATUS_ZOMBIE
+    try:
+        return proc.is_running() and proc.status() != STATUS_ZOMBIE
+    except NoSuchProcess:
+        return False
+
+
+async def wait_gone(procs, timeout, poll=0.05):
+    """Wait up to ``timeout`` for ``procs`` to end; returns those alive."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    alive = [p for p in procs if _alive(p)]
+    while alive and loop.time() < deadline:
+        await asyncio.sleep(poll)
+        alive = [p for p in alive if _alive(p)]
+    return alive
+
+
+async def terminate(tmux, pid, include_self=False):
+    """Terminate the children of ``pid`` (and itself), kill if need be."""
+    if getattr(tmux, 'tracing', False):
+        return await get_core().blocking(tmux._terminate, pid, include_self)
+    from psutil import Process, NoSuchProcess
+    try:
+        proc = Process(pid)
+        procs = proc.children(recursive=True)
+    except NoSuchProcess:
+        return
+    if include_self:
+        procs.append(proc)
+    for p in procs:
+        info("trying to terminate %s" % p)
+        try:
+            p.terminate()
+        except NoSuchProcess:
+            pass
+    for p in await wait_gone(procs, 1):
+        info("killing %s" % p)
+        try:
+            p.kill()
+        except NoSuchProcess:
+            pass
+
+
+async def clean_up(tmux, pids, include_self=False, lock=None):
+    """Terminate what is left of a stopped window, then release its lock."""
+    try:
+        await asyncio.sleep(1)
+        results = await asyncio.gather(
+            *[terminate(tmux, p, include_self) for p in pids],
+            return_exceptions=True)
+        for r in results:
+            if isinstance(r, Exception):
+                info('exception in termination, can be ignored: %s' % r)
+    finally:
+        if lock:
+            lock.release()
+
+
+def _session_lock(tmux, operation, shared=False):
+    lock = tmux.session_lock(operation, shared)
+    if lock.timeout is None:
+        lock.timeout = LOCK_TIMEOUT
+    return lock
+
+
+async def _window_locks(tmux, window_name, operation):
+    # the locks of an operation on a window, taken on the loop: the blocking
+    # call doing it then finds them held by its owner, instead of waiting
+    # for them on a worker
+    session = await tmux.session_lock(operation, shared=True).acquire_async()
+    try:
+        window = await tmux.window_lock(window_name, operation).acquire_async()
+    except BaseException:
+        session.release()
+        raise
+    return [window, session]
+
+
+def _release(locks):
+    for lock in locks:
+        lock.release()
+
+
+async def stop_window(tmux, window_name, operation='stop'):
+    """Stop a window; returns the task cleaning up its processes."""
+    core = get_core()
+    locks = await _window_locks(tmux, window_name, operation)
+    try:
+        pids, include_self, lock = await core.blocking(
+            tmux._interrupt_window, window_name, operation)
+    finally:
+        _release(locks)
+    return core.spawn(clean_up(tmux, pids, include_self, lock))
+
+
+async def kill_window(tmux, window_name):
+    """Stop a window and terminate all of its processes, pane processes
+    of direct windows included; returns the clean-up task."""
+    core = get_core()
+    first = await stop_window(tmux, window_name, 'kill')
+
+    async def again():
+        await asyncio.sleep(1)
+        locks = [await tmux.window_lock(window_name, 'kill').acquire_async()]
+        try:
+            pids, include_self, lock = await core.blocking(
+                tmux._window_pids, window_name, 'kill')
+        finally:
+            _release(locks)
+        await asyncio.gather(first, clean_up(tmux, pids, include_self, lock))
+    return core.spawn(again())
+
+
+async def kill_all(tmux):
+    """Kill all windows, in reverse order, and the session."""
+    core = get_core()
+    lock = await _session_lock(tmux, 'terminate').acquire_async()
+    try:
+        with tmux.journal.operation('terminate'), tmux.state.batch():
+            cleanups = []
+            for winconf in tmux.config['windows'][::-1]:
+                try:
+                    cleanups.append(await kill_window(tmux, winconf['name']))
+                except Exception as e:
+                    warning('There was an exception shutting down, '
+                            'carrying on regardless: %s' % str(e))
+            await asyncio.gather(*cleanups, return_exceptions=True)
+        await core.blocking(tmux.server.kill_session, tmux.session_name)
+    finally:
+        lock.release()
+
+
+async def execute(tmux, plan, on_failure=None):
+    """Run ``plan`` and return its :class:`tmule.plan.Outcome`."""
+    from .plan import Outcome
+    core = get_core()
+    outcome = Outcome(plan, on_failure or tmux.config.get(
+        'on_failure', 'abort'))
+    await core.blocking(tmux.hooks.redeliver)
+    # shared: the windows are locked one by one, as they are launched or
+    # stopped, so that other windows can be looked at and stopped meanwhile
+    lock = await _session_lock(tmux, plan.action, shared=True).acquire_async()
+    try:
+        with tmux.journal.operation(
+                plan.action, plan=plan.to_dict()) as result:
+            await _execute(tmux, plan, outcome)
+            if not outcome.ok:
+                result.update(error=outcome.summary(),
+                              outcome=outcome.to_dict())
+    finally:
+        lock.release()
+    return outcome
+
+
+async def _execute(tmux, plan, outcome):
+    from .plan import _ancestors
+    core = get_core()
+    admission = None
+    if 'throttle' in tmux.config and plan.action != 'stop':
+        from .admission import AdmissionController
+        admission = AdmissionController.from_config(tmux.config['throttle'])
+    ancestors = _ancestors(dict(
+        (w['name'], w) for w in tmux.config['windows']))
+    # windows launched, in the order of their launch, and the launches
+    # themselves, which go on when their step is cancelled
+    launched = []
+    launches = []
+    aborted = False
+    with tmux.state.batch():
+        for stage in plan.stages:
+            tasks = {}
+            for step in stage:
+                if aborted or ancestors[step['window']].intersection(
+                        outcome.failed()):
+                    outcome.windows[step['window']] = 'skipped'
+                else:
+                    tasks[core.spawn(run_step(
+                        tmux, step, admission, launched, launches))] = \
+                        step['window']
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    state = 'failed' if task.exception() else task.result()
+                    outcome.windows[tasks[task]] = state
+                    if state == 'failed' and outcome.on_failure != 'continue':
+                        aborted = True
+                if aborted:
+                    # the other windows of the stage stop at once
+                    for task in pending:
+                        task.cancel()
+                    if pending:
+                        await asyncio.wait(pending)
+                    # a window is only cancelled once its launch is over
+                    await asyncio.gather(*launches, return_exceptions=True)
+                    for task in pending:
+                        outcome.windows[tasks[task]] = \
+                            'cancelled' if tasks[task] in launched \
+                            else 'skipped'
+                    pending = set()
+        if outcome.failed():
+            error('%s failed for %s.' % (
+                plan.action, ', '.join(outcome.failed())))
+            outcome.result = {'continue': 'failed', 'abort': 'aborted',
+                              'rollback': 'rolled back'}[outcome.on_failure]
+        if outcome.result == 'rolled back':
+            await asyncio.gather(*launches, return_exceptions=True)
+            await roll_back(tmux, launched, outcome)
+    return outcome
+
+
+async def roll_back(tmux, names, outcome):
+    info('rolling back %s' % ', '.join(names))
+    # all windows are told to stop first, then their processes are cleaned
+    # up in parallel
+    cleanups = []
+    for name in names[::-1]:
+        try:
+            cleanups.append(await stop_window(tmux, name))
+            if outcome.windows[name] != 'failed':
+                outcome.windows[name] = 'rolled back'
+        except Exception as e:
+            warning('could not roll back %s: %s' % (name, str(e)))
+    await asyncio.gather(*cleanups, return_exceptions=True)
+
+
+async def run_step(tmux, step, admission=None, launched=None,
+                   launches=None):
+    """Run one step of a plan; returns the state of its window.
+
+    The names of the windows launched are appended to ``launched``, the
+    launches themselves (which are not cancelled with the step) to
+    ``launches``.
+    """
+    core = get_core()
+    name = step['window']
+    if step['op'] in ('stop', 'relaunch'):
+        cleanup = await stop_window(tmux, name)
+        if step['op'] == 'stop':
+            return 'stopped'
+        # the clean up would kill what is launched before it finished
+        await cleanup
+    if admission:
+        await admission.admit(name, step.get('cost'))
+    if launched is not None:
+        launched.append(name)
+    # watching from before the launch, so that no output is missed
+    watch = await core.blocking(tmux.watch_ready, name) \
+        if step.get('ready_when') else None
+    try:
+        locks = await _window_locks(tmux, name, 'launch')
+        # a launch is not cut short, only what comes after it: it keeps
+        # the window locked until it is over
+        launch = core.spawn(core.blocking(tmux.launch_window, name))
+        launch.add_done_callback(lambda _: _release(locks))
+        if launches is not None:
+            launches.append(launch)
+        await asyncio.shield(launch)
+        if step['wait'] > 0:
+            info('sleep %f seconds after launch of %s' % (step['wait'], name))
+            await asyncio.sleep(step['wait'])
+        ready = True
+        if watch:
+            ready = await watch.wait(step['timeout'])
+            if not ready:
+                error('output of window %s did not match in time' % name)
+    finally:
+        if watch:
+            await core.blocking(tmux.unwatch_ready, watch)
+    if ready and step['check']:
+        ready = await wait_ready(tmux, step)
+    await core.blocking(tmux.hooks.emit, 'ready' if ready else 'fail', name)
+    return 'ready' if ready else 'failed'
+
+
+async def wait_ready(tmux, step):
+    """Wait for the check of a window to pass, up to the step's timeout."""
+    debug('need to run check command')
+    winconf = tmux.window_config(step['window'])
+    running = False
+    loop = 0
+    waited = 0
+    while not running and waited < step['timeout']:
+        loop += 1
+        await asyncio.sleep(loop * tmux.sleepCheckLoop)
+        waited += loop * tmux.sleepCheckLoop
+        running = await check(tmux, winconf)
+        info('ran check for %s (loop %d) => %s' % (
+            step['window'], loop, running))
+    if not running:
+        error('window %s failed to come up in time' % step['window'])
+    return running
+
+
+def test_core():
+    core = Core(workers=2)
+
+    async def slow():
+        await asyncio.sleep(10)
+
+    async def scenario():
+        task = core.spawn(slow())
+        result = await core.blocking(lambda x: x * 2, 21)
+        task.cancel()
+        await asyncio.wait([task])
+        return result, task.cancelled()
+
+    assert core.run(scenario()) == (42, True)
+    assert core.stats()['tasks'] == 0 and core.stats()['busy'] == 0
+    core.close()
+
+
+def test_execute():
+    import os
+    import tempfile
+    from contextlib import contextmanager
+    from time import sleep
+    from .journal import Journal
+    from .plan import compile_plan
+
+    class Stub(object):
+        """Just enough of TMux, launching and stopping nothing."""
+        sleepCheckLoop = 0.01
+
+        def __init__(self, windows, failing, on_failure):
+            self.config = {'windows': windows, 'on_failure': on_failure}
+            self.failing = failing
+            self.calls = []
+            self.journal = Journal('s', os.path.join(tempfile.mkdtemp(),
+                                                     's.journal'))
+            self.hooks = self.state = self
+
+        def redeliver(self):
+            pass
+
+        def emit(self, event, window):
+            self.calls.append((event, window))
+
+        @contextmanager
+        def batch(self):
+            yield
+
+        timeout = None
+
+        def session_lock(self, operation, shared=False):
+            return self
+
+        def window_lock(self, window_name, operation):
+            return self
+
+        async def acquire_async(self):
+            return self
+
+        def release(self):
+            pass
+
+        def launch_window(self, name):
+            self.calls.append(('launch', name))
+            if name.startswith('slow'):
+                sleep(0.3)
+                self.calls.append(('launched', name))
+            if name in self.failing:
+                raise RuntimeError('%s does not start' % name)
+
+        def _interrupt_window(self, name, operation):
+            self.calls.append((operation, name))
+            return [], False, None
+
+    def run(windows, failing, on_failure, batch=1):
+        tmux = Stub(windows, failing, on_failure)
+        plan = compile_plan(tmux.config, '0' * 40, 's', 'launch', batch=batch)
+        outcome = get_core().run(execute(tmux, plan))
+        return outcome, tmux.calls
+
+    windows = [{'name': n, 'panes': ['true']} for n in ('a', 'b', 'c')]
+    windows[2]['depends'] = ['a']
+    try:
+        outcome, calls = run(windows, {'b'}, 'abort')
+        assert outcome.result == 'aborted' and outcome.windows == {
+            'a': 'ready', 'b': 'failed', 'c': 'skipped'}
+        outcome, calls = run(windows, {'b'}, 'continue')
+        assert outcome.result == 'failed' and outcome.windows == {
+            'a': 'ready', 'b': 'failed', 'c': 'ready'}
+        outcome, calls = run(windows, {'b'}, 'rollback')
+        assert outcome.result == 'rolled back' and outcome.windows == {
+            'a': 'rolled back', 'b': 'failed', 'c': 'skipped'}
+        # the windows launched are stopped in reverse order
+        assert [c for c in calls if c[0] == 'stop'] == [
+            ('stop', 'b'), ('stop', 'a')]
+
+        # a failure stops the other windows of its stage at once
+        windows = [{'name': 'slow', 'panes': ['true'], 'wait': 30},
+                   {'name': 'bad', 'panes': ['true']},
+                   {'name': 'later', 'panes': ['true']}]
+        outcome, calls = run(windows, {'bad'}, 'abort', batch=2)
+        assert outcome.windows == {
+            'slow': 'cancelled', 'bad': 'failed', 'later': 'skipped'}
+        assert ('launch', 'later') not in calls
+        # nor is a window rolled back before its launch is over
+        windows[0]['wait'] = 0
+        outcome, calls = run(windows, {'bad'}, 'rollback', batch=2)
+        assert outcome.windows['slow'] == 'rolled back'
+        assert calls.index(('launched', 'slow')) < calls.index(
+            ('stop', 'slow'))
+    finally:
+        shutdown()
+
+
+def test_lock_waits():
+    # waiting for a busy lock takes no worker, and gives up in time
+    import tempfile
+    from threading import Event
+    from .exc import LockError
+    from .locks import FileLock
+    core = Core(workers=1)
+    with tempfile.NamedTemporaryFile() as f:
+        held, done = Event(), Event()
+
+        def hold():
+            # by another thread than the one running the scenario
+            with FileLock(f.name, 'test'):
+                held.set()
+                done.wait()
+        Thread(target=hold).start()
+        held.wait()
+
+        async def scenario():
+            waiter = core.spawn(
+                FileLock(f.name, 'test', timeout=0.5).acquire_async())
+            assert await core.blocking(lambda: 42) == 42
+            try:
+                await waiter
+                assert False, 'busy lock acquired'
+            except LockError:
+                pass
+        try:
+            core.run(scenario())
+        finally:
+            done.set()
+    core.close()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""tmuled: long-lived TMuLE control daemon.
+
+The daemon keeps the parsed configuration, the tmux server connection and a
+process watcher alive, and answers requests from the ``tmule`` CLI over a
+Unix socket. The CLI falls back to controlling tmux directly when no daemon
+is running for its (config, session) pair.
+"""
+from __future__ import print_function, absolute_import
+
+import argparse
+import json
+import os
+import socket
+from logging import info, warning, error, basicConfig, INFO
+from threading import Thread, Lock, Event
+from time import time
+
+from .paths import socket_path
+
+# commands that may change what is running and hence invalidate the
+# status cache
+MUTATING_COMMANDS = {'launch', 'stop', 'relaunch', 'resume', 'terminate'}
+
+
+def call_daemon(args):
+    """Send the parsed CLI ``args`` to a running daemon.
+
+    Returns the reply dict, or None if no daemon serves this config/session.
+    """
+    path = socket_path(args.config, args.session)
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(0.5)
+        sock.connect(path)
+    except (OSError, socket.timeout):
+        sock.close()
+        return None
+    try:
+        # commands like launch can legitimately take a long time
+        sock.settimeout(None)
+        request = {'args': vars(args)}
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        buf = b''
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            buf += chunk
+    finally:
+        sock.close()
+    if not buf:
+        return None
+    return json.loads(buf.decode('utf-8'))
+
+
+class TMuleDaemon(object):
+
+    def __init__(self, configfile, session_name=None, sleep_sec=0.0,
+                 interval=2.0):
+        from .tmule import TMux
+        self.configfile = configfile
+        self.socket_path = socket_path(configfile, session_name)
+        self.interval = interval
+        self.tmux = TMux(
+            session_name=session_name,
+            configfile=configfile,
+            sleep_sec=sleep_sec)
+        self.tmux.init()
+        if self.tmux.has_output_limit():
+            self.tmux.start_output_guard()
+        self.lock = Lock()
+        self.stopped = Event()
+        # window name -> (timestamp, running)
+        self.status = {}
+
+    def _reload_if_changed(self):
+        # the config file, the files it includes and the directories of
+        # its include patterns
+        if self.tmux.config_cache.changed():
+            info('config %s changed, reloading' % self.configfile)
+            self.tmux.load_config()
+            self.tmux.init()
+            self.status = {}
+
+    def _refresh_status(self):
+        for name in self.tmux.list_windows():
+            try:
+                running = self.tmux.is_running(name)
+            except Exception as e:
+                warning('status of %s could not be determined: %s'
+                        % (name, str(e)))
+                continue
+            self.status[name] = (time(), running)
+
+    def _apply_scheduling(self):
+        # processes forked since the last round get the window's settings
+        for name, (_, running) in list(self.status.items()):
+            if running:
+                self.tmux.apply_scheduling(name, only_new=True)
+
+    def _watch(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                with self.lock:
+                    self._reload_if_changed()
+                self._refresh_status()
+                self._apply_scheduling()
+            except Exception as e:
+                warning('process watcher failed, carrying on: %s' % str(e))
+
+    def _cached_running(self, window_name):
+        entry = self.status.get(window_name)
+        if entry and time() - entry[0] <= 2 * self.interval:
+            return entry[1]
+        return None
+
+    def handle(self, request):
+        from .tmule import run_command
+        args = argparse.Namespace(**request['args'])
+        if args.cmd == 'ping':
+            return {'output': None}
+        if args.cmd == 'shutdown':
+            self.stopped.set()
+            return {'output': None}
+        if args.cmd == 'running':
+            running = self._cached_running(args.window)
+            if running is not None:
+                return {'output': str(running)}
+        with self.lock:
+            self.tmux.sleep_sec = args.wait
+            self.tmux.lock_timeout = getattr(args, 'lock_timeout', None)
+            output = run_command(self.tmux, args)
+            if args.cmd in MUTATING_COMMANDS:
+                self.status = {}
+        if args.cmd == 'running':
+            self.status[args.window] = (time(), output == 'True')
+        return {'output': output}
+
+    def serve(self):
+        import socketserver
+
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+
+            def handle(self):
+                line = self.rfile.readline()
+                try:
+                    reply = daemon.handle(json.loads(line.decode('utf-8')))
+                except Exception as e:
+                    error('request failed: %s' % str(e))
+                    reply = {'output': getattr(e, 'output', None),
+                             'error': str(e),
+                             'exit_code': getattr(e, 'exit_code', 1)}
+                self.wfile.write(json.dumps(reply).encode('utf-8'))
+
+        class Server(socketserver.ThreadingMixIn,
+                     socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        if os.path.exists(self.socket_path):
+            # a stale socket from a daemon that died
+            os.unlink(self.socket_path)
+        server = Server(self.socket_path, Handler)
+        os.chmod(self.socket_path, 0o600)
+        Thread(target=self._watch, daemon=True).start()
+        Thread(target=server.serve_forever, daemon=True).start()
+        info('tmuled serving %s on %s' % (self.configfile, self.socket_path))
+        try:
+            self.stopped.wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.shutdown()
+            server.server_close()
+            os.unlink(self.socket_path)
+
+
+def main():
+    basicConfig(level=INFO)
+    parser = argparse.ArgumentParser(
+        description='TMuLE control daemon; "tmule" commands for the same '
+        'config and session are served by it.')
+    parser.add_argument("--config", '-c', type=str,
+                        default='tmule.yaml',
+                        help="YAML config file. Default: tmule.yaml")
+    parser.add_argument("--session", '-s', type=str,
+                        default=None,
+                        help="The session that is controlled. "
+                        "Default: 'tmule'")
+    parser.add_argument("--wait", '-W', type=float,
+                        default=0.0,
+                        help="Seconds to wait between launching windows.")
+    parser.add_argument("--interval", type=float,
+                        default=2.0,
+                        help="Seconds between process watcher updates. "
+                        "Default: 2.0")
+    parser.add_argument("--stop", action='store_true',
+                        help="Stop the daemon serving this config/session.")
+    args = parser.parse_args()
+
+    if args.stop:
+        reply = call_daemon(argparse.Namespace(
+            config=args.config, session=args.session, cmd='shutdown'))
+        if reply is None:
+            warning('no daemon running for %s' % args.config)
+        return
+
+    if call_daemon(argparse.Namespace(
+            config=args.config, session=args.session,
+            cmd='ping')) is not None:
+        error('a daemon is already serving %s' % args.config)
+        return
+
+    TMuleDaemon(
+        args.config, session_name=args.session, sleep_sec=args.wait,
+        interval=args.interval).serve()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""Cached environment of ``init_cmd``.
+
+With ``env_cache: true`` the ``init_cmd`` is evaluated once in a bash, what
+it changes in the environment captured (``env -0`` before and after it)
+and cached, keyed by the text of ``init_cmd``, the modification times of
+the files it sources and the environment it inherits. Panes then only
+source a small file of ``export`` and ``unset`` statements, and checks run
+with the changes applied to the current environment, instead of each
+re-running ``init_cmd``: variables it does not touch (``DISPLAY``,
+``SSH_AUTH_SOCK``, ...) are never cached.
+Only the environment is captured: shell functions, aliases and other side
+effects of ``init_cmd`` are not.
+"""
+from __future__ import absolute_import
+
+import json
+import os
+import re
+from hashlib import sha1
+from logging import info, warning
+from shlex import quote
+from subprocess import Popen, PIPE
+
+from .paths import cache_dir, runtime_dir
+
+_SOURCE_RE = re.compile(r'(?:^|[;&|(\s])(?:source|\.)\s+([^\s;&|)]+)')
+
+# variables that describe the capturing shell, not the environment
+_VOLATILE = {'PWD', 'OLDPWD', 'SHLVL', '_'}
+
+_NAME_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def sourced_files(init_cmd):
+    """The (existing) files ``init_cmd`` sources directly."""
+    files = []
+    for m in _SOURCE_RE.finditer(init_cmd):
+        filename = os.path.expanduser(
+            os.path.expandvars(m.group(1).strip('"\'')))
+        if os.path.isfile(filename):
+            files.append(os.path.abspath(filename))
+    return files
+
+
+def cache_key(init_cmd):
+    h = sha1(init_cmd.encode('utf-8'))
+    # what init_cmd does may depend on any variable it inherits
+    for k in sorted(os.environ):
+        if k not in _VOLATILE:
+            h.update(('\0%s=%s' % (k, os.environ[k])).encode('utf-8'))
+    for filename in sourced_files(init_cmd):
+        st = os.stat(filename)
+        h.update(('\0%s\0%d\0%d' % (
+            filename, st.st_mtime_ns, st.st_size)).encode('utf-8'))
+    return h.hexdigest()[:16]
+
+
+def _parse(text):
+    env = {}
+    for entry in text.split('\0'):
+        if '=' in entry:
+            k, v = entry.split('=', 1)
+            if k not in _VOLATILE:
+                env[k] = v
+    return env
+
+
+def _capture(init_cmd):
+    """What ``init_cmd`` changes in the environment it inherits."""
+    # anything init_cmd prints goes to stderr, only the environments before
+    # and after it (separated by an empty entry) to stdout
+    script = 'exec 3>&1 1>&2\nenv -0 >&3\nprintf "\\0" >&3\n%s\nenv -0 >&3\n' % (
+        init_cmd)
+    p = Popen(['/bin/bash', '-c', script], stdout=PIPE, stdin=PIPE)
+    out, _ = p.communicate()
+    if p.returncode != 0:
+        warning('init_cmd exited with %d while capturing its environment'
+                % p.returncode)
+    before, _, after = out.decode('utf-8', 'replace').partition('\0\0')
+    before, after = _parse(before), _parse(after)
+    changed = dict((k, v) for k, v in after.items() if before.get(k) != v)
+    unset = sorted(k for k in before if k not in after)
+    return {'set': changed, 'unset': unset}
+
+
+def delta(init_cmd):
+    """What ``init_cmd`` changes in the current environment (cached)."""
+    path = os.path.join(cache_dir(), 'env-%s.json' % cache_key(init_cmd))
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        pass
+    info('capturing environment of init_cmd')
+    captured = _capture(init_cmd)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(captured, f)
+    os.replace(tmp, path)
+    return captured
+
+
+def snapshot(init_cmd):
+    """Return the current environment as changed by ``init_cmd``."""
+    changes = delta(init_cmd)
+    env = dict(os.environ)
+    for k in changes['unset']:
+        env.pop(k, None)
+    env.update(changes['set'])
+    return env
+
+
+def env_file(init_cmd):
+    """Write (if needed) a script applying the changes of ``init_cmd``.
+
+    The script only holds what ``init_cmd`` sets and unsets, and is named
+    after its content.
+    """
+    changes = delta(init_cmd)
+    lines = ['# environment of init_cmd, generated by TMuLE']
+    for k in changes['unset']:
+        if _NAME_RE.match(k):
+            lines.append('unset %s' % k)
+    for k in sorted(changes['set']):
+        if _NAME_RE.match(k):
+            lines.append('export %s=%s' % (k, quote(changes['set'][k])))
+    text = '\n'.join(lines) + '\n'
+    d = os.path.join(runtime_dir(), 'env')
+    if not os.path.isdir(d):
+        os.makedirs(d, mode=0o700)
+    path = os.path.join(d, '%s.sh' % sha1(text.encode('utf-8')).hexdigest()[:16])
+    if os.path.exists(path):
+        return path
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, path)
+    return path
+
+
+def test_sourced_files():
+    import tempfile
+    with tempfile.NamedTemporaryFile('w', suffix='.bash') as f:
+        init_cmd = 'export A=1\nsource %s && . /nonexistent/setup.bash' % f.name
+        assert sourced_files(init_cmd) == [f.name]
+        key = cache_key(init_cmd)
+        os.utime(f.name, (0, 0))
+        assert cache_key(init_cmd) != key
+
+
+def test_delta():
+    import tempfile
+    saved = dict(os.environ)
+    os.environ['XDG_CACHE_HOME'] = tempfile.mkdtemp()
+    try:
+        os.environ['TMULE_BASE'] = 'a'
+        os.environ['TMULE_OTHER'] = '1'
+        os.environ['TMULE_GONE'] = 'y'
+        init_cmd = 'export TMULE_X=$TMULE_BASE/x; unset TMULE_GONE'
+        env = snapshot(init_cmd)
+        assert env['TMULE_X'] == 'a/x' and env['TMULE_OTHER'] == '1'
+        # untouched variables come from the current environment
+        os.environ['TMULE_OTHER'] = '2'
+        env = snapshot(init_cmd)
+        assert env['TMULE_OTHER'] == '2' and 'TMULE_GONE' not in env
+        # and what it derives from them is captured again
+        os.environ['TMULE_BASE'] = 'b'
+        assert snapshot(init_cmd)['TMULE_X'] == 'b/x'
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
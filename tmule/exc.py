@@ -67,3 +67,59 @@ class AmbiguousOption(OptionError):
     """Option that could potentially match more than one."""
 
     pass
+
+
+class TMuleException(Exception):
+
+    """Base Exception for TMuLE errors."""
+
+
+class ConfigError(TMuleException):
+
+    """Invalid configuration.
+
+    ``errors`` is a list of ``(location, message)`` pairs, where location is
+    a ``(file, line, column)`` tuple (or None if unknown).
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        super(ConfigError, self).__init__(str(self))
+
+    def __str__(self):
+        lines = []
+        for location, message in self.errors:
+            if location:
+                lines.append('%s:%d:%d: %s' % (location + (message,)))
+            else:
+                lines.append(message)
+        return '\n'.join(lines)
+
+
+class LockError(TMuleException):
+
+    """A session or window is busy with an operation of another process."""
+
+    pass
+
+
+class PlanFailed(TMuleException):
+
+    """A launch or relaunch did not bring up all of its windows.
+
+    ``outcome`` is the :class:`tmule.plan.Outcome`, ``output`` what the
+    command has to print nevertheless (or None).
+    """
+
+    def __init__(self, outcome, output=None):
+        self.outcome = outcome
+        self.output = output
+        super(PlanFailed, self).__init__(outcome.summary())
+
+
+class InvalidPattern(TMuleException):
+
+    """A search pattern is not a valid regular expression."""
+
+    # like grep
+    exit_code = 2
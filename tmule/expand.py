@@ -0,0 +1,105 @@
+"""Expansion of window templates with ``foreach`` and ``matrix``.
+
+A window with ``foreach: [front, back]`` stands for one window per item,
+``@item@`` being replaced by the item in all its strings (name, panes,
+check, tags, ...); items that are mappings define one variable per key
+instead. ``matrix: {robot: [r1, r2], camera: [front, back]}`` gives one
+window per combination, with ``@robot@`` and ``@camera@``. Both can be
+combined. Expansion happens when the configuration is compiled, so it is
+cached along with it.
+"""
+from __future__ import absolute_import
+
+from itertools import product
+
+from .config import ConfigDict, ConfigList
+from .exc import ConfigError
+
+TEMPLATE_KEYS = ('foreach', 'matrix')
+
+
+def _where(container, key=None):
+    where = getattr(container, 'where', None)
+    return where(key) if where else None
+
+
+def _combinations(win):
+    axes = []
+    if 'foreach' in win:
+        items = win['foreach']
+        if not isinstance(items, list):
+            raise ConfigError([(_where(win, 'foreach'),
+                                '"foreach" of window must be a list')])
+        axes.append([dict((str(k), str(v)) for k, v in item.items())
+                     if isinstance(item, dict) else {'item': str(item)}
+                     for item in items])
+    if 'matrix' in win:
+        matrix = win['matrix']
+        if not isinstance(matrix, dict) or not all(
+                isinstance(v, list) for v in matrix.values()):
+            raise ConfigError([(_where(win, 'matrix'), '"matrix" of window '
+                                'must map variables to lists')])
+        for var in sorted(matrix):
+            axes.append([{str(var): str(v)} for v in matrix[var]])
+    for combination in product(*axes):
+        variables = {}
+        for v in combination:
+            variables.update(v)
+        yield variables
+
+
+def substitute(node, variables):
+    """A copy of ``node`` with ``@var@`` replaced in all strings."""
+    if isinstance(node, str):
+        if '@' in node:
+            for var, value in variables.items():
+                node = node.replace('@%s@' % var, value)
+        return node
+    if isinstance(node, dict):
+        copy = ConfigDict()
+        copy.mark = getattr(node, 'mark', None)
+        copy.marks = getattr(node, 'marks', {})
+        for k, v in node.items():
+            copy[k] = substitute(v, variables)
+        return copy
+    if isinstance(node, list):
+        copy = ConfigList(substitute(v, variables) for v in node)
+        copy.mark = getattr(node, 'mark', None)
+        copy.marks = getattr(node, 'marks', [])
+        return copy
+    return node
+
+
+def expand_windows(windows):
+    """Yield ``windows`` with every template replaced by its expansions."""
+    for win in windows:
+        if not isinstance(win, dict) or not any(
+                k in win for k in TEMPLATE_KEYS):
+            yield win
+            continue
+        template = ConfigDict(
+            (k, v) for k, v in win.items() if k not in TEMPLATE_KEYS)
+        template.mark = getattr(win, 'mark', None)
+        template.marks = getattr(win, 'marks', {})
+        for variables in _combinations(win):
+            yield substitute(template, variables)
+
+
+def test_expand_windows():
+    windows = [
+        {'name': 'core', 'panes': ['roscore']},
+        {'name': 'cam_@item@', 'foreach': ['front', 'back'],
+         'panes': ['camera.launch name:=@item@'], 'tags': ['@item@']},
+        {'name': '@robot@_@sensor@', 'panes': ['run @robot@ @sensor@'],
+         'matrix': {'robot': ['r1', 'r2'], 'sensor': ['lidar']}},
+        {'name': 'arm_@side@', 'panes': ['arm @id@'],
+         'foreach': [{'side': 'left', 'id': 1}, {'side': 'right', 'id': 2}]},
+    ]
+    expanded = list(expand_windows(windows))
+    assert [w['name'] for w in expanded] == [
+        'core', 'cam_front', 'cam_back', 'r1_lidar', 'r2_lidar',
+        'arm_left', 'arm_right']
+    assert expanded[2]['panes'] == ['camera.launch name:=back']
+    assert expanded[2]['tags'] == ['back']
+    assert expanded[6]['panes'] == ['arm 2']
+    assert 'foreach' not in expanded[1]
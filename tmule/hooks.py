@@ -0,0 +1,232 @@
+"""Hooks run when windows become ready, fail their check or are stopped.
+
+The events are ``ready`` (a window was launched and its ``check``, if any,
+passed), ``fail`` (its check did not pass in time) and ``stop``. Python
+code can ``register`` functions for them; the configuration (globally and
+per window) can declare hooks under ``hooks: {on_ready: ..., on_fail: ...,
+on_stop: ...}``, each a shell command (run with ``TMULE_EVENT``,
+``TMULE_WINDOW`` and ``TMULE_SESSION`` set) or ``{url: ..., method: ...}``
+for an HTTP request with the event as JSON body. A list gives several.
+
+Hooks run on a small pool of worker threads, so a slow hook never holds up
+a launch. Configured hooks are delivered at least once: each delivery is
+recorded in the journal as pending before it is attempted and as done (or
+failed, after some retries) afterwards; deliveries left pending by a
+process that died are attempted again by the next one executing a plan.
+"""
+from __future__ import absolute_import
+
+import json
+import os
+from logging import info, warning, debug
+from threading import Lock
+from time import time, sleep
+
+EVENTS = ('ready', 'fail', 'stop')
+WORKERS = 4
+RETRIES = 3
+# seconds a hook may take
+TIMEOUT = 30
+
+
+def configured_hooks(config, winconf, event):
+    """The hooks declared for ``event`` of a window, global ones first."""
+    hooks = []
+    for conf in (config, winconf):
+        declared = (conf.get('hooks') or {}).get('on_%s' % event) or []
+        if not isinstance(declared, list):
+            declared = [declared]
+        hooks.extend(declared)
+    return hooks
+
+
+def _environ(payload):
+    env = dict(os.environ)
+    env.update({'TMULE_EVENT': payload['event'],
+                'TMULE_WINDOW': payload['window'],
+                'TMULE_SESSION': payload['session']})
+    return env
+
+
+def run_hook(hook, payload):
+    """Run one configured hook; raises an exception if it failed."""
+    if isinstance(hook, dict):
+        from urllib.request import Request, urlopen
+        request = Request(hook['url'], method=hook.get('method', 'POST'),
+                          data=json.dumps(payload).encode('utf-8'),
+                          headers={'Content-Type': 'application/json'})
+        urlopen(request, timeout=TIMEOUT).close()
+    else:
+        from subprocess import run
+        r = run(hook, shell=True, executable='/bin/bash',
+                env=_environ(payload), timeout=TIMEOUT)
+        if r.returncode != 0:
+            raise RuntimeError('exit code %d' % r.returncode)
+
+
+class Hooks(object):
+
+    def __init__(self, tmux, workers=WORKERS, retries=RETRIES):
+        self.tmux = tmux
+        self.workers = workers
+        self.retries = retries
+        # what delivers a configured hook (replaced when replaying a trace)
+        self.run = run_hook
+        self.handlers = dict((event, []) for event in EVENTS)
+        self._pool = None
+        self._lock = Lock()
+
+    def register(self, event, handler):
+        """Call ``handler(event, window, payload)`` on ``event``."""
+        if event not in EVENTS:
+            raise ValueError('unknown event %s, must be one of %s'
+                             % (event, ', '.join(EVENTS)))
+        self.handlers[event].append(handler)
+
+    def _submit(self, *args):
+        with self._lock:
+            if self._pool is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._pool = ThreadPoolExecutor(
+                    self.workers, thread_name_prefix='tmule-hook')
+            return self._pool.submit(*args)
+
+    def emit(self, event, window, **fields):
+        winconf = self.tmux.window_config(window) if window else {}
+        payload = dict(fields, event=event, window=window,
+                       session=self.tmux.session_name, time=time())
+        for handler in self.handlers[event]:
+            self._submit(self._call, handler, event, window, payload)
+        for hook in configured_hooks(self.tmux.config, winconf, event):
+            delivery = os.urandom(6).hex()
+            self.tmux.journal.record('hook', 'pending', id=delivery,
+                                     hook=hook, payload=payload,
+                                     window=window)
+            self._submit(self._deliver, delivery, hook, payload)
+
+    def _call(self, handler, event, window, payload):
+        try:
+            handler(event, window, payload)
+        except Exception as e:
+            warning('%s hook %r of %s failed: %s' % (
+                event, handler, window, e))
+
+    def _deliver(self, delivery, hook, payload):
+        journal = self.tmux.journal
+        for attempt in range(self.retries):
+            try:
+                self.run(hook, payload)
+                journal.record('hook', 'done', id=delivery,
+                               window=payload['window'])
+                debug('%s hook %r of %s delivered' % (
+                    payload['event'], hook, payload['window']))
+                return
+            except Exception as e:
+                warning('%s hook %r of %s failed (attempt %d): %s' % (
+                    payload['event'], hook, payload['window'], attempt + 1,
+                    e))
+                error = str(e)
+                if attempt + 1 < self.retries:
+                    sleep(2 ** attempt)
+        journal.record('hook', 'failed', id=delivery, error=error,
+                       window=payload['window'])
+
+    def redeliver(self):
+        """Deliver again what dead processes left pending in the journal.
+
+        Only the journal written since the previous call (of any process)
+        is read: where it stopped and what was pending then are kept in
+        ``<journal>.hooks``.
+        """
+        from psutil import pid_exists
+        from .locks import FileLock
+        journal = self.tmux.journal
+        path = journal.path + '.hooks'
+        with FileLock(path + '.lock', 'hook deliveries', 'redeliver'):
+            try:
+                with open(path) as f:
+                    saved = json.load(f)
+                cursor, pending = saved['cursor'], saved['pending']
+            except (IOError, OSError, ValueError, KeyError):
+                cursor, pending = None, {}
+            entries, cursor = journal.since(cursor)
+            for entry in entries:
+                if entry['op'] != 'hook':
+                    continue
+                if entry['phase'] == 'pending':
+                    pending[entry['id']] = entry
+                else:
+                    pending.pop(entry['id'], None)
+            for delivery, entry in list(pending.items()):
+                if pid_exists(entry['pid']):
+                    # still being delivered
+                    continue
+                info('delivering %s hook of %s again' % (
+                    entry['payload']['event'], entry['window']))
+                # pending again, read back the next time
+                del pending[delivery]
+                journal.record('hook', 'pending', id=delivery,
+                               hook=entry['hook'], payload=entry['payload'],
+                               window=entry['window'])
+                self._submit(self._deliver, delivery, entry['hook'],
+                             entry['payload'])
+            tmp = '%s.%d.tmp' % (path, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump({'cursor': cursor, 'pending': pending}, f)
+            os.replace(tmp, path)
+
+    def wait(self):
+        """Wait for all hooks emitted so far."""
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+
+def test_configured_hooks():
+    config = {'hooks': {'on_fail': 'notify-send failed'}}
+    winconf = {'name': 'nav', 'hooks': {
+        'on_fail': [{'url': 'http://localhost:8080/'}], 'on_stop': 'true'}}
+    assert configured_hooks(config, winconf, 'fail') == [
+        'notify-send failed', {'url': 'http://localhost:8080/'}]
+    assert configured_hooks(config, winconf, 'stop') == ['true']
+    assert configured_hooks(config, {}, 'ready') == []
+    payload = {'event': 'stop', 'window': 'nav', 'session': 's'}
+    run_hook('test "$TMULE_EVENT $TMULE_WINDOW" = "stop nav"', payload)
+    try:
+        run_hook('exit 3', payload)
+        assert False, 'failing hook not reported'
+    except RuntimeError as e:
+        assert 'exit code 3' in str(e)
+
+
+def test_redeliver():
+    import tempfile
+    from .journal import Journal
+
+    class Stub(object):
+        session_name = 's'
+        config = {}
+        journal = Journal('s', os.path.join(tempfile.mkdtemp(), 's.journal'))
+    stub = Stub()
+    done = tempfile.mktemp()
+    payload = {'event': 'stop', 'window': 'nav', 'session': 's'}
+    # left pending by a process that died, in the rotated journal
+    stub.journal.record('hook', 'pending', id='1', hook='touch %s' % done,
+                        payload=payload, window='nav')
+    with open(stub.journal.path) as f:
+        entry = json.loads(f.read())
+    entry['pid'] = 1 << 30
+    with open(stub.journal.path, 'w') as f:
+        f.write(json.dumps(entry) + '\n')
+    os.replace(stub.journal.path, stub.journal.path + '.1')
+    hooks = Hooks(stub)
+    hooks.redeliver()
+    hooks.wait()
+    assert os.path.exists(done)
+    os.remove(done)
+    # delivered: not again
+    hooks.redeliver()
+    hooks.wait()
+    assert not os.path.exists(done)
+    assert [e['phase'] for e in stub.journal.tail(None)] == ['pending', 'done']
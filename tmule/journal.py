@@ -0,0 +1,128 @@
+"""Journal of the operations done on a session.
+
+Every launch, stop, relaunch and kill is appended as JSON lines (one when
+it starts, one when it is done or failed, with pid and time) to
+``$XDG_STATE_HOME/tmule/<session>.journal``, so that it is clear what
+which process did to a session, also when several run at once. Entries
+are written with a single ``write`` to a file opened for appending, so
+lines of concurrent writers do not interleave.
+"""
+from __future__ import absolute_import
+
+import json
+import os
+from contextlib import contextmanager
+from time import time
+
+from .paths import state_dir
+
+# the journal is rotated to <session>.journal.1 beyond this size
+MAX_SIZE = 1 << 20
+
+
+def _inode(path):
+    try:
+        return os.stat(path).st_ino
+    except OSError:
+        return None
+
+
+class Journal(object):
+
+    def __init__(self, session_name, path=None):
+        self.path = path or os.path.join(
+            state_dir(), '%s.journal' % session_name)
+
+    def record(self, operation, phase, **fields):
+        entry = dict(fields, time=time(), pid=os.getpid(), op=operation,
+                     phase=phase)
+        try:
+            if os.path.getsize(self.path) > MAX_SIZE:
+                os.replace(self.path, self.path + '.1')
+        except OSError:
+            pass
+        line = json.dumps(entry, sort_keys=True) + '\n'
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, line.encode('utf-8'))
+        finally:
+            os.close(fd)
+
+    @contextmanager
+    def operation(self, operation, **fields):
+        """Record the start and the outcome of the operation in the block.
+
+        The block gets a dict for fields to add to the final entry; with an
+        ``error`` in it, the operation is recorded as failed.
+        """
+        self.record(operation, 'start', **fields)
+        result = {}
+        try:
+            yield result
+        except Exception as e:
+            self.record(operation, 'failed', **dict(fields, error=str(e)))
+            raise
+        self.record(operation, 'failed' if 'error' in result else 'done',
+                    **dict(fields, **result))
+
+    def since(self, cursor=None):
+        """The entries appended after ``cursor`` and the cursor after them.
+
+        A cursor is the (inode, offset) of a journal file, so that the end
+        of a journal rotated since is read as well; without one, the
+        rotated journal and the current one are read entirely.
+        """
+        rotated = self.path + '.1'
+        while True:
+            inode, offset = cursor or (None, 0)
+            if inode is not None and inode == _inode(self.path):
+                reads = [(self.path, offset)]
+            elif inode is not None and inode == _inode(rotated):
+                reads = [(rotated, offset), (self.path, 0)]
+            else:
+                inode, reads = None, [(rotated, 0), (self.path, 0)]
+            entries = []
+            new = cursor
+            for path, start in reads:
+                try:
+                    with open(path, 'rb') as f:
+                        ino = os.fstat(f.fileno()).st_ino
+                        if start and ino != inode:
+                            # rotated meanwhile
+                            break
+                        f.seek(start)
+                        data = f.read()
+                except (IOError, OSError):
+                    continue
+                # a line being written is read the next time
+                end = data.rfind(b'\n') + 1
+                entries.extend(json.loads(line) for line in
+                               data[:end].decode('utf-8').splitlines()
+                               if line.strip())
+                new = (ino, start + end)
+            else:
+                return entries, new
+
+    def tail(self, n=20):
+        """The last ``n`` entries (all of them if ``n`` is None)."""
+        try:
+            with open(self.path) as f:
+                lines = f.readlines()[-n:] if n else f.readlines()
+        except (IOError, OSError):
+            return []
+        return [json.loads(line) for line in lines if line.strip()]
+
+
+def test_since():
+    import tempfile
+    journal = Journal('s', os.path.join(tempfile.mkdtemp(), 's.journal'))
+    journal.record('launch', 'start')
+    entries, cursor = journal.since()
+    assert [e['phase'] for e in entries] == ['start']
+    journal.record('launch', 'done')
+    os.replace(journal.path, journal.path + '.1')
+    journal.record('stop', 'start')
+    entries, cursor = journal.since(cursor)
+    assert [(e['op'], e['phase']) for e in entries] == [
+        ('launch', 'done'), ('stop', 'start')]
+    assert journal.since(cursor)[0] == []
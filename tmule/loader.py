@@ -1,26 +1,207 @@
 import yaml
 import os.path
+import re
+import shlex
+from copy import deepcopy
+from glob import glob, has_magic
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from .config import ConfigDict, ConfigList
+from .exc import ConfigError
+from .paths import include_path
+
+# use libyaml for parsing where available, it is a lot faster
+_BaseLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# finds the arguments of (most) !include tags in raw YAML, to start reading
+# nested includes before the including file has been parsed
+_INCLUDE_RE = re.compile(r'!include\s+([^\n#]+)')
+
+
+def _mark(node):
+    m = node.start_mark
+    return (m.name, m.line + 1, m.column + 1)
+
+
+def _split(spec):
+    try:
+        return shlex.split(spec)
+    except ValueError:
+        return spec.split()
+
+
+class IncludeResolver(object):
+    """Shared state of one (top-level) load with all its includes.
+
+    Files are read concurrently, and speculatively before they are needed:
+    as soon as a file has been read, the files it includes are queued, so
+    the whole include tree is read while it is being parsed. Parsing itself
+    stays in the loading thread. Files included more than once are parsed
+    only once. ``dependencies`` collects all files (and directories of glob
+    patterns) the configuration was built from, and ``expansions`` the
+    include specs using environment variables or ``~`` (with the directory
+    they are relative to) and the paths they expanded to, for cache
+    invalidation.
+    """
+
+    def __init__(self, max_workers=8):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.reads = {}
+        self._lock = Lock()
+        self.parsed = {}
+        self.dependencies = set()
+        self.expansions = {}
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    def expand(self, spec, root):
+        """Return the files ``spec`` (one entry of an !include) refers to."""
+        filename = include_path(spec, root)
+        if '$' in spec or spec.startswith('~'):
+            with self._lock:
+                self.expansions[(spec, os.path.abspath(root))] = filename
+        if not has_magic(filename):
+            return [filename]
+        self.dependencies.add(os.path.dirname(filename))
+        return sorted(glob(filename))
+
+    def _read(self, filename):
+        with open(filename, 'r') as f:
+            text = f.read()
+        root = os.path.dirname(filename)
+        for m in _INCLUDE_RE.finditer(text):
+            specs = m.group(1).strip().strip('[]').replace(',', ' ')
+            for spec in _split(specs):
+                if '$' not in spec:
+                    for f in self.expand(spec, root):
+                        self.prefetch(f)
+        return text
+
+    def prefetch(self, filename):
+        with self._lock:
+            if filename not in self.reads:
+                self.reads[filename] = self.executor.submit(
+                    self._read, filename)
+
+    def read(self, filename):
+        self.prefetch(filename)
+        return self.reads[filename].result()
+
+
+class _Stream(object):
+    """In-memory file content, named like the file it came from."""
+
+    def __init__(self, text, name):
+        self.text = text
+        self.name = name
+
+    def read(self, size=-1):
+        text, self.text = self.text, ''
+        return text
+
 
 # This is a solution provided by Josh Bode in stackoverflow to provide import
 # https://stackoverflow.com/questions/528281/how-can-i-include-an-yaml-file-inside-another
-class Loader(yaml.SafeLoader):
+class Loader(_BaseLoader):
 
-    def __init__(self, stream):
+    def __init__(self, stream, parent=None):
 
         self._root = os.path.split(stream.name)[0]
+        self._file = os.path.abspath(stream.name)
+        if parent:
+            self._stack = parent._stack + [self._file]
+            self.resolver = parent.resolver
+        else:
+            self._stack = [self._file]
+            self.resolver = IncludeResolver()
+        self.dependencies = self.resolver.dependencies
+        self.dependencies.add(self._file)
 
         super(Loader, self).__init__(stream)
 
+    def dispose(self):
+        if len(self._stack) == 1:
+            self.resolver.close()
+        super(Loader, self).dispose()
+
+    def construct_config_map(self, node):
+        data = ConfigDict()
+        data.mark = _mark(node)
+        yield data
+        data.update(self.construct_mapping(node))
+        marks = {}
+        for key_node, value_node in node.value:
+            try:
+                marks[self.construct_object(key_node)] = _mark(value_node)
+            except TypeError:
+                # unhashable key, the validation will complain about it
+                pass
+        data.marks = marks
+
+    def construct_config_seq(self, node):
+        data = ConfigList()
+        data.mark = _mark(node)
+        yield data
+        data.extend(self.construct_sequence(node))
+        data.marks = [_mark(n) for n in node.value]
+
+    def _load_file(self, filename, mark):
+        if filename in self._stack:
+            raise ConfigError([(mark, 'include loop: %s' % ' -> '.join(
+                self._stack + [filename]))])
+        if filename in self.resolver.parsed:
+            return deepcopy(self.resolver.parsed[filename])
+        try:
+            text = self.resolver.read(filename)
+        except (IOError, OSError) as e:
+            raise ConfigError([(mark, 'cannot include %s: %s' % (
+                filename, e.strerror))])
+        loader = Loader(_Stream(text, filename), parent=self)
+        try:
+            data = loader.get_single_data()
+        finally:
+            loader.dispose()
+        self.dependencies.add(filename)
+        self.resolver.parsed[filename] = data
+        return deepcopy(data)
+
     def include(self, node):
+        """Include the lists from one or more files.
 
-        data = []
-        for file in str(self.construct_scalar(node)).split(' '):
-            if (file[:1] == '$'):
-                filename = os.path.expandvars(file)
-            else:
-                filename = os.path.join(self._root, file)
-            with open(filename, 'r') as f:
-                data += yaml.load(f, Loader)
+        Files are given as a space separated string (use quotes for names
+        with spaces) or as a list, may be relative to the including file,
+        contain environment variables and glob patterns.
+        """
+        data = ConfigList()
+        data.mark = _mark(node)
+        data.marks = []
+        if isinstance(node, yaml.SequenceNode):
+            specs = [str(s) for s in self.construct_sequence(node)]
+        else:
+            specs = _split(str(self.construct_scalar(node)))
+        filenames = []
+        for spec in specs:
+            files = self.resolver.expand(spec, self._root)
+            if not files:
+                raise ConfigError([(data.mark, 'no files match %s' % spec)])
+            filenames += files
+        for filename in filenames:
+            self.resolver.prefetch(filename)
+        for filename in filenames:
+            included = self._load_file(filename, data.mark)
+            if included is None:
+                # empty file
+                continue
+            if not isinstance(included, ConfigList):
+                raise ConfigError([(data.mark, '%s does not contain a list'
+                                    % filename)])
+            data += included
+            data.marks += included.marks
         return data
 
-Loader.add_constructor('!include', Loader.include)
\ No newline at end of file
+
+Loader.add_constructor('tag:yaml.org,2002:map', Loader.construct_config_map)
+Loader.add_constructor('tag:yaml.org,2002:seq', Loader.construct_config_seq)
+Loader.add_constructor('!include', Loader.include)
@@ -0,0 +1,230 @@
+"""Advisory locks coordinating TMuLE processes working on the same session.
+
+Operations changing the whole session (creating windows, killing the
+session) hold the session lock exclusively; plans and operations on a
+single window hold it shared plus the lock of each window they launch or
+stop, and commands only looking at a complete session take no lock. Locks are flock(2)
+locks on files in the runtime directory, so they vanish with the process
+holding them. A process waits for a busy lock (``timeout=None``) or gives
+up with a :class:`LockError` naming the holder after ``timeout`` seconds.
+Tasks of an asyncio loop wait with ``acquire_async``, which does not hold
+a thread while the lock is busy.
+
+Within one process, a lock belongs to the thread taking it, or to the
+operation that thread works for (see ``set_lock_owner``; :mod:`tmule.core`
+runs each operation as an owner of its own, on whatever threads and
+tasks): its owner can acquire it again (it is counted), which lets a plan
+take window locks while holding the session lock and lets the clean up of
+a stopped window keep the window lock until it is done. Other threads and
+operations of the process wait for it like other processes do.
+"""
+from __future__ import absolute_import
+
+import fcntl
+import os
+from contextvars import ContextVar
+from logging import info
+from threading import Lock, current_thread
+from time import sleep, time
+
+from .exc import LockError
+from .paths import runtime_dir
+
+# (path, owner) -> [fd, count] of the locks held by this process
+_held = {}
+# (path, owner) of the locks being acquired
+_acquiring = set()
+_mutex = Lock()
+
+_owner = ContextVar('tmule_lock_owner', default=None)
+
+
+def lock_owner():
+    """Who locks taken now belong to: the operation, or else the thread."""
+    return _owner.get() or current_thread()
+
+
+def set_lock_owner(owner):
+    """Make locks taken in this context (and the ones copied from it, like
+    asyncio tasks) belong to ``owner``."""
+    _owner.set(owner)
+
+
+def _lock_dir(session_name):
+    d = os.path.join(runtime_dir(), 'locks', session_name)
+    if not os.path.isdir(d):
+        os.makedirs(d, mode=0o700)
+    return d
+
+
+class FileLock(object):
+
+    def __init__(self, path, what, operation='', shared=False, timeout=None):
+        self.path = path
+        self.what = what
+        self.operation = operation
+        self.shared = shared
+        self.timeout = timeout
+
+    def _holder(self, fd):
+        try:
+            return os.pread(fd, 200, 0).decode('utf-8', 'replace').strip()
+        except OSError:
+            return ''
+
+    def acquire(self):
+        for delay in self._steps():
+            sleep(delay)
+        return self
+
+    async def acquire_async(self):
+        """Acquire the lock in a task, waiting on the loop instead of
+        holding a thread while it is busy."""
+        import asyncio
+        steps = self._steps()
+        try:
+            for delay in steps:
+                await asyncio.sleep(delay)
+        finally:
+            # cancelled: give up what was taken so far
+            steps.close()
+        return self
+
+    def _steps(self):
+        # taking the lock, yielding the seconds to wait before trying again
+        # (so that threads can sleep and tasks can await)
+        key = (self.path, lock_owner())
+        while True:
+            with _mutex:
+                if key not in _acquiring:
+                    if key in _held:
+                        _held[key][1] += 1
+                        self._key = key
+                        return
+                    _acquiring.add(key)
+                    break
+            # another thread of the same owner is taking it right now
+            yield 0.01
+        fd = None
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            mode = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+            start = time()
+            waiting = False
+            while True:
+                try:
+                    fcntl.flock(fd, mode | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    holder = self._holder(fd) or 'another process'
+                    if self.timeout is not None and \
+                            time() - start >= self.timeout:
+                        raise LockError('%s is busy (%s)' % (
+                            self.what, holder))
+                    if not waiting:
+                        info('waiting for %s, busy (%s)' % (
+                            self.what, holder))
+                        waiting = True
+                    yield 0.1
+            if not self.shared:
+                os.ftruncate(fd, 0)
+                os.pwrite(fd, ('pid %d: %s' % (
+                    os.getpid(), self.operation)).encode('utf-8'), 0)
+            with _mutex:
+                _held[key] = [fd, 1]
+            fd = None
+            self._key = key
+        finally:
+            if fd is not None:
+                os.close(fd)
+            with _mutex:
+                _acquiring.discard(key)
+
+    def release(self):
+        # by the owner that acquired it, from whichever thread
+        with _mutex:
+            entry = _held[self._key]
+            entry[1] -= 1
+            if entry[1] > 0:
+                return
+            del _held[self._key]
+        # closing the file releases the flock
+        os.close(entry[0])
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def session_lock(session_name, operation='', shared=False, timeout=None):
+    return FileLock(os.path.join(_lock_dir(session_name), 'session.lock'),
+                    'session %s' % session_name, operation, shared, timeout)
+
+
+def window_lock(session_name, window_name, operation='', timeout=None):
+    return FileLock(os.path.join(_lock_dir(session_name), '%s.lock' %
+                                 window_name.replace(os.sep, '_')),
+                    'window %s' % window_name, operation, False, timeout)
+
+
+def test_file_lock():
+    import sys
+    import tempfile
+    from subprocess import call, DEVNULL
+    with tempfile.NamedTemporaryFile() as f:
+        lock = FileLock(f.name, 'test', 'testing')
+        with lock:
+            with lock:
+                pass
+            # still held, by this process
+            assert call([sys.executable, '-c', 'import fcntl, sys; '
+                         'fcntl.flock(open(sys.argv[1]), fcntl.LOCK_EX | '
+                         'fcntl.LOCK_NB)', f.name], stderr=DEVNULL) != 0
+        assert not _held
+        assert call([sys.executable, '-c', 'import fcntl, sys; '
+                     'fcntl.flock(open(sys.argv[1]), fcntl.LOCK_EX | '
+                     'fcntl.LOCK_NB)', f.name]) == 0
+
+
+def test_file_lock_threads():
+    import tempfile
+    from threading import Thread, Event
+    with tempfile.NamedTemporaryFile() as f:
+        held, release = Event(), Event()
+
+        def hold():
+            with FileLock(f.name, 'test'):
+                held.set()
+                release.wait()
+        t = Thread(target=hold)
+        t.start()
+        held.wait()
+        # another thread of the process does not get it
+        try:
+            FileLock(f.name, 'test', timeout=0.2).acquire()
+            assert False, 'lock held by another thread acquired'
+        except LockError:
+            pass
+        release.set()
+        t.join()
+        FileLock(f.name, 'test', timeout=0.2).acquire().release()
+
+        # threads of one owner share it, even when acquiring it at once
+        errors = []
+
+        def share(owner):
+            set_lock_owner(owner)
+            try:
+                for _ in range(20):
+                    FileLock(f.name, 'test', shared=True).acquire().release()
+            except Exception as e:
+                errors.append(e)
+        owner = object()
+        threads = [Thread(target=share, args=(owner,)) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert not errors and not _held
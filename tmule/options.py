@@ -0,0 +1,139 @@
+"""tmux options of the session, its windows and their panes.
+
+``tmux_options`` in the configuration has the scopes ``session``,
+``window`` (all windows) and ``pane`` (all panes), each mapping tmux option
+names to values, and may name a ``preset`` to start from. A window's own
+``tmux_options`` can have ``window``, ``pane`` and ``panes`` (a list with
+the options of each pane, in the order of ``panes``) and a ``preset`` as
+well. Options are set once, when the session, a window or a pane is
+created, with batches of ``set-option`` commands run by a single tmux
+call each.
+"""
+from __future__ import absolute_import
+
+from logging import debug, warning
+
+SCOPES = ('session', 'window', 'pane')
+
+PRESETS = {
+    # robots nobody looks at most of the time: little scrollback (it is
+    # kept in memory for every pane), no status line redraws or activity
+    # monitoring, and panes of crashed commands are kept for inspection
+    'headless': {
+        'session': {
+            'history-limit': 2000,
+            'status-interval': 0,
+            'visual-activity': 'off',
+            'visual-bell': 'off',
+            'visual-silence': 'off',
+        },
+        'window': {
+            'monitor-activity': 'off',
+            'monitor-bell': 'off',
+            'monitor-silence': 0,
+            'automatic-rename': 'off',
+        },
+        'pane': {
+            'remain-on-exit': 'on',
+        },
+    },
+}
+
+# number of set-option commands per tmux call
+BATCH = 100
+
+
+def _value(value):
+    if isinstance(value, bool):
+        return 'on' if value else 'off'
+    return str(value)
+
+
+def _layers(config, winconf=None):
+    # from the lowest to the highest priority
+    layers = []
+    for conf in [config] + ([winconf] if winconf is not None else []):
+        options = conf.get('tmux_options') or {}
+        layers.append(PRESETS.get(options.get('preset'), {}))
+        layers.append(options)
+    return layers
+
+
+def _merge(layers, scope):
+    merged = {}
+    for layer in layers:
+        merged.update(layer.get(scope) or {})
+    return merged
+
+
+def session_options(config):
+    return _merge(_layers(config), 'session')
+
+
+def window_options(config, winconf):
+    """Options of the window and of each of its panes."""
+    layers = _layers(config, winconf)
+    panes = _merge(layers, 'pane')
+    own = (winconf.get('tmux_options') or {}).get('panes') or []
+    pane_options = []
+    for no in range(len(winconf['panes'])):
+        options = dict(panes)
+        if no < len(own):
+            options.update(own[no] or {})
+        pane_options.append(options)
+    return _merge(layers, 'window'), pane_options
+
+
+def session_commands(config, session_name):
+    return [['set-option', '-t', session_name, name, _value(value)]
+            for name, value in sorted(session_options(config).items())]
+
+
+def window_commands(config, winconf, pane_ids):
+    """Commands setting the options of a window, given its panes' ids."""
+    window, panes = window_options(config, winconf)
+    commands = []
+    if pane_ids:
+        # a pane is as good a target as its window
+        commands.extend(['set-option', '-w', '-t', pane_ids[0], name,
+                         _value(value)]
+                        for name, value in sorted(window.items()))
+    for pane_id, options in zip(pane_ids, panes):
+        commands.extend(['set-option', '-p', '-t', pane_id, name,
+                         _value(value)]
+                        for name, value in sorted(options.items()))
+    return commands
+
+
+def run_batched(server, commands, size=BATCH):
+    """Run ``commands`` with one tmux call per ``size`` of them."""
+    for i in range(0, len(commands), size):
+        args = []
+        for cmd in commands[i:i + size]:
+            if args:
+                args.append(';')
+            args.extend(cmd)
+        debug('tmux %s' % ' '.join(args))
+        r = server.cmd(*args)
+        if r.stderr:
+            warning('cannot set tmux options: %s' % '; '.join(r.stderr))
+
+
+def test_window_options():
+    config = {'tmux_options': {'preset': 'headless',
+                               'session': {'history-limit': 5000},
+                               'pane': {'remain-on-exit': False}}}
+    assert session_options(config)['history-limit'] == 5000
+    assert session_options(config)['status-interval'] == 0
+    winconf = {'name': 'nav', 'panes': ['a', 'b'], 'tmux_options': {
+        'window': {'monitor-activity': True},
+        'panes': [{'remain-on-exit': 'on'}]}}
+    window, panes = window_options(config, winconf)
+    assert window['monitor-activity'] is True
+    assert window['automatic-rename'] == 'off'
+    assert [p['remain-on-exit'] for p in panes] == ['on', False]
+    commands = window_commands(config, winconf, ['%1', '%2'])
+    assert ['set-option', '-p', '-t', '%2', 'remain-on-exit', 'off'] \
+        in commands
+    assert ['set-option', '-w', '-t', '%1', 'monitor-activity', 'on'] \
+        in commands
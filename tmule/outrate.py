@@ -0,0 +1,338 @@
+"""Output rates of panes and protection against floods of output.
+
+A pane printing megabytes per second makes tmux burn CPU and fills its
+scrollback. The bytes written to each pane are counted by one tmux control
+mode client (``tmux -C attach-session``, read-only and not affecting window
+sizes), which receives every pane's output as ``%output`` notifications.
+
+``output_limit`` (globally, or per window) sets the allowed ``rate`` in
+bytes per second (e.g. ``512K``) and the ``action`` taken for panes
+exceeding it:
+
+* ``warn`` logs it (and records it in the journal),
+* ``divert`` in addition copies the pane's output into a file (see
+  ``divert_path``) and clears the pane's scrollback, every ``interval``
+  for as long as the flood lasts,
+* ``throttle`` in addition stops the pane's processes (SIGSTOP) for the
+  share of each ``interval`` needed to bring their rate down to the limit.
+"""
+from __future__ import absolute_import
+
+import os
+import re
+import signal
+from logging import info, warning, debug
+from shlex import quote
+from subprocess import Popen, PIPE, DEVNULL
+from threading import Thread, Timer, Lock, Event
+from time import time
+
+from .paths import state_dir
+
+ACTIONS = ('warn', 'divert', 'throttle')
+DEFAULT_INTERVAL = 2.0
+
+
+def _output(line):
+    # pane id and (escaped) data of a control mode output notification
+    if line.startswith(b'%output '):
+        parts = line.split(b' ', 2)
+        data = parts[2] if len(parts) > 2 else b''
+    elif line.startswith(b'%extended-output '):
+        head, _, data = line.partition(b' : ')
+        parts = head.split(b' ')
+    else:
+        return None
+    return parts[1].decode('ascii'), data.rstrip(b'\n')
+
+
+def output_bytes(line):
+    """Number of bytes a control mode output notification stands for."""
+    output = _output(line)
+    if output is None:
+        return 0
+    # every non-printable byte and backslash is sent as \ooo
+    return len(output[1]) - 3 * output[1].count(b'\\')
+
+
+_ESCAPED = re.compile(br'\\([0-7]{3})')
+
+
+def unescape(data):
+    """The bytes written to a pane, from the data of a notification."""
+    return _ESCAPED.sub(lambda m: bytes([int(m.group(1), 8)]), data)
+
+
+class OutputMonitor(object):
+    """Count the bytes written to each pane of a session."""
+
+    def __init__(self, session_name):
+        self.session_name = session_name
+        self.totals = {}
+        self.proc = None
+        # pane id -> functions called with what is written to the pane
+        self.watchers = {}
+        self.attached = Event()
+        self._lock = Lock()
+        self._last = (time(), {})
+
+    def start(self):
+        from shutil import which
+        self.attached.clear()
+        self.proc = Popen([which('tmux') or 'tmux', '-C', 'attach-session',
+                           '-f', 'read-only,ignore-size',
+                           '-t', self.session_name],
+                          stdin=PIPE, stdout=PIPE, stderr=DEVNULL)
+        self._last = (time(), dict(self.totals))
+        Thread(target=self._read, args=(self.proc,), daemon=True).start()
+        debug('counting output of session %s' % self.session_name)
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def _read(self, proc):
+        totals = self.totals
+        for line in proc.stdout:
+            # the reply to attach-session comes first
+            self.attached.set()
+            output = _output(line)
+            if output is None:
+                continue
+            pane, data = output
+            n = len(data) - 3 * data.count(b'\\')
+            with self._lock:
+                totals[pane] = totals.get(pane, 0) + n
+            for watcher in self.watchers.get(pane, ()):
+                watcher(pane, unescape(data))
+
+    def watch(self, pane_ids, watcher):
+        """Call ``watcher(pane_id, data)`` with the output of the panes."""
+        with self._lock:
+            for pane in pane_ids:
+                self.watchers[pane] = self.watchers.get(pane, ()) + (watcher,)
+
+    def unwatch(self, watcher):
+        with self._lock:
+            for pane, watchers in list(self.watchers.items()):
+                watchers = tuple(w for w in watchers if w is not watcher)
+                if watchers:
+                    self.watchers[pane] = watchers
+                else:
+                    del self.watchers[pane]
+
+    def sample(self):
+        """Bytes per second of each pane since the previous sample."""
+        now = time()
+        with self._lock:
+            totals = dict(self.totals)
+        then, before = self._last
+        self._last = (now, totals)
+        dt = max(now - then, 1e-3)
+        return dict((pane, (n - before.get(pane, 0)) / dt)
+                    for pane, n in totals.items()), dt
+
+    def stop(self):
+        if self.alive():
+            try:
+                # an empty line detaches a control client
+                self.proc.stdin.write(b'\n')
+                self.proc.stdin.close()
+                self.proc.wait(1)
+            except Exception:
+                self.proc.kill()
+        self.proc = None
+
+
+def output_limit(config, winconf):
+    """The output limit of a window: (bytes per second, action, interval)
+    or None."""
+    from .admission import parse_size
+    limit = dict(config.get('output_limit') or {})
+    limit.update(winconf.get('output_limit') or {})
+    if 'rate' not in limit:
+        return None
+    return (parse_size(limit['rate']), limit.get('action', 'warn'),
+            float(limit.get('interval', DEFAULT_INTERVAL)))
+
+
+def _shortest_interval(config):
+    # the guard samples as often as the window checked most often needs
+    intervals = [float(conf['output_limit']['interval'])
+                 for conf in [config] + list(config['windows'])
+                 if 'interval' in (conf.get('output_limit') or {})]
+    return min(intervals or [DEFAULT_INTERVAL])
+
+
+def divert_path(session_name, window_name, pane_no):
+    d = os.path.join(state_dir(), 'output', session_name)
+    if not os.path.isdir(d):
+        os.makedirs(d, mode=0o700)
+    return os.path.join(d, '%s.%d.log' % (
+        window_name.replace(os.sep, '_'), pane_no))
+
+
+def _signal(pids, sig):
+    for pid in pids:
+        try:
+            os.kill(pid, sig)
+        except OSError:
+            pass
+
+
+class OutputGuard(object):
+    """Watch the output rates of a session and enforce ``output_limit``.
+
+    Rates are sampled every ``interval`` (by default the shortest one
+    configured); the limit of a pane is enforced on its rate over the
+    ``interval`` of its own window.
+    """
+
+    def __init__(self, tmux, interval=None):
+        self.tmux = tmux
+        self.interval = interval or _shortest_interval(tmux.config)
+        self.monitor = OutputMonitor(tmux.session_name)
+        self.stopped = Event()
+        # pane id -> window, pane no, rate, action taken
+        self.rates = {}
+        self._flooding = {}
+        self._paused = {}
+        self._timers = {}
+        # pane id -> [bytes, seconds] since its limit was last enforced
+        self._counted = {}
+
+    def start(self):
+        Thread(target=self._run, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        for pane, (timer, pids) in list(self._timers.items()):
+            timer.cancel()
+            _signal(pids, signal.SIGCONT)
+        for pane, action in list(self._flooding.items()):
+            if action == 'divert':
+                self.tmux.server.cmd('pipe-pane', '-t', pane)
+        self._flooding = {}
+        self.monitor.stop()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                warning('output guard failed, carrying on: %s' % e)
+
+    def _panes(self):
+        r = self.tmux.server.cmd(
+            'list-panes', '-s', '-t', self.tmux.session_name,
+            '-F', '#{pane_id} #{pane_pid} #{pane_index} #{window_name}')
+        panes = {}
+        for line in r.stdout:
+            pane, pid, index, window = line.split(' ', 3)
+            panes[pane] = (window, int(index), int(pid))
+        return panes
+
+    def check(self):
+        if not self.monitor.alive():
+            # not started yet, or the session was gone for a while
+            self.monitor.start()
+            return
+        rates, dt = self.monitor.sample()
+        panes = self._panes()
+        winconfs = dict((w['name'], w) for w in self.tmux.config['windows'])
+        current = {}
+        for pane, rate in rates.items():
+            if pane not in panes:
+                continue
+            window, index, pid = panes[pane]
+            entry = {'window': window, 'pane': index, 'rate': rate,
+                     'action': self._flooding.get(pane)}
+            current[pane] = entry
+            limit = output_limit(self.tmux.config, winconfs[window]) \
+                if window in winconfs else None
+            if limit is None:
+                continue
+            counted = self._counted.setdefault(pane, [0.0, 0.0])
+            counted[0] += rate * dt
+            counted[1] += dt
+            if counted[1] < limit[2] - self.interval / 2:
+                # its own interval is not over yet
+                continue
+            del self._counted[pane]
+            # the rate while the processes were not stopped
+            running = max(counted[1] - self._paused.pop(pane, 0), 1e-3)
+            if counted[0] / running > limit[0]:
+                entry['action'] = limit[1]
+                self._flood(pane, entry, limit, counted[0] / running,
+                            winconfs[window], pid)
+            elif pane in self._flooding:
+                entry['action'] = None
+                self._calm(pane, entry)
+        for pane in list(self._flooding):
+            if pane not in current:
+                self._calm(pane, None)
+        for pane in list(self._counted):
+            if pane not in current:
+                del self._counted[pane]
+        self.rates = current
+
+    def _flood(self, pane, entry, limit, rate, winconf, pid):
+        tmux = self.tmux
+        rate_limit, action, interval = limit
+        if pane not in self._flooding:
+            warning('window %s pane %d writes %d bytes/s (limit %d), %s' % (
+                entry['window'], entry['pane'], rate, rate_limit, action))
+            tmux.journal.record('output', 'flood', window=entry['window'],
+                                pane=entry['pane'], rate=int(rate),
+                                action=action)
+            if action == 'divert':
+                path = divert_path(tmux.session_name, entry['window'],
+                                   entry['pane'])
+                info('output of %s pane %d goes to %s' % (
+                    entry['window'], entry['pane'], path))
+                tmux.server.cmd('pipe-pane', '-O', '-t', pane,
+                                'exec cat >> %s' % quote(path))
+        self._flooding[pane] = action
+        if action == 'divert':
+            tmux.server.cmd('clear-history', '-t', pane)
+        elif action == 'throttle':
+            pids = tmux._get_children_pids(pid)
+            if tmux._is_direct(winconf):
+                pids.append(pid)
+            pause = min(0.9, 1 - float(rate_limit) / rate) * interval
+            debug('stopping %s for %.2fs' % (pids, pause))
+            _signal(pids, signal.SIGSTOP)
+            timer = Timer(pause, self._resume, args=(pane, pids))
+            self._timers[pane] = (timer, pids)
+            self._paused[pane] = pause
+            timer.start()
+
+    def _resume(self, pane, pids):
+        _signal(pids, signal.SIGCONT)
+        self._timers.pop(pane, None)
+
+    def _calm(self, pane, entry):
+        action = self._flooding.pop(pane)
+        if entry:
+            info('window %s pane %d is calm again' % (
+                entry['window'], entry['pane']))
+            self.tmux.journal.record('output', 'calm',
+                                     window=entry['window'],
+                                     pane=entry['pane'])
+        if action == 'divert':
+            # without a command, pipe-pane closes the pipe
+            self.tmux.server.cmd('pipe-pane', '-t', pane)
+
+
+def test_output_bytes():
+    assert output_bytes(b'%output %1 hello\\015\\012\n') == 7
+    assert output_bytes(b'%output %12 a\\134b') == 3
+    assert output_bytes(b'%extended-output %3 120 : abc\n') == 3
+    assert output_bytes(b'%begin 1 2 0\n') == 0
+    assert unescape(b'ready\\015\\012a\\134b') == b'ready\r\na\\b'
+    assert output_limit({'output_limit': {'rate': '1K'}},
+                        {'output_limit': {'action': 'divert'}}) == \
+        (1024, 'divert', DEFAULT_INTERVAL)
+    assert output_limit({}, {'name': 'a'}) is None
+    assert _shortest_interval({'output_limit': {'rate': '1K'}, 'windows': [
+        {'output_limit': {'interval': 0.5}}, {}]}) == 0.5
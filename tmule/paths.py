@@ -0,0 +1,96 @@
+from __future__ import absolute_import
+
+import os
+import stat
+from hashlib import sha1
+
+from .exc import TMuleException
+
+
+def runtime_dir():
+    """Per-user directory for sockets and other volatile runtime files.
+
+    It holds the daemon's socket and the scripts panes run, so it must be
+    private: one created in advance by someone else (in /tmp, anyone can)
+    is refused.
+    """
+    base = os.environ.get('XDG_RUNTIME_DIR')
+    if base:
+        d = os.path.join(base, 'tmule')
+    else:
+        d = os.path.join('/tmp', 'tmule-%d' % os.getuid())
+    os.makedirs(d, mode=0o700, exist_ok=True)
+    st = os.lstat(d)
+    if stat.S_ISLNK(st.st_mode) or not stat.S_ISDIR(st.st_mode) or \
+            st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise TMuleException(
+            'refusing to use %s: it must be a directory owned by you and '
+            'accessible to nobody else (mode 700)' % d)
+    return d
+
+
+def include_path(spec, root):
+    """The path an ``!include`` of ``spec`` in directory ``root`` refers to
+    (still a glob pattern if ``spec`` is one)."""
+    filename = os.path.expanduser(os.path.expandvars(spec))
+    return os.path.abspath(os.path.join(root, filename))
+
+
+def config_key(configfile, session_name=None):
+    """Short stable key identifying a (config file, session) pair."""
+    key = '%s\0%s' % (os.path.abspath(configfile), session_name or '')
+    return sha1(key.encode('utf-8')).hexdigest()[:12]
+
+
+def socket_path(configfile, session_name=None):
+    return os.path.join(
+        runtime_dir(), '%s.sock' % config_key(configfile, session_name))
+
+
+def state_dir():
+    """Per-user directory for state that has to survive a reboot."""
+    base = os.environ.get('XDG_STATE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.local', 'state')
+    d = os.path.join(base, 'tmule')
+    if not os.path.isdir(d):
+        os.makedirs(d, mode=0o700)
+    return d
+
+
+def cache_dir():
+    """Per-user directory for data that can be recomputed at any time."""
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    d = os.path.join(base, 'tmule')
+    if not os.path.isdir(d):
+        os.makedirs(d, mode=0o700)
+    return d
+
+
+def test_runtime_dir():
+    import tempfile
+    base = tempfile.mkdtemp()
+    old = os.environ.get('XDG_RUNTIME_DIR')
+    os.environ['XDG_RUNTIME_DIR'] = base
+    try:
+        assert runtime_dir() == os.path.join(base, 'tmule')
+        os.chmod(os.path.join(base, 'tmule'), 0o777)
+        try:
+            runtime_dir()
+            assert False, 'directory accessible to others accepted'
+        except TMuleException:
+            pass
+        os.rmdir(os.path.join(base, 'tmule'))
+        os.symlink(base, os.path.join(base, 'tmule'))
+        try:
+            runtime_dir()
+            assert False, 'symbolic link accepted'
+        except TMuleException:
+            pass
+    finally:
+        if old is None:
+            del os.environ['XDG_RUNTIME_DIR']
+        else:
+            os.environ['XDG_RUNTIME_DIR'] = old
+        import shutil
+        shutil.rmtree(base)
@@ -0,0 +1,321 @@
+"""Launch plans: what a launch, stop or relaunch is going to do.
+
+A plan is compiled from the configuration, the selected tags/windows and
+the action, and consists of stages that run one after the other; the steps
+of a stage may run in parallel. Plans are plain data (``to_dict``), so
+they can be printed (``--dry-run``) and cached: as the compilation only
+depends on the compiled configuration, a plan is cached under a key
+derived from the config hash and the selection.
+"""
+from __future__ import absolute_import
+
+import json
+import os
+from hashlib import sha1
+from logging import debug, warning
+
+from .paths import cache_dir
+
+ACTIONS = ('launch', 'stop', 'relaunch')
+
+# bump whenever the layout of plans changes
+PLAN_VERSION = 2
+
+
+def select_windows(config, tags=(), windows=None, untagged=False):
+    """Names of the windows an action applies to, in configuration order.
+
+    An explicit selection of ``windows`` overrides skip flags and tags.
+    With ``untagged``, windows without ``tags`` are selected whatever the
+    ``tags`` (as ``stop -t`` has always done).
+    """
+    selected = []
+    for winconf in config['windows']:
+        if windows:
+            if winconf['name'] in windows:
+                selected.append(winconf['name'])
+            continue
+        if winconf.get('skip', False):
+            continue
+        if tags and ('tags' in winconf or not untagged) and \
+                not set(winconf.get('tags', [])).intersection(tags):
+            continue
+        selected.append(winconf['name'])
+    return selected
+
+
+class Plan(object):
+
+    def __init__(self, action, session_name, config_hash, stages=None):
+        self.action = action
+        self.session_name = session_name
+        self.config_hash = config_hash
+        # list of lists of steps (dicts)
+        self.stages = stages or []
+
+    def steps(self):
+        return [step for stage in self.stages for step in stage]
+
+    def to_dict(self):
+        return {
+            'version': PLAN_VERSION,
+            'action': self.action,
+            'session': self.session_name,
+            'config_hash': self.config_hash,
+            'stages': self.stages
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['action'], d['session'], d['config_hash'], d['stages'])
+
+    def format(self):
+        lines = ['%s plan for session %s (config %s):' % (
+            self.action, self.session_name, self.config_hash[:8])]
+        for no, stage in enumerate(self.stages, 1):
+            for i, step in enumerate(stage):
+                what = ['%s %s (%d panes)' % (
+                    step['op'], step['window'], step['panes'])]
+                if step.get('wait'):
+                    what.append('wait %gs' % step['wait'])
+                for pane, regex in step.get('ready_when') or []:
+                    what.append('pane %d prints %r' % (pane, regex))
+                if step.get('check'):
+                    what.append('check %r within %gs' % (
+                        step['check'], step['timeout']))
+                lines.append('%4s %s' % ('%d.' % no if i == 0 else '',
+                                         ', '.join(what)))
+        if not self.stages:
+            lines.append('     nothing to do')
+        return '\n'.join(lines)
+
+
+class Outcome(object):
+    """What executing a plan did to each window.
+
+    Window states are ``ready`` (launched, check passed), ``stopped``,
+    ``failed`` (check did not pass), ``cancelled`` (its launch was cut short
+    by the failure of another window), ``skipped`` (not launched because of
+    a failure) and ``rolled back``. ``result`` is ``ok``, ``failed`` (with
+    ``continue``), ``aborted`` or ``rolled back``.
+    """
+
+    def __init__(self, plan, on_failure='abort'):
+        self.action = plan.action
+        self.session_name = plan.session_name
+        self.config_hash = plan.config_hash
+        self.on_failure = on_failure
+        self.windows = {}
+        self.result = 'ok'
+
+    @property
+    def ok(self):
+        return self.result == 'ok'
+
+    def __bool__(self):
+        return self.ok
+
+    __nonzero__ = __bool__
+
+    def failed(self):
+        return [w for w, state in self.windows.items() if state == 'failed']
+
+    def to_dict(self):
+        return {
+            'action': self.action,
+            'session': self.session_name,
+            'config_hash': self.config_hash,
+            'on_failure': self.on_failure,
+            'result': self.result,
+            'failed': self.failed(),
+            'windows': self.windows
+        }
+
+    def summary(self):
+        lines = ['%s of session %s: %s' % (
+            self.action, self.session_name, self.result)]
+        for state in ('failed', 'cancelled', 'skipped', 'rolled back'):
+            names = [w for w, s in self.windows.items() if s == state]
+            if names:
+                lines.append('  %s: %s' % (state, ', '.join(names)))
+        return '\n'.join(lines)
+
+
+def _ancestors(winconfs):
+    """Window name -> all windows it depends on, directly or not."""
+    result = {}
+
+    def ancestors(name):
+        if name not in result:
+            deps = set(winconfs[name].get('depends') or [])
+            for dep in list(deps):
+                deps |= ancestors(dep)
+            result[name] = deps
+        return result[name]
+
+    for name in winconfs:
+        ancestors(name)
+    return result
+
+
+def rolling_batches(names, winconfs, size):
+    """Split ``names`` (in dependency order) into batches of up to ``size``.
+
+    A window never shares a batch with a window it depends on, so that
+    each batch only starts once everything it needs is up again.
+    """
+    ancestors = _ancestors(winconfs)
+    batches = []
+    for name in names:
+        if (batches and len(batches[-1]) < size and
+                not ancestors[name].intersection(batches[-1])):
+            batches[-1].append(name)
+        else:
+            batches.append([name])
+    return batches
+
+
+def compile_plan(config, config_hash, session_name, action, tags=(),
+                 windows=None, sleep_sec=0.0, check_timeout=136.0, batch=1):
+    """Compile the plan of ``action`` on the selected windows.
+
+    A launch or relaunch starts ``batch`` windows at a time.
+    """
+    names = select_windows(config, tags, windows,
+                           untagged=action == 'stop')
+    winconfs = dict((w['name'], w) for w in config['windows'])
+    if action == 'stop':
+        # the reverse of the launch order
+        names = names[::-1]
+    if action != 'stop':
+        batches = rolling_batches(names, winconfs, max(1, batch))
+    else:
+        batches = [[name] for name in names]
+    return Plan(action, session_name, config_hash, [
+        [_step(action, winconfs[name], config, sleep_sec, check_timeout)
+         for name in stage]
+        for stage in batches])
+
+
+def _step(action, winconf, config, sleep_sec, check_timeout):
+    from .ready import ready_conditions
+    step = {
+        'op': action,
+        'window': winconf['name'],
+        'panes': len(winconf['panes'])
+    }
+    if action != 'stop':
+        # with a throttle, admission replaces the global delay
+        wait = 0 if 'throttle' in config else sleep_sec
+        step['wait'] = float(winconf.get('wait', wait))
+        step['check'] = winconf.get('check')
+        step['ready_when'] = ready_conditions(winconf)
+        step['timeout'] = check_timeout
+        step['cost'] = winconf.get('cost')
+    return step
+
+
+class PlanCache(object):
+    """Compiled plans as JSON files, keyed by config hash and selection.
+
+    Only the ``keep`` plans used most recently are kept.
+    """
+
+    def __init__(self, keep=64):
+        self.keep = keep
+
+    def path(self, *key):
+        h = sha1(json.dumps(key, sort_keys=True).encode('utf-8'))
+        return os.path.join(cache_dir(), 'plan-%s.json' % h.hexdigest()[:16])
+
+    def get(self, config, config_hash, session_name, action, tags=(),
+            windows=None, **kwargs):
+        path = self.path(config_hash, session_name, action, sorted(tags),
+                         sorted(windows or []), kwargs)
+        try:
+            with open(path) as f:
+                d = json.load(f)
+            if d.get('version') == PLAN_VERSION:
+                debug('using cached plan %s' % path)
+                # used recently, so kept when pruning
+                os.utime(path)
+                return Plan.from_dict(d)
+        except (IOError, OSError, ValueError):
+            pass
+        plan = compile_plan(config, config_hash, session_name, action, tags,
+                            windows, **kwargs)
+        try:
+            tmp = '%s.%d.tmp' % (path, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(plan.to_dict(), f)
+            os.replace(tmp, path)
+        except (IOError, OSError) as e:
+            warning('could not cache plan: %s' % e)
+        self.prune()
+        return plan
+
+    def prune(self):
+        """Remove all but the ``keep`` plans used most recently."""
+        d = cache_dir()
+        plans = []
+        for name in os.listdir(d):
+            if name.startswith('plan-') and name.endswith('.json'):
+                try:
+                    plans.append((os.stat(os.path.join(d, name)).st_mtime,
+                                  name))
+                except OSError:
+                    pass
+        for _, name in sorted(plans, reverse=True)[self.keep:]:
+            try:
+                os.remove(os.path.join(d, name))
+            except OSError:
+                pass
+
+
+def test_compile_plan():
+    config = {'windows': [
+        {'name': 'core', 'panes': ['roscore'], 'check': 'rostopic list'},
+        {'name': 'nav', 'panes': ['a', 'b'], 'tags': ['robot'], 'wait': 2},
+        {'name': 'dev', 'panes': ['c'], 'skip': True},
+    ]}
+    plan = compile_plan(config, '0' * 40, 's', 'launch', sleep_sec=1)
+    assert [s['window'] for s in plan.steps()] == ['core', 'nav']
+    assert plan.steps()[0]['wait'] == 1 and plan.steps()[1]['wait'] == 2
+    plan = compile_plan(config, '0' * 40, 's', 'launch', tags={'robot'})
+    assert [s['window'] for s in plan.steps()] == ['nav']
+    # stopping by tag stops the windows without tags as well
+    plan = compile_plan(config, '0' * 40, 's', 'stop', tags={'robot'})
+    assert [s['window'] for s in plan.steps()] == ['nav', 'core']
+    plan = compile_plan(config, '0' * 40, 's', 'relaunch',
+                        windows={'dev', 'core'})
+    assert [s['window'] for s in plan.steps()] == ['core', 'dev']
+    config['windows'][1]['depends'] = ['core']
+    plan = compile_plan(config, '0' * 40, 's', 'relaunch', batch=2,
+                        windows={'dev', 'core', 'nav'})
+    assert [[s['window'] for s in stage] for stage in plan.stages] == [
+        ['core'], ['nav', 'dev']]
+    assert Plan.from_dict(json.loads(json.dumps(
+        plan.to_dict()))).to_dict() == plan.to_dict()
+    outcome = Outcome(plan, 'rollback')
+    outcome.windows.update(core='failed', nav='rolled back', dev='skipped')
+    outcome.result = 'rolled back'
+    assert not outcome and outcome.failed() == ['core']
+
+
+def test_plan_cache():
+    import tempfile
+    saved = os.environ.get('XDG_CACHE_HOME')
+    os.environ['XDG_CACHE_HOME'] = tempfile.mkdtemp()
+    try:
+        config = {'windows': [{'name': 'a', 'panes': ['ls']}]}
+        cache = PlanCache(keep=2)
+        for action in ('launch', 'stop', 'relaunch'):
+            plan = cache.get(config, '0' * 40, 's', action)
+        assert len(os.listdir(cache_dir())) == 2
+        assert cache.get(config, '0' * 40, 's', 'relaunch').to_dict() == \
+            plan.to_dict()
+    finally:
+        if saved is None:
+            del os.environ['XDG_CACHE_HOME']
+        else:
+            os.environ['XDG_CACHE_HOME'] = saved
@@ -0,0 +1,114 @@
+"""Several TMuLE projects (configs, each with its own session) in one process.
+
+All projects share one libtmux server connection, one snapshot of the
+process table and one cache of window states, so that a single web server
+can control a number of stacks without duplicating that work per project.
+"""
+from __future__ import absolute_import
+
+from threading import Lock
+from time import time
+
+from .exc import ConfigError
+
+
+class ProcessSnapshot(object):
+    """Parent -> children map of all processes, taken at most every ``ttl``
+    seconds, instead of walking the process tree for every window."""
+
+    def __init__(self, ttl=1.0):
+        self.ttl = ttl
+        self._taken = 0
+        self._children = {}
+        self._lock = Lock()
+
+    def invalidate(self):
+        self._taken = 0
+
+    def _refresh(self):
+        import psutil
+        children = {}
+        for p in psutil.process_iter(['pid', 'ppid']):
+            children.setdefault(p.info['ppid'], []).append(p.info['pid'])
+        self._children = children
+        self._taken = time()
+
+    def children(self, pid):
+        """All (recursive) children of ``pid``."""
+        with self._lock:
+            if time() - self._taken > self.ttl:
+                self._refresh()
+            children = self._children
+        result = []
+        todo = list(children.get(pid, []))
+        while todo:
+            p = todo.pop()
+            result.append(p)
+            todo.extend(children.get(p, []))
+        return result
+
+
+class Projects(object):
+    """The TMux instances served together, keyed by session name."""
+
+    def __init__(self, tmuxes, ttl=2.0):
+        self.projects = {}
+        for tmux in tmuxes:
+            other = self.projects.get(tmux.session_name)
+            if other:
+                raise ConfigError([(None, 'session %s is used by both %s '
+                                    'and %s' % (tmux.session_name,
+                                                other.configfile,
+                                                tmux.configfile))])
+            self.projects[tmux.session_name] = tmux
+        self.ttl = ttl
+        self.snapshot = ProcessSnapshot()
+        # (session, window) -> (timestamp, running)
+        self.status_cache = {}
+        self.server = None
+
+    @classmethod
+    def load(cls, configfiles, sleep_sec=0.0):
+        from .tmule import TMux
+        return cls([TMux(configfile=c, sleep_sec=sleep_sec)
+                    for c in configfiles])
+
+    def names(self):
+        return list(self.projects)
+
+    def __getitem__(self, name):
+        return self.projects[name]
+
+    def init(self, name=None):
+        """(Re-)initialise one or all projects on the shared tmux server."""
+        if self.server is None:
+            from libtmux import Server
+            self.server = Server()
+        for n in [name] if name else self.names():
+            tmux = self.projects[n]
+            tmux.snapshot = self.snapshot
+            tmux.init(server=self.server)
+
+    def invalidate(self, name):
+        """Forget what is known about ``name``, after it was changed."""
+        self.snapshot.invalidate()
+        for key in list(self.status_cache):
+            if key[0] == name:
+                del self.status_cache[key]
+
+    def status(self, name):
+        """Running state of all windows of project ``name`` (cached)."""
+        tmux = self.projects[name]
+        now = time()
+        result = {}
+        for window in tmux.list_windows():
+            entry = self.status_cache.get((name, window))
+            if entry is None or now - entry[0] > self.ttl:
+                entry = (now, tmux.is_running(window))
+                self.status_cache[(name, window)] = entry
+            result[window] = entry[1]
+        return result
+
+    def kill_all(self):
+        for tmux in self.projects.values():
+            tmux.kill_all_windows()
@@ -0,0 +1,161 @@
+"""Readiness of windows from what their panes print.
+
+``ready_when`` of a window, ``{pane: 0, regex: 'odom ready'}`` or a list of
+such conditions, makes a launch wait until every regex has matched the
+output of its pane (pane 0 if not given) after the launch, instead of
+guessing a ``wait`` or polling a ``check`` (which, if given as well, is
+only run once the output matched). Panes are numbered by their place in
+``panes``, from 0, whatever tmux's ``pane-base-index``.
+
+The output is streamed, as it is written, by the tmux control mode client
+of the session (see :class:`tmule.outrate.OutputMonitor`): no process is
+started per check. Each regex of a pane is searched in each line as soon
+as it is complete, lines split between chunks of output included (up to
+``LOOKBACK`` characters). The echo of the
+commands typed into a pane (with ``launch_mode: keys``) does not count.
+"""
+from __future__ import absolute_import
+
+import re
+from logging import info, debug
+from threading import Event
+
+# characters of earlier output searched together with new output
+LOOKBACK = 4096
+
+# escape sequences (like colours) and carriage returns (terminals break
+# long lines with them) are not part of the text of a line
+_CONTROL = re.compile('\x1b\\[[0-?]*[ -/]*[@-~]|\r')
+
+
+def ready_conditions(winconf):
+    """The ``ready_when`` of a window, as a list of (pane, regex)."""
+    conditions = winconf.get('ready_when') or []
+    if isinstance(conditions, dict):
+        conditions = [conditions]
+    return [(int(c.get('pane', 0)), c['regex']) for c in conditions]
+
+
+def compile_regex(regex):
+    """The regex of a ``ready_when`` as searched in each line of output."""
+    return re.compile(regex)
+
+
+class StreamMatcher(object):
+    """Search the lines of a stream of text for several regexes.
+
+    Each regex not matched yet is searched on its own in every line, so
+    that regexes matching the same text all match. Lines containing one of
+    ``ignore`` (like the echo of a command typed into a shell) do not
+    count.
+    """
+
+    def __init__(self, patterns, ignore=(), lookback=LOOKBACK):
+        self.patterns = list(patterns)
+        self.ignore = [i for i in ignore if i]
+        self.lookback = lookback
+        self.matched = set()
+        # the last line, not complete yet
+        self.partial = ''
+        self.regexes = [compile_regex(p) for p in self.patterns]
+
+    def done(self):
+        return len(self.matched) == len(self.patterns)
+
+    def feed(self, text):
+        """Search the lines completed by ``text``; returns the indices of
+        the patterns matching for the first time."""
+        if self.done():
+            return set()
+        buf = self.partial + text
+        end = buf.rfind('\n') + 1
+        lines, self.partial = buf[:end], buf[end:][-self.lookback:]
+        new = set()
+        for line in _CONTROL.sub('', lines).splitlines():
+            if any(i in line for i in self.ignore):
+                continue
+            for i, regex in enumerate(self.regexes):
+                if i not in self.matched and i not in new and \
+                        regex.search(line):
+                    new.add(i)
+        self.matched |= new
+        return new
+
+
+class ReadyWatch(object):
+    """Wait for the ``ready_when`` conditions of a window to match."""
+
+    def __init__(self, window_name, conditions, pane_ids, typed=None):
+        self.window_name = window_name
+        typed = typed or {}
+        # pane id -> matcher of its regexes
+        self.matchers = {}
+        for pane_no in sorted(set(p for p, _ in conditions)):
+            if pane_no not in pane_ids:
+                raise ValueError('window %s has no pane %d for ready_when' % (
+                    window_name, pane_no))
+            self.matchers[pane_ids[pane_no]] = StreamMatcher(
+                [regex for p, regex in conditions if p == pane_no],
+                [line.strip() for line in typed.get(pane_no, [])])
+        self.ready = Event()
+        self._notify = None
+        # called with all output before it is matched (to record it)
+        self.tap = None
+
+    def pane_ids(self):
+        return list(self.matchers)
+
+    def __call__(self, pane_id, data):
+        # called by the reader of the control mode client
+        if self.tap is not None:
+            self.tap(pane_id, data)
+        matcher = self.matchers[pane_id]
+        for i in matcher.feed(data.decode('utf-8', 'replace')):
+            debug('%s matched %r' % (self.window_name, matcher.patterns[i]))
+        if not self.ready.is_set() and all(
+                m.done() for m in self.matchers.values()):
+            info('%s is ready' % self.window_name)
+            self.ready.set()
+            if self._notify:
+                self._notify()
+
+    async def wait(self, timeout):
+        """Whether the output matched within ``timeout`` seconds."""
+        import asyncio
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        # set before looking, so that a match in between is not missed
+        self._notify = lambda: loop.call_soon_threadsafe(event.set)
+        if self.ready.is_set():
+            return True
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+def test_stream_matcher():
+    assert ready_conditions({'ready_when': {'regex': 'up'}}) == [(0, 'up')]
+    matcher = StreamMatcher(['odom ready', r'^Listening on \d+'],
+                            ['echo odom ready'])
+    assert matcher.feed('$ echo odom ready\r\nodom re') == set()
+    # across chunks
+    assert matcher.feed('ady\r\n') == {0}
+    assert matcher.feed('odom ready\r\nListening on 80') == set()
+    assert matcher.feed('80\r\n') == {1}
+    assert matcher.done() and matcher.feed('odom ready\n') == set()
+    matcher = StreamMatcher([r'^Listening on \d+'])
+    assert matcher.feed('\x1b[?2004l\rListening on 8080\x1b[0m\r\n') == {0}
+    # overlapping regexes all match the same line
+    matcher = StreamMatcher(['odom', 'odom ready'])
+    assert matcher.feed('odom ready\n') == {0, 1} and matcher.done()
+    # inline flags and backreferences work as in a regex of their own
+    matcher = StreamMatcher(['(?i)READY', r'(a)\1$'])
+    assert matcher.feed('ready\nxaa\n') == {0, 1}
+    watch = ReadyWatch('nav', [(0, 'a+b'), (1, 'c')], {0: '%1', 1: '%2'})
+    watch('%1', b'xaa')
+    watch('%2', b'c\n')
+    assert not watch.ready.is_set()
+    watch('%1', b'b\n')
+    assert watch.ready.is_set()
@@ -0,0 +1,127 @@
+"""CPU affinity, niceness, I/O priority and cgroup placement of windows.
+
+Settings are applied to the pane processes of a window and all their
+children at launch; as children inherit them, everything started later in
+the pane gets them as well. The tmuled process watcher re-applies them to
+processes that appeared since, catching programs that change their own
+scheduling.
+"""
+from __future__ import absolute_import
+
+import os
+from logging import debug, warning
+
+SCHED_KEYS = ('cpu_affinity', 'nice', 'ionice', 'cgroup')
+
+IONICE_CLASSES = ('realtime', 'best-effort', 'idle')
+
+DEFAULT_CGROUP_ROOT = '/sys/fs/cgroup/tmule'
+
+
+def has_sched(winconf):
+    return any(k in winconf for k in SCHED_KEYS)
+
+
+def parse_cpus(cpus):
+    """Turn 3, "0-3,6" or [0, 1] into a sorted list of CPU numbers."""
+    if isinstance(cpus, int):
+        return [cpus]
+    if isinstance(cpus, list):
+        return sorted(int(c) for c in cpus)
+    result = set()
+    for part in str(cpus).split(','):
+        part = part.strip()
+        if '-' in part:
+            lo, hi = part.split('-', 1)
+            result.update(range(int(lo), int(hi) + 1))
+        elif part:
+            result.add(int(part))
+    return sorted(result)
+
+
+def _ionice_args(ionice):
+    import psutil
+    if isinstance(ionice, dict):
+        cls, value = ionice.get('class', 'best-effort'), ionice.get('value')
+    else:
+        cls, value = ionice, None
+    ioclass = {
+        'realtime': psutil.IOPRIO_CLASS_RT,
+        'best-effort': psutil.IOPRIO_CLASS_BE,
+        'idle': psutil.IOPRIO_CLASS_IDLE,
+    }[cls]
+    if cls == 'idle':
+        value = None
+    elif value is None:
+        value = 4
+    return ioclass, value
+
+
+def cgroup_path(root, session_name, window_name):
+    return os.path.join(root, session_name, window_name.replace(os.sep, '_'))
+
+
+def _write(path, value):
+    with open(path, 'w') as f:
+        f.write(str(value))
+
+
+def ensure_cgroup(root, path, limits):
+    """Create the cgroup v2 ``path`` below ``root`` and set its ``limits``."""
+    from .admission import parse_size
+    controllers = sorted(set(k.split('.')[0] for k in limits))
+    for d in [root, os.path.dirname(path), path]:
+        if not os.path.isdir(d):
+            os.mkdir(d)
+    # the controllers have to be enabled on every level above the window
+    for d in [os.path.dirname(root), root, os.path.dirname(path)]:
+        for c in controllers:
+            try:
+                _write(os.path.join(d, 'cgroup.subtree_control'), '+' + c)
+            except (IOError, OSError) as e:
+                debug('cannot enable %s in %s: %s' % (c, d, e))
+    for key, value in limits.items():
+        if key.startswith('memory.') and value != 'max':
+            value = parse_size(value)
+        _write(os.path.join(path, key), value)
+
+
+def apply(pids, winconf, session_name, cgroup_root=None):
+    """Apply the scheduling settings of ``winconf`` to ``pids``."""
+    import psutil
+    cpus = parse_cpus(winconf['cpu_affinity']) \
+        if 'cpu_affinity' in winconf else None
+    ionice = _ionice_args(winconf['ionice']) if 'ionice' in winconf else None
+    if 'cgroup' in winconf:
+        cgroup_root = cgroup_root or DEFAULT_CGROUP_ROOT
+        path = cgroup_path(cgroup_root, session_name, winconf['name'])
+        try:
+            ensure_cgroup(cgroup_root, path, winconf['cgroup'])
+        except (IOError, OSError) as e:
+            warning('cannot set up cgroup %s for %s: %s'
+                    % (path, winconf['name'], e))
+            path = None
+    else:
+        path = None
+    for pid in pids:
+        try:
+            p = psutil.Process(pid)
+            if cpus is not None:
+                p.cpu_affinity(cpus)
+            if 'nice' in winconf:
+                p.nice(winconf['nice'])
+            if ionice is not None:
+                p.ionice(*ionice)
+            if path:
+                _write(os.path.join(path, 'cgroup.procs'), pid)
+        except psutil.NoSuchProcess:
+            pass
+        except (psutil.AccessDenied, IOError, OSError) as e:
+            warning('cannot apply scheduling of %s to pid %d: %s'
+                    % (winconf['name'], pid, e))
+
+
+def test_parse_cpus():
+    assert parse_cpus('0-3,6') == [0, 1, 2, 3, 6]
+    assert parse_cpus([2, 1]) == [1, 2]
+    assert parse_cpus(5) == [5]
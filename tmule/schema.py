@@ -0,0 +1,541 @@
+"""Validation of TMuLE configurations.
+
+Runs once when a configuration is compiled (see :mod:`tmule.cache`) and
+reports all problems found, each with the file and line it stems from.
+"""
+from __future__ import absolute_import
+
+import shlex
+from logging import warning
+
+from .exc import ConfigError
+
+_STRING = (str,)
+_NUMBER = (int, float)
+
+# allowed keys and their types
+CONFIG_KEYS = {
+    'session': _STRING,
+    'init_cmd': _STRING,
+    # 'keys' (type commands into a shell) or 'direct' (see tmule.spawn)
+    'launch_mode': _STRING,
+    # evaluate init_cmd once and reuse its environment (see tmule.envcache)
+    'env_cache': (bool,),
+    # admission control of launches (see tmule.admission)
+    'throttle': (dict,),
+    # where windows' cgroups are created (see tmule.sched)
+    'cgroup_root': _STRING,
+    # options of the session, windows and panes (see tmule.options)
+    'tmux_options': (dict,),
+    # output rate limit of panes (see tmule.outrate)
+    'output_limit': (dict,),
+    # commands or URLs called on events (see tmule.hooks)
+    'hooks': (dict,),
+    # what happens when a window fails its check (see TMux.execute)
+    'on_failure': _STRING,
+    # environment and directory of all panes (see tmule.context)
+    'env': (dict,),
+    'cwd': _STRING,
+    'windows': (list,),
+    # if given, windows may only use these tags
+    'tags': (list,),
+}
+
+WINDOW_KEYS = {
+    'name': _STRING,
+    'panes': (list,),
+    'tags': (list,),
+    'skip': (bool,),
+    'wait': _NUMBER,
+    'check': _STRING,
+    # output of panes showing the window is up (see tmule.ready)
+    'ready_when': (dict, list),
+    'env': (dict,),
+    'cwd': _STRING,
+    'launch_mode': _STRING,
+    # names of windows that have to be launched before this one
+    'depends': (list,),
+    # one window per item/combination (see tmule.expand); already expanded
+    # when the configuration is validated
+    'foreach': (list,),
+    'matrix': (dict,),
+    # resources the window needs, e.g. {cpu: 2, mem: 1G}
+    'cost': (dict,),
+    # scheduling of the window's processes (see tmule.sched)
+    'cpu_affinity': (list, str, int),
+    'nice': (int,),
+    'ionice': (str, dict),
+    'cgroup': (dict,),
+    'tmux_options': (dict,),
+    'output_limit': (dict,),
+    'hooks': (dict,),
+}
+
+OUTPUT_LIMIT_KEYS = {
+    'rate': _STRING + _NUMBER,
+    'action': _STRING,
+    'interval': _NUMBER,
+}
+
+# a pane given as a mapping instead of its command
+PANE_KEYS = {
+    'cmd': _STRING,
+    'env': (dict,),
+    'cwd': _STRING,
+}
+
+READY_KEYS = {
+    'pane': (int,),
+    'regex': _STRING,
+}
+
+THROTTLE_KEYS = {
+    'max_cpu': _NUMBER,
+    'min_free_mem': _STRING + _NUMBER,
+    'settle': _NUMBER,
+    'timeout': _NUMBER,
+    'default_cost': (dict,),
+}
+
+COST_KEYS = {
+    'cpu': _NUMBER,
+    'mem': _STRING + _NUMBER,
+}
+
+_TYPE_NAMES = {
+    _STRING: 'a string', _NUMBER: 'a number', (list,): 'a list',
+    _STRING + _NUMBER: 'a size (like 512M or 1G)',
+    (bool,): 'true or false', (dict,): 'a mapping', (int,): 'an integer',
+    (list, str, int): 'a CPU list (like [0, 1] or "0-3,6")',
+    (str, dict): 'an I/O class or a mapping with class and value',
+    (dict, list): 'a mapping or a list of mappings',
+}
+
+
+def _where(container, key=None):
+    where = getattr(container, 'where', None)
+    return where(key) if where else None
+
+
+def _check_keys(conf, allowed, what, errors):
+    for key in conf:
+        if key not in allowed:
+            if not str(key).startswith('_'):
+                errors.append((_where(conf, key),
+                               'unknown key "%s" in %s' % (key, what)))
+        elif not isinstance(conf[key], allowed[key]) or (
+                allowed[key] == _NUMBER and isinstance(conf[key], bool)):
+            errors.append((_where(conf, key), '"%s" in %s must be %s' % (
+                key, what, _TYPE_NAMES[allowed[key]])))
+
+
+def _check_strings(items, what, errors):
+    for i, item in enumerate(items):
+        if not isinstance(item, str):
+            errors.append((_where(items, i), '%s must be strings' % what))
+
+
+def _check_env(env, what, errors):
+    import re
+    for name, value in env.items():
+        if not isinstance(name, str) or not re.match(
+                r'^[A-Za-z_][A-Za-z0-9_]*$', name):
+            errors.append((_where(env, name), 'bad variable name "%s" in env '
+                           'of %s' % (name, what)))
+        elif not isinstance(value, _STRING + _NUMBER + (bool,)):
+            errors.append((_where(env, name), 'variable "%s" in env of %s '
+                           'must be a single value' % (name, what)))
+
+
+def _check_pane(panes, p, what, errors):
+    pane = panes[p]
+    if isinstance(pane, str):
+        _check_command(pane, _where(panes, p))
+        return
+    if not isinstance(pane, dict) or not isinstance(pane.get('cmd'), str):
+        errors.append((_where(panes, p), 'panes of %s must be commands or '
+                       'mappings with a "cmd"' % what))
+        return
+    what = 'pane %d of %s' % (p, what)
+    _check_keys(pane, PANE_KEYS, what, errors)
+    _check_command(pane['cmd'], _where(pane, 'cmd'))
+    if isinstance(pane.get('env'), dict):
+        _check_env(pane['env'], what, errors)
+
+
+def _check_command(cmd, location):
+    # a cheap syntax check catching unbalanced quotes, which otherwise only
+    # show as a shell waiting for more input in the pane; shlex does not know
+    # all of bash (like $'...' quoting), so this is only a warning, and here
+    # documents are skipped
+    if '<<' in cmd:
+        return
+    try:
+        shlex.split(cmd, comments=True)
+    except ValueError as e:
+        _warn(location, 'command may be malformed (%s): %s' % (
+            str(e).lower(), cmd.strip().split('\n')[0]))
+
+
+def _coerce_legacy(win, what):
+    # strings were accepted for wait and skip before they were validated:
+    # they are still taken as before, with a warning
+    wait = win.get('wait')
+    if isinstance(wait, str):
+        try:
+            win['wait'] = float(wait)
+        except ValueError:
+            return
+        _warn(_where(win, 'wait'), '"wait" in %s should be a number, not '
+              'the string %r' % (what, wait))
+    skip = win.get('skip')
+    if 'skip' in win and not isinstance(skip, bool):
+        win['skip'] = bool(skip)
+        _warn(_where(win, 'skip'), '"skip" in %s should be true or false, '
+              'taking %r as %s' % (what, skip, str(win['skip']).lower()))
+
+
+def _warn(location, message):
+    warning('%s:%d:%d: %s' % (location + (message,))
+            if location else message)
+
+
+LAUNCH_MODES = ('keys', 'direct')
+FAILURE_MODES = ('abort', 'continue', 'rollback')
+
+
+def _check_size(conf, key, what, errors):
+    from .admission import parse_size
+    try:
+        parse_size(conf[key])
+    except ValueError:
+        errors.append((_where(conf, key), '"%s" in %s must be %s' % (
+            key, what, _TYPE_NAMES[_STRING + _NUMBER])))
+
+
+def _check_sched(win, what, errors):
+    from .sched import parse_cpus, IONICE_CLASSES
+    if isinstance(win.get('cpu_affinity'), (list, str, int)):
+        try:
+            parse_cpus(win['cpu_affinity'])
+        except (TypeError, ValueError):
+            errors.append((_where(win, 'cpu_affinity'), '"cpu_affinity" in %s '
+                           'must be %s' % (what, _TYPE_NAMES[(list, str, int)])))
+    ionice = win.get('ionice')
+    if isinstance(ionice, dict):
+        ionice = ionice.get('class', 'best-effort')
+    if isinstance(ionice, str) and ionice not in IONICE_CLASSES:
+        errors.append((_where(win, 'ionice'), 'ionice class of %s must be one '
+                       'of %s' % (what, ', '.join(IONICE_CLASSES))))
+    if isinstance(win.get('cgroup'), dict):
+        for key in win['cgroup']:
+            if '.' not in str(key):
+                errors.append((_where(win['cgroup'], key), 'cgroup of %s: '
+                               '"%s" is not a cgroup file like cpu.max'
+                               % (what, key)))
+
+
+def _check_tmux_options(options, scopes, what, errors):
+    from .options import PRESETS
+    what = 'tmux_options of %s' % what
+    if 'preset' in options and not (isinstance(options['preset'], str) and
+                                    options['preset'] in PRESETS):
+        errors.append((_where(options, 'preset'), 'preset of %s must be one '
+                       'of %s' % (what, ', '.join(sorted(PRESETS)))))
+    for key, value in options.items():
+        if key == 'preset':
+            continue
+        if key not in scopes:
+            errors.append((_where(options, key), 'unknown scope "%s" in %s, '
+                           'must be one of %s' % (key, what,
+                                                  ', '.join(scopes))))
+            continue
+        values = value if key == 'panes' else [value]
+        if not isinstance(value, (list if key == 'panes' else dict)) or \
+                not all(isinstance(v, dict) for v in values):
+            errors.append((_where(options, key), '"%s" in %s must be %s' % (
+                key, what, 'a list of mappings' if key == 'panes'
+                else _TYPE_NAMES[(dict,)])))
+            continue
+        for v in values:
+            for name, option in v.items():
+                if isinstance(option, (dict, list)) or option is None:
+                    errors.append((_where(v, name), 'tmux option "%s" in %s '
+                                   'must be a single value' % (name, what)))
+
+
+def _check_output_limit(limit, what, errors):
+    from .outrate import ACTIONS
+    _check_keys(limit, OUTPUT_LIMIT_KEYS, 'output_limit of %s' % what, errors)
+    if isinstance(limit.get('rate'), str):
+        _check_size(limit, 'rate', 'output_limit of %s' % what, errors)
+    if isinstance(limit.get('action'), str) and \
+            limit['action'] not in ACTIONS:
+        errors.append((_where(limit, 'action'), 'action of output_limit of %s '
+                       'must be one of %s' % (what, ', '.join(ACTIONS))))
+
+
+def _check_hooks(hooks, what, errors):
+    from .hooks import EVENTS
+    what = 'hooks of %s' % what
+    for key, declared in hooks.items():
+        if key not in ['on_%s' % e for e in EVENTS]:
+            errors.append((_where(hooks, key), 'unknown event "%s" in %s, '
+                           'must be one of %s' % (key, what, ', '.join(
+                               'on_%s' % e for e in EVENTS))))
+            continue
+        items = declared if isinstance(declared, list) else [declared]
+        for i, hook in enumerate(items):
+            where = _where(declared, i) if declared is not hook \
+                else _where(hooks, key)
+            if isinstance(hook, dict):
+                if not isinstance(hook.get('url'), str):
+                    errors.append((where, 'HTTP hook in %s needs a "url"'
+                                   % what))
+            elif isinstance(hook, str):
+                _check_command(hook, where)
+            else:
+                errors.append((where, '%s must be commands or mappings with '
+                               'a "url"' % what))
+
+
+def _check_ready_when(win, what, errors):
+    import re
+    from .ready import compile_regex
+    conditions = win['ready_when']
+    items = conditions if isinstance(conditions, list) else [conditions]
+    panes = win.get('panes') if isinstance(win.get('panes'), list) else None
+    for i, cond in enumerate(items):
+        where = _where(conditions, i) if cond is not conditions \
+            else _where(win, 'ready_when')
+        if not isinstance(cond, dict) or not isinstance(
+                cond.get('regex'), str):
+            errors.append((where, 'ready_when of %s needs a "regex"' % what))
+            continue
+        _check_keys(cond, READY_KEYS, 'ready_when of %s' % what, errors)
+        try:
+            compile_regex(cond['regex'])
+        except re.error as e:
+            errors.append((_where(cond, 'regex'), 'bad regex in ready_when '
+                           'of %s: %s' % (what, e)))
+        pane = cond.get('pane', 0)
+        if isinstance(pane, int) and panes is not None and \
+                not 0 <= pane < len(panes):
+            errors.append((_where(cond, 'pane'), '%s has no pane %d (panes '
+                           'count from 0)' % (what, pane)))
+
+
+def _check_cost(cost, what, errors):
+    _check_keys(cost, COST_KEYS, 'cost of %s' % what, errors)
+    if isinstance(cost.get('mem'), str):
+        _check_size(cost, 'mem', 'cost of %s' % what, errors)
+
+
+def validate(config):
+    """Check ``config`` and raise :class:`ConfigError` listing all problems."""
+    errors = []
+    if not isinstance(config, dict):
+        raise ConfigError([(_where(config), 'configuration must be a mapping')])
+    _check_keys(config, CONFIG_KEYS, 'configuration', errors)
+    if 'windows' not in config:
+        errors.append((_where(config), 'no "windows" defined'))
+    if isinstance(config.get('init_cmd'), str):
+        _check_command(config['init_cmd'], _where(config, 'init_cmd'))
+    if config.get('launch_mode', 'keys') not in LAUNCH_MODES:
+        errors.append((_where(config, 'launch_mode'),
+                       'launch_mode must be one of %s' % ', '.join(LAUNCH_MODES)))
+    if config.get('on_failure', 'abort') not in FAILURE_MODES:
+        errors.append((_where(config, 'on_failure'),
+                       'on_failure must be one of %s'
+                       % ', '.join(FAILURE_MODES)))
+    if isinstance(config.get('throttle'), dict):
+        _check_keys(config['throttle'], THROTTLE_KEYS, 'throttle', errors)
+        if isinstance(config['throttle'].get('default_cost'), dict):
+            _check_cost(config['throttle']['default_cost'], 'throttle',
+                        errors)
+        if isinstance(config['throttle'].get('min_free_mem'), str):
+            _check_size(config['throttle'], 'min_free_mem', 'throttle',
+                        errors)
+    if isinstance(config.get('tmux_options'), dict):
+        _check_tmux_options(config['tmux_options'],
+                            ('session', 'window', 'pane'), 'configuration',
+                            errors)
+    if isinstance(config.get('output_limit'), dict):
+        _check_output_limit(config['output_limit'], 'configuration', errors)
+    if isinstance(config.get('hooks'), dict):
+        _check_hooks(config['hooks'], 'configuration', errors)
+    if isinstance(config.get('env'), dict):
+        _check_env(config['env'], 'configuration', errors)
+    declared_tags = config.get('tags')
+    if isinstance(declared_tags, list):
+        _check_strings(declared_tags, 'tags', errors)
+        declared_tags = set(declared_tags)
+    else:
+        declared_tags = None
+
+    windows = config.get('windows')
+    if not isinstance(windows, list):
+        raise ConfigError(errors)
+
+    names = {}
+    for i, win in enumerate(windows):
+        if not isinstance(win, dict):
+            errors.append((_where(windows, i), 'windows must be mappings'))
+            continue
+        if not isinstance(win.get('name'), str):
+            errors.append((_where(win), 'window without a name'))
+            what = 'window %d' % (i + 1)
+        else:
+            what = 'window "%s"' % win['name']
+            if win['name'] in names:
+                errors.append((_where(win, 'name'), '%s already defined at %s'
+                               % (what, '%s:%d' % names[win['name']][:2]
+                                  if names[win['name']] else 'another place')))
+            else:
+                names[win['name']] = _where(win, 'name')
+        _coerce_legacy(win, what)
+        _check_keys(win, WINDOW_KEYS, what, errors)
+        _check_sched(win, what, errors)
+        if isinstance(win.get('cost'), dict):
+            _check_cost(win['cost'], what, errors)
+        if isinstance(win.get('tmux_options'), dict):
+            _check_tmux_options(win['tmux_options'],
+                                ('window', 'pane', 'panes'), what, errors)
+        if isinstance(win.get('output_limit'), dict):
+            _check_output_limit(win['output_limit'], what, errors)
+        if isinstance(win.get('hooks'), dict):
+            _check_hooks(win['hooks'], what, errors)
+        if isinstance(win.get('ready_when'), (dict, list)):
+            _check_ready_when(win, what, errors)
+        if isinstance(win.get('env'), dict):
+            _check_env(win['env'], what, errors)
+        if win.get('launch_mode', 'keys') not in LAUNCH_MODES:
+            errors.append((_where(win, 'launch_mode'),
+                           'launch_mode of %s must be one of %s'
+                           % (what, ', '.join(LAUNCH_MODES))))
+        panes = win.get('panes')
+        if panes is None:
+            errors.append((_where(win), '%s has no "panes"' % what))
+        elif isinstance(panes, list):
+            for p in range(len(panes)):
+                _check_pane(panes, p, what, errors)
+        for key in ['tags', 'depends']:
+            if isinstance(win.get(key), list):
+                _check_strings(win[key], '%s of %s' % (key, what), errors)
+        if declared_tags is not None and isinstance(win.get('tags'), list):
+            for t, tag in enumerate(win['tags']):
+                if isinstance(tag, str) and tag not in declared_tags:
+                    errors.append((_where(win['tags'], t),
+                                   'unknown tag "%s" in %s' % (tag, what)))
+
+    for win in windows:
+        if isinstance(win, dict) and isinstance(win.get('depends'), list):
+            for d, dep in enumerate(win['depends']):
+                if isinstance(dep, str) and dep not in names:
+                    errors.append((_where(win['depends'], d),
+                                   'window "%s" depends on unknown window '
+                                   '"%s"' % (win.get('name'), dep)))
+    if errors:
+        raise ConfigError(errors)
+
+    cycle = _find_cycle(windows)
+    if cycle:
+        first = [w for w in windows if w['name'] == cycle[0]][0]
+        raise ConfigError([(_where(first, 'depends'), 'dependency cycle: %s'
+                            % ' -> '.join(cycle))])
+
+
+def _depends(win):
+    return win.get('depends') or []
+
+
+def _find_cycle(windows):
+    by_name = dict((w['name'], w) for w in windows)
+    state = {}
+
+    def visit(name, path):
+        state[name] = 'visiting'
+        for dep in _depends(by_name[name]):
+            if state.get(dep) == 'visiting':
+                return path[path.index(dep):] + [dep]
+            if dep not in state:
+                cycle = visit(dep, path + [dep])
+                if cycle:
+                    return cycle
+        state[name] = 'done'
+
+    for w in windows:
+        if w['name'] not in state:
+            cycle = visit(w['name'], [w['name']])
+            if cycle:
+                return cycle
+
+
+def dependency_order(windows):
+    """Order ``windows`` so that each comes after the ones it depends on.
+
+    The order of the configuration is kept wherever the dependencies allow.
+    """
+    by_name = dict((w['name'], w) for w in windows)
+    ordered = []
+    done = set()
+
+    def add(win):
+        if win['name'] in done:
+            return
+        done.add(win['name'])
+        for dep in _depends(win):
+            add(by_name[dep])
+        ordered.append(win)
+
+    for w in windows:
+        add(w)
+    return ordered
+
+
+def test_validate():
+    from .config import ConfigDict
+    config = ConfigDict(windows=[
+        {'name': 'a', 'panes': ['echo "unterminated'], 'depends': ['b']},
+        {'name': 'a', 'panes': 'top', 'wait': 'long'},
+        {'name': 'b', 'panes': ['ls'], 'depends': ['c']},
+        {'name': 'r', 'panes': ['ls'],
+         'ready_when': {'pane': 1, 'regex': '('}},
+        {'name': 'e', 'env': {'1X': 'a'},
+         'panes': [{'cmd': 'ls', 'cwd': '/tmp'}, {'cwd': '/'}]},
+    ])
+    try:
+        validate(config)
+        assert False, 'invalid configuration passed'
+    except ConfigError as e:
+        messages = [m for _, m in e.errors]
+    # only a warning: shlex is no bash
+    assert not any(m.startswith('command may be malformed') for m in messages)
+    assert 'window "a" already defined at another place' in messages
+    assert '"panes" in window "a" must be a list' in messages
+    assert '"wait" in window "a" must be a number' in messages
+    assert 'window "b" depends on unknown window "c"' in messages
+    assert 'window "r" has no pane 1 (panes count from 0)' in messages
+    assert 'bad variable name "1X" in env of window "e"' in messages
+    assert 'panes of window "e" must be commands or mappings with a "cmd"' \
+        in messages
+    assert any(m.startswith('bad regex in ready_when of window "r"')
+               for m in messages)
+
+    validate({'windows': [{'name': 'q', 'panes': ["echo $'don\\'t'"]}]})
+    # as before they were validated, with a warning
+    windows = [{'name': 'q', 'panes': [], 'wait': '2', 'skip': 'yes'}]
+    validate({'windows': windows})
+    assert windows[0]['wait'] == 2.0 and windows[0]['skip'] is True
+
+    windows = [{'name': 'a', 'panes': [], 'depends': ['b']},
+               {'name': 'b', 'panes': [], 'depends': ['a']}]
+    try:
+        validate({'windows': windows})
+        assert False, 'dependency cycle not detected'
+    except ConfigError as e:
+        assert 'dependency cycle: a -> b -> a' in str(e)
+
+    windows = [{'name': 'a', 'depends': ['c']}, {'name': 'b'},
+               {'name': 'c', 'depends': ['b']}]
+    assert [w['name'] for w in dependency_order(windows)] == ['b', 'c', 'a']
@@ -0,0 +1,79 @@
+"""Wrapper scripts for the direct launch mode.
+
+In ``launch_mode: direct`` a pane is not typed into; instead it is respawned
+(``respawn-pane -k``) running a generated script that holds the ``init_cmd``
+and the pane's command. Where the command is a single simple command, the
+script ``exec``s it, so that the pane PID is the PID of the command itself.
+"""
+from __future__ import absolute_import
+
+import os
+import shlex
+import stat
+
+from .paths import runtime_dir
+
+# words that only work inside the shell, and therefore cannot be exec'ed
+_SHELL_WORDS = {
+    '.', ':', '[[', '{', '!', 'alias', 'case', 'cd', 'declare', 'eval',
+    'exec', 'export', 'for', 'function', 'if', 'local', 'read', 'select',
+    'set', 'shopt', 'source', 'trap', 'ulimit', 'umask', 'unset', 'until',
+    'while', 'wait'
+}
+
+
+def is_simple_command(cmd):
+    """True if ``cmd`` is a single command that can be run with ``exec``."""
+    cmd = cmd.strip()
+    if not cmd or '\n' in cmd:
+        return False
+    try:
+        lexer = shlex.shlex(cmd, posix=True, punctuation_chars=True)
+        lexer.whitespace_split = True
+        tokens = list(lexer)
+    except ValueError:
+        return False
+    if not tokens or tokens[0] in _SHELL_WORDS or '=' in tokens[0]:
+        return False
+    # any control operator or redirection keeps the shell in charge
+    return not any(t and t[0] in ';&|()<>' for t in tokens)
+
+
+def wrapper_path(session_name, window_name, pane_no):
+    d = os.path.join(runtime_dir(), 'spawn', session_name)
+    if not os.path.isdir(d):
+        os.makedirs(d, mode=0o700)
+    return os.path.join(d, '%s.%d.sh' % (
+        window_name.replace(os.sep, '_'), pane_no))
+
+
+def write_wrapper(session_name, window_name, pane_no, cmd, init_cmd=None):
+    """Write the wrapper script for one pane and return its path."""
+    path = wrapper_path(session_name, window_name, pane_no)
+    lines = [
+        '#!/bin/bash',
+        '# generated by TMuLE for %s:%s.%d' % (
+            session_name, window_name, pane_no),
+    ]
+    if init_cmd:
+        lines.append(init_cmd.rstrip('\n'))
+    if is_simple_command(cmd):
+        lines.append('exec ' + cmd.strip())
+    else:
+        lines.append(cmd.rstrip('\n'))
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.chmod(tmp, stat.S_IRWXU)
+    os.replace(tmp, path)
+    return path
+
+
+def test_is_simple_command():
+    assert is_simple_command('roslaunch pkg file.launch x:=1')
+    assert is_simple_command('echo "a; b"')
+    assert not is_simple_command('date\nsleep 1')
+    assert not is_simple_command('cd /tmp && ls')
+    assert not is_simple_command('ls > out')
+    assert not is_simple_command('FOO=1 run')
+    assert not is_simple_command('source setup.bash')
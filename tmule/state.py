@@ -0,0 +1,124 @@
+from __future__ import absolute_import
+
+import json
+import os
+from contextlib import contextmanager
+from logging import warning
+from tempfile import NamedTemporaryFile
+from threading import RLock
+from time import time
+
+from .locks import FileLock
+from .paths import state_dir
+
+
+class StateFile(object):
+    """Persisted desired state of the windows of one session.
+
+    Records, per window, whether it should be running, when it was last
+    launched and the pane PIDs, together with the hash of the configuration
+    it was launched from, so that ``tmule resume`` can bring back exactly
+    the previously running set after the tmux server (or the robot) died.
+    The file is written atomically (temporary file + rename), so a crash
+    never leaves a truncated state behind. Writes merge the windows changed
+    here into the file as it is then, under a lock, so that the ones other
+    processes changed meanwhile are kept.
+    """
+
+    def __init__(self, session_name, path=None):
+        self.path = path or os.path.join(
+            state_dir(), '%s.json' % session_name)
+        self.data = {'config_hash': None, 'windows': {}}
+        self._hold = 0
+        # windows (and whether the config hash) changed since the last write
+        self._changed = set()
+        self._hash_changed = False
+        # set_window is called from worker threads
+        self._lock = RLock()
+        self.load()
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError):
+            pass
+        except ValueError as e:
+            warning('ignoring corrupt state file %s: %s' % (self.path, e))
+        return None
+
+    def load(self):
+        data = self._read()
+        with self._lock:
+            if data is not None:
+                self.data = data
+            return self.data
+
+    def save(self):
+        with self._lock:
+            if self._hold:
+                return
+            if not self._changed and not self._hash_changed:
+                return
+            with FileLock(self.path + '.lock', 'state file %s' % self.path,
+                          'save'):
+                data = self._read() or {'config_hash': None, 'windows': {}}
+                for name in self._changed:
+                    data['windows'][name] = self.data['windows'][name]
+                if self._hash_changed:
+                    data['config_hash'] = self.data['config_hash']
+                d = os.path.dirname(self.path)
+                with NamedTemporaryFile('w', dir=d, prefix='.state-',
+                                        delete=False) as f:
+                    json.dump(data, f, separators=(',', ':'), sort_keys=True)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(f.name, self.path)
+            self.data = data
+            self._changed.clear()
+            self._hash_changed = False
+
+    @contextmanager
+    def batch(self):
+        """Collect all updates within the block into a single write."""
+        with self._lock:
+            self._hold += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._hold -= 1
+                self.save()
+
+    def set_window(self, window_name, running, config_hash=None, pids=None):
+        with self._lock:
+            win = self.data['windows'].setdefault(window_name, {})
+            win['desired'] = 'running' if running else 'stopped'
+            if running:
+                win['launched'] = time()
+                win['pids'] = pids or []
+            self._changed.add(window_name)
+            if config_hash:
+                self.data['config_hash'] = config_hash
+                self._hash_changed = True
+            self.save()
+
+    def running_windows(self):
+        with self._lock:
+            return [name for name, win in self.data['windows'].items()
+                    if win.get('desired') == 'running']
+
+
+def test_state_merge():
+    import tempfile
+    d = tempfile.mkdtemp()
+    path = os.path.join(d, 'robot.json')
+    mine, theirs = StateFile('robot', path), StateFile('robot', path)
+    mine.set_window('nav', True, 'h1', [1])
+    theirs.set_window('arm', True, pids=[2])
+    with mine.batch():
+        mine.set_window('nav', False)
+        mine.set_window('cam', True)
+    assert StateFile('robot', path).data == mine.data
+    assert sorted(mine.running_windows()) == ['arm', 'cam']
+    assert mine.data['config_hash'] == 'h1'
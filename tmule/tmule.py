@@ -1,23 +1,20 @@
 #!/usr/bin/env python3
 from __future__ import print_function, absolute_import
 
-from libtmux import Server
-from yaml import load
+# Only cheap modules are imported here: libtmux, psutil, yaml and the web
+# stack are imported where they are needed, so that short CLI commands (and
+# commands served by tmuled) start fast. test_startup_imports guards this.
 from logging import error, warning, info, debug, basicConfig, INFO
-from pprint import pformat
 from time import sleep
-import signal
 import os
 import sys
 from os import path
 import argparse
-from subprocess import call
-from psutil import Process, wait_procs
-import sys
-from .loader import Loader
-from threading import Thread
 from datetime import datetime
+from contextlib import contextmanager
+from threading import Lock
 from os.path import abspath, dirname
+from .exc import ConfigError, InvalidPattern, TMuleException
 
 basicConfig(level=INFO)
 
@@ -40,17 +37,38 @@ class TMux:
         if session_name:
             self.session_name = session_name
         self.sleep_sec = sleep_sec
+        if self.config:
+            from .hooks import Hooks
+            from .journal import Journal
+            from .state import StateFile
+            self.state = StateFile(self.session_name)
+            self.journal = Journal(self.session_name)
+            self.hooks = Hooks(self)
+        else:
+            self.state = None
+        # seconds to wait for a session or window busy with another
+        # process (None: wait as long as it takes, 0: fail at once)
+        self.lock_timeout = None
         # max number of loops to wait for process to come up
         self.maxCheckLoops = 16
         # time to wait between checks (factor multiplied by loop)
         self.sleepCheckLoop = 1
+        # a ProcessSnapshot shared with other projects, if any
+        self.snapshot = None
+        # the control mode client streaming output for ready_when
+        self._ready_monitor = None
+        self._monitor_lock = Lock()
 
     def _on_terminate(self, proc):
         info("process {} terminated with exit code {}"
              .format(proc, proc.returncode))
 
-    def _terminate(self, pid):
-        procs = Process(pid).children(recursive=True)
+    def _terminate(self, pid, include_self=False):
+        from psutil import Process, wait_procs
+        proc = Process(pid)
+        procs = proc.children(recursive=True)
+        if include_self:
+            procs.append(proc)
         for p in procs:
             info("trying to terminate %s" % p)
             p.terminate()
@@ -61,13 +79,16 @@ class TMux:
             p.kill()
 
     def _get_children_pids(self, pid):
-        return Process(pid).children(recursive=True)
+        if self.snapshot:
+            return self.snapshot.children(pid)
+        from psutil import Process
+        return [p.pid for p in Process(pid).children(recursive=True)]
 
     def var_substitute(self, root):
-        if type(root) == dict:
+        if isinstance(root, dict):
             for d in root:
                 root[d] = self.var_substitute(root[d])
-        elif type(root) == list:
+        elif isinstance(root, list):
             for l in range(0, len(root)):
                 root[l] = self.var_substitute(root[l])
         elif type(root) == str:
@@ -78,53 +99,176 @@ class TMux:
         return root
 
     def load_config(self):
+        from .cache import ConfigCache
+        self.var_dict = {
+            'TMULE_CONFIG_FILE': abspath(self.configfile),
+            'TMULE_CONFIG_DIR': dirname(abspath(self.configfile)),
+            'TMULE_SESSION_NAME': self.session_name
+        }
+        cache = ConfigCache(self.configfile, self.session_name)
+        compiled = cache.load()
+        if compiled is None:
+            compiled, dependencies, expansions = self.compile_config()
+            cache.store(compiled, dependencies, expansions)
+        self.config, self.config_hash = compiled
+        # tells whether the files the configuration came from changed
+        self.config_cache = cache
+        self.known_tags = set([])
+        for w in self.config['windows']:
+            if 'tags' in w:
+                for t in w['tags']:
+                    self.known_tags.add(t)
+
+    def compile_config(self):
+        """Parse, substitute and validate the config file.
+
+        Returns the compiled config with its hash, the set of files it
+        was compiled from and the paths include specs with environment
+        variables expanded to (see :class:`tmule.loader.IncludeResolver`).
+        """
+        import json
+        from hashlib import sha1
+        from .config import Window
+        from .context import compile_contexts
+        from .expand import expand_windows
+        from .loader import Loader
+        from .schema import validate, dependency_order
         with open(self.configfile) as data_file:
-            self.config = load(data_file, Loader)
-            self.var_dict = {
-                'TMULE_CONFIG_FILE': abspath(self.configfile),
-                'TMULE_CONFIG_DIR': dirname(abspath(self.configfile)),
-                'TMULE_SESSION_NAME': self.session_name
-            }
-            self.config = self.var_substitute(self.config)
-            self.known_tags = set([])
-            for w in self.config['windows']:
-                if 'tags' in w:
-                    for t in w['tags']:
-                        self.known_tags.add(t)
-
-    def init(self):
+            loader = Loader(data_file)
+            try:
+                config = loader.get_single_data()
+            finally:
+                loader.dispose()
+        windows = config.get('windows') if isinstance(config, dict) else None
+        if isinstance(windows, list):
+            config['windows'] = list(expand_windows(windows))
+        config = self.var_substitute(config)
+        validate(config)
+        compile_contexts(config, dirname(abspath(self.configfile)))
+        config['windows'] = dependency_order(config['windows'])
+        config_hash = sha1(json.dumps(
+            config, sort_keys=True).encode('utf-8')).hexdigest()
+        config['windows'] = [Window(w) for w in config['windows']]
+        return (config, config_hash), loader.dependencies, \
+            loader.resolver.expansions
+
+    def init(self, server=None):
         if not self.config:
             error('config file not loaded; call "load_config" first!')
         else:
-            self.server = Server()
-            if self.server.has_session(self.session_name):
+            if server is None:
+                from libtmux import Server
+                server = Server()
+            self.server = server
+            # windows created by this init cannot run anything yet
+            self.created_windows = set()
+            if self.server.has_session(self.session_name) and \
+                    self._complete():
+                # nothing to create: commands only looking at the session
+                # (running, pids, ...) do not wait for the lock of a plan
                 self.session = self.server.find_where({
                     "session_name": self.session_name
                 })
-
-                debug('found running session %s on server' % self.session_name)
-            else:
-                info('starting new session %s on server' % self.session_name)
-                self.session = self.server.new_session(
-                    session_name=self.session_name
-                )
-
-            for win in self.config['windows']:
-                # print win, "***", self.config['windows']
-                window = self.session.find_where({
-                    "window_name": win['name']
-                })
-                if window:
-                    debug('window %s already exists' % win['name'])
+                debug('found complete session %s on server'
+                      % self.session_name)
+                return
+            with self.session_lock('init'):
+                from .context import pane_context
+                from .options import session_commands, run_batched
+                if self.server.has_session(self.session_name):
+                    self.session = self.server.find_where({
+                        "session_name": self.session_name
+                    })
+
+                    debug('found running session %s on server'
+                          % self.session_name)
                 else:
-                    info('create window %s' % win['name'])
-                    window = self.session.new_window(win['name'])
-                exist_num_panes = len(window.list_panes())
-                while exist_num_panes < len(win['panes']):
-                    info('new pane needed in window %s' % win['name'])
-                    window.split_window(vertical=1)
+                    info('starting new session %s on server'
+                         % self.session_name)
+                    self.session = self.server.new_session(
+                        session_name=self.session_name
+                    )
+                    # before any window is created, as some options (like
+                    # history-limit) only apply to new panes
+                    run_batched(self.server, session_commands(
+                        self.config, self.session_name))
+
+                # windows (or panes) created now, their options are set
+                tune = []
+                for win in self.config['windows']:
+                    # print win, "***", self.config['windows']
+                    window = self.session.find_where({
+                        "window_name": win['name']
+                    })
+                    if window:
+                        debug('window %s already exists' % win['name'])
+                    else:
+                        info('create window %s' % win['name'])
+                        env, cwd = pane_context(win, 0)
+                        window = self.session.new_window(
+                            win['name'], start_directory=cwd,
+                            environment=env)
+                        self.created_windows.add(win['name'])
+                        tune.append(win)
                     exist_num_panes = len(window.list_panes())
-                window.cmd('select-layout', 'tiled')
+                    if exist_num_panes < len(win['panes']) and \
+                            win['name'] not in self.created_windows:
+                        tune.append(win)
+                    while exist_num_panes < len(win['panes']):
+                        info('new pane needed in window %s' % win['name'])
+                        env, cwd = pane_context(win, exist_num_panes)
+                        window.split_window(vertical=1, start_directory=cwd,
+                                            environment=env)
+                        exist_num_panes = len(window.list_panes())
+                    window.cmd('select-layout', 'tiled')
+                if tune:
+                    self._tune_windows(tune)
+
+    def _complete(self):
+        # whether all windows of the configuration exist, with their panes
+        from .capture import list_panes
+        panes = {}
+        for window, _, _ in list_panes(self.server, self.session_name):
+            panes[window] = panes.get(window, 0) + 1
+        return all(panes.get(w['name'], 0) >= len(w['panes'])
+                   for w in self.config['windows'])
+
+    def _tune_windows(self, winconfs):
+        from .capture import list_panes
+        from .options import window_commands, run_batched
+        pane_ids = {}
+        for window, index, pane_id in sorted(
+                list_panes(self.server, self.session_name)):
+            pane_ids.setdefault(window, []).append(pane_id)
+        commands = []
+        for win in winconfs:
+            commands.extend(window_commands(
+                self.config, win, pane_ids.get(win['name'], [])))
+        run_batched(self.server, commands)
+
+    def session_lock(self, operation, shared=False):
+        from .locks import session_lock
+        return session_lock(self.session_name, operation, shared,
+                            self.lock_timeout)
+
+    def window_lock(self, window_name, operation):
+        from .locks import window_lock
+        return window_lock(self.session_name, window_name, operation,
+                           self.lock_timeout)
+
+    @contextmanager
+    def _window_operation(self, window_name, operation):
+        # the session lock is only shared, operations on other windows of
+        # the session can go on at the same time
+        with self.session_lock(operation, shared=True), \
+                self.window_lock(window_name, operation), \
+                self.journal.operation(operation, window=window_name):
+            yield
+
+    def window_config(self, window_name):
+        for win in self.config['windows']:
+            if win['name'] == window_name:
+                return win
 
     def find_window(self, window_name):
         for win in self.config['windows']:
@@ -143,11 +287,45 @@ class TMux:
         pane.send_keys('# tmux-controller sent Ctrl-C at %s' % datestr,
                        enter=True, suppress_history=True)
 
+    def _is_direct(self, winconf):
+        return winconf.get(
+            'launch_mode', self.config.get('launch_mode', 'keys')) == 'direct'
+
+    def _spawn_window(self, winconf, window):
+        # direct mode: respawn each pane running a wrapper script, no keys
+        from shlex import quote
+        from .context import context_args, pane_context
+        from .spawn import write_wrapper
+        # keep dead panes around, so that the layout stays and the output of
+        # crashed commands can be inspected
+        window.cmd('set-window-option', 'remain-on-exit', 'on')
+        for pane_no, cmd in enumerate(winconf['panes']):
+            script = write_wrapper(
+                window.session.name, winconf['name'], pane_no, cmd,
+                self._pane_init_cmd())
+            window.cmd('respawn-pane', '-k',
+                       *context_args(*pane_context(winconf, pane_no)) +
+                       ['exec /bin/bash %s' % quote(script)],
+                       target='%s:%s.%d' % (
+                           window.session.name, winconf['name'], pane_no))
+
     def launch_window(self, window_name, enter=True):
+        with self._window_operation(window_name, 'launch'):
+            self._launch_window(window_name, enter)
+
+    def _launch_window(self, window_name, enter=True):
         info('launch %s' % window_name)
         winconf, window = self.find_window(window_name)
+        if self._is_direct(winconf):
+            self._spawn_window(winconf, window)
+            winconf['_running'] = True
+            self.apply_scheduling(window_name)
+            self.state.set_window(window_name, True, self.config_hash,
+                                  self._get_pids_window(window, live=True))
+            return
         pane_no = 0
         datestr = datetime.now().strftime('%c')
+        init_cmd = self._pane_init_cmd()
         for cmd in winconf['panes']:
             pane = window.select_pane('%s:%s.%d' % (
                 window.session.name, window_name, pane_no))
@@ -155,63 +333,85 @@ class TMux:
             self.send_ctrlc(pane)
             pane.send_keys('# tmux-controller starts new command %s' % datestr,
                            enter=True, suppress_history=True)
-            if 'init_cmd' in self.config:
-                pane.send_keys(self.config['init_cmd'],
+            if init_cmd:
+                pane.send_keys(init_cmd,
                                enter=enter, suppress_history=False)
             pane.send_keys(cmd, enter=enter, suppress_history=False)
             pane_no += 1
         winconf['_running'] = True
-
-    def launch_all_windows(self, tags=set([])):
-        for winconf in self.config['windows']:
-            selected = 'skip' not in winconf or not winconf['skip']
-            if selected and tags:
-                if 'tags' in winconf:
-                    selected = set(winconf['tags']).intersection(tags)
-                else:
-                    selected = False
-            if selected:
-                self.launch_window(winconf['name'])
-                w = self.sleep_sec
-                if 'wait' in winconf:
-                    w = float(winconf['wait'])
-                if w > 0:
-                    info('sleep %f seconds after launch of %s' % (
-                        w, winconf['name']))
-                    sleep(w)
-                if 'check' in winconf:
-                    debug('need to run check command')
-                    running = False
-                    loop = 0
-                    check_cmd = '\n'
-                    if 'init_cmd' in self.config:
-                        check_cmd += self.config['init_cmd'] + '\n'
-                    check_cmd += winconf['check']
-
-                    while not running and loop < self.maxCheckLoops:
-                        loop += 1
-                        sleep(loop * self.sleepCheckLoop)
-                        #running = (call(winconf['check'], shell=True) == 0)
-                        running = (call(
-                            check_cmd, executable='/bin/bash', shell=True, stdout=None,
-                            stdin=None) == 0)
-                        info('ran check for %s (loop %d) => %s' % (
-                            winconf['name'], loop, running))
-                    if loop >= self.maxCheckLoops:
-                        error(
-                            'window %s failed to come up in time, '
-                            'not continuing launch.'
-                            % winconf['name'])
-                        break
+        self.apply_scheduling(window_name)
+        self.state.set_window(window_name, True, self.config_hash,
+                              self._get_pids_window(window))
+
+    def plan(self, action, tags=set([]), windows=None, batch=1):
+        """The (cached) plan of ``action`` on the selected windows."""
+        from .plan import PlanCache
+        n = self.maxCheckLoops
+        return PlanCache().get(
+            self.config, self.config_hash, self.session_name, action,
+            tags, windows, sleep_sec=self.sleep_sec,
+            check_timeout=self.sleepCheckLoop * n * (n + 1) / 2.0,
+            batch=batch)
+
+    def execute(self, plan, on_failure=None):
+        """Run ``plan`` and return its :class:`tmule.plan.Outcome`.
+
+        ``on_failure`` (default: ``on_failure`` of the configuration, or
+        ``abort``) says what happens when a window fails its check:
+        ``abort`` launches nothing more and cancels the launches in
+        progress, ``continue`` goes on with all windows not depending on
+        the failed one, ``rollback`` aborts and stops all windows launched
+        so far (the failed one included), in reverse order.
+
+        The plan runs on the loop of :mod:`tmule.core`, see
+        :func:`tmule.core.execute` to await it there.
+        """
+        from .core import get_core, execute
+        return get_core().run(execute(self, plan, on_failure))
+
+    def launch_all_windows(self, tags=set([]), windows=None, batch=1,
+                           on_failure=None):
+        return self.execute(self.plan('launch', tags, windows, batch),
+                            on_failure)
 
     def stop_all_windows(self, tags=set([])):
-        for winconf in self.config['windows'][::-1]:
-            selected = 'skip' not in winconf or not winconf['skip']
-            if selected and tags:
-                if 'tags' in winconf:
-                    selected = set(winconf['tags']).intersection(tags)
-            if selected:
-                self.stop_window(winconf['name'])
+        return self.execute(self.plan('stop', tags))
+
+    def relaunch_all_windows(self, tags=set([]), windows=None, batch=1,
+                             on_failure=None):
+        """Restart the selected windows, ``batch`` windows at a time."""
+        return self.execute(self.plan('relaunch', tags, windows, batch),
+                            on_failure)
+
+    def resume(self):
+        """Launch the windows that were running according to the state file.
+
+        Windows are launched in configuration order, windows that still (or
+        already) have processes running are left alone.
+        """
+        # shared, like the plan it runs: the windows are locked one by one
+        with self.session_lock('resume', shared=True):
+            self._resume()
+
+    def _resume(self):
+        recorded = self.state.data.get('config_hash')
+        if recorded and recorded != self.config_hash:
+            warning('configuration changed since the state was recorded, '
+                    'resuming with the current configuration')
+        names = set(self.list_windows())
+        to_launch = set()
+        for name in self.state.running_windows():
+            if name not in names:
+                warning('window %s is no longer configured, skipping' % name)
+            elif (name not in self.created_windows and
+                    self.get_children_pids_window(name)):
+                info('window %s is already running' % name)
+            else:
+                to_launch.add(name)
+        if to_launch:
+            self.launch_all_windows(windows=to_launch)
+        else:
+            info('nothing to resume')
 
     def get_children_pids_all_windows(self):
         pids = []
@@ -222,50 +422,54 @@ class TMux:
         return pids
 
     def kill_all_windows(self):
-        for winconf in self.config['windows'][::-1]:
-            try:
-                self.kill_window(winconf['name'])
-            except Exception as e:
-                warning(
-                    'There was an exception shutting down, '
-                    'carrying on regardless: %s' % str(e))
-        self.server.kill_session(self.session_name)
+        from .core import get_core, kill_all
+        get_core().run(kill_all(self))
 
     def stop_window(self, window_name):
-        info('stop %s' % window_name)
-        winconf, window = self.find_window(window_name)
-        self._stop_window(winconf, window)
-
-    def __pids_clean_up(self, pids):
-        sleep(1)
-        for p in pids:
-            try:
-                self._terminate(p)
-            except Exception as e:
-                info('exception in termination, can be ignored: %s' % str(e))
-
-    def _stop_window(self, winconf, window):
-        pane_no = 0
-        for _ in winconf['panes']:
-            pane = window.select_pane('%s:%s.%d' % (
-                window.session.name, window.name, pane_no))
-            self.send_ctrlc(pane)
-            pane_no += 1
-        pids = self._get_pids_window(window)
-        Thread(target=self.__pids_clean_up, args=(pids,)).start()
-        #for p in pids:
-           #self._terminate(p)
-        winconf['_running'] = False
+        """Stop a window; returns a future done once its processes are
+        cleaned up."""
+        from .core import get_core, stop_window
+        core = get_core()
+        return core.future(core.run(stop_window(self, window_name)))
 
     def kill_window(self, window_name):
-        info('terminate %s' % window_name)
+        """Kill a window; returns a future done once its processes are
+        cleaned up."""
+        from .core import get_core, kill_window
+        core = get_core()
+        return core.future(core.run(kill_window(self, window_name)))
+
+    def _interrupt_window(self, window_name, operation='stop'):
+        # stops the processes of a window nicely, the rest is up to
+        # tmule.core.clean_up: returns the pids to clean up and the lock of
+        # the window, which stays locked until its processes are gone, so
+        # that nobody launches anything there that would be killed as well
+        info('%s %s' % (operation, window_name))
+        winconf, window = self.find_window(window_name)
+        with self._window_operation(window_name, operation):
+            direct = self._is_direct(winconf)
+            pane_no = 0
+            for _ in winconf['panes']:
+                pane = window.select_pane('%s:%s.%d' % (
+                    window.session.name, window.name, pane_no))
+                if direct:
+                    # there is no shell to leave a comment in
+                    pane.cmd("send-keys", "", "C-c")
+                else:
+                    self.send_ctrlc(pane)
+                pane_no += 1
+            pids, _, lock = self._window_pids(window_name, 'clean up')
+            winconf['_running'] = False
+            self.state.set_window(winconf['name'], False)
+            self.hooks.emit('stop', winconf['name'])
+        return pids, direct, lock
+
+    def _window_pids(self, window_name, operation):
+        # the pids of a window's panes to be cleaned up, with its lock
         winconf, window = self.find_window(window_name)
-#                       "-F '#{pane_active} #{pane_pid}")
-        self._stop_window(winconf, window)
-        pids = self._get_pids_window(window)
-        sleep(1)
-        Thread(target=self.__pids_clean_up, args=(pids,)).start()
-        winconf['_running'] = False
+        direct = self._is_direct(winconf)
+        lock = self.window_lock(window_name, operation).acquire()
+        return self._get_pids_window(window, live=direct), direct, lock
 
     def list_windows(self):
         return [w['name'] for w in self.config['windows']]
@@ -274,178 +478,236 @@ class TMux:
         winconf, window = self.find_window(window_name)
         return self._get_pids_window(window)
 
-    def _get_pids_window(self, window):
+    def _get_pids_window(self, window, live=False):
+        # with live=True, panes whose process has exited (only kept with
+        # remain-on-exit) are left out
         r = window.cmd('list-panes',
-                       "-F #{pane_pid}")
-        return [int(p) for p in r.stdout]
+                       "-F #{pane_pid} #{pane_dead}")
+        pids = []
+        for line in r.stdout:
+            pid, dead = (line.split() + [''])[:2]
+            if not (live and dead == '1'):
+                pids.append(int(pid))
+        return pids
 
     def get_children_pids_window(self, window_name):
-        _, window = self.find_window(window_name)
-        return self._get_children_pids_window(window)
+        winconf, window = self.find_window(window_name)
+        return self._get_children_pids_window(
+            window, self._is_direct(winconf))
 
-    def _get_children_pids_window(self, window):
-        winpids = self._get_pids_window(window)
+    def _get_children_pids_window(self, window, direct=False):
+        winpids = self._get_pids_window(window, live=direct)
         pids = []
         for pid in winpids:
+            if direct:
+                # the pane process is the command itself
+                pids.append(pid)
             pids.extend(self._get_children_pids(pid))
-        return [p.pid for p in pids]
+        return pids
+
+    def apply_scheduling(self, window_name, only_new=False):
+        """Apply cpu_affinity, nice, ionice and cgroup of a window.
+
+        The settings go to the pane processes and all their children; with
+        ``only_new`` only to processes not seen by a previous call.
+        """
+        from .sched import has_sched, apply
+        winconf, window = self.find_window(window_name)
+        if not has_sched(winconf):
+            return
+        panes = self._get_pids_window(window, live=True)
+        pids = panes + [p for p in self._get_children_pids_window(
+            window, self._is_direct(winconf)) if p not in panes]
+        if not hasattr(self, '_sched_applied'):
+            self._sched_applied = {}
+        applied = self._sched_applied.get(window_name, set())
+        new = [p for p in pids if not (only_new and p in applied)]
+        if new:
+            debug('apply scheduling of %s to %s' % (window_name, new))
+            apply(new, winconf, self.session_name,
+                  self.config.get('cgroup_root'))
+        self._sched_applied[window_name] = set(pids)
 
     def is_running(self, window_name):
         winconf, window = self.find_window(window_name)
-        pids = self._get_children_pids_window(window)
+        pids = self._get_children_pids_window(
+            window, self._is_direct(winconf))
         if len(pids) < 1:
             return False
         if 'check' in winconf:
             debug('need to run check command')
-            check_cmd = '\n'
-            if 'init_cmd' in self.config:
-                check_cmd += self.config['init_cmd'] + '\n'
-            check_cmd += winconf['check']
-            running = (call(
-                check_cmd, executable='/bin/bash', shell=True, stdout=None,
-                stdin=None) == 0)
-            return running
+            return self._run_check(winconf)
         else:
             return True
 
-    def _server(self, port=9999, keepalive=True):
-        from .ws_protocol import JsonWSProtocol
-        import web
-        from web.httpserver import StaticMiddleware, StaticApp
-
-        from autobahn.twisted.websocket import WebSocketServerProtocol, \
-            WebSocketServerFactory
-        from autobahn.twisted.resource import WebSocketResource, WSGIRootResource
-
-        from twisted.internet import reactor
-        from twisted.web.server import Site
-        from twisted.web.wsgi import WSGIResource
-        from twisted.python import log
-        from twisted.web.static import File
-
-        tmux_self = self
-
-        class TMuxWebServer(web.auto_application):
-
-            def __init__(self):
-
-                web.auto_application.__init__(
-                    self
-                )
-
-                self._renderer = web.template.render(
-                    path.realpath(
-                        path.join(
-                            path.dirname(__file__),
-                            'www'
-                        )
-                    ),
-                    base="base", globals=globals())
-
-                self_app = self
-
-                class Index(self.page):
-                    path = '/'
-
-                    def GET(self):
-                        tmux_self.load_config()
-                        tmux_self.init()
-                        ws_uri = '%s://%s%sws' % (
-                            'ws' if web.ctx['protocol'] == 'http' else 'wss',
-                            web.ctx['host'],
-                            web.ctx['fullpath']
-                        )
-                        return self_app._renderer.index(
-                            ws_uri,
-                            tmux_self.config, tmux_self.known_tags)
-
-                class Log(self.page):
-                    path = '/log'
-
-                    def GET(self):
-                        lines = tmux_self.server.cmd(
-                            'capture-pane', '-p', '-C', '-S', '-100000').stdout
-                        return '\n'.join(lines)
-
-        class TMuxWSProtocol(JsonWSProtocol):
-
-            def __init__(self):
-                super(TMuxWSProtocol, self).__init__()
-
-            def on_button(self, payload):
-                debug('button pressed: \n%s' % pformat(payload))
-                window_name = payload['id']
-                cmd = payload['cmd']
-                if cmd == 'launch':
-                    if window_name == '':
-                        tmux_self.launch_all_windows()
-                    else:
-                        tmux_self.launch_window(window_name)
-                elif cmd == 'launch-tag':
-                    tmux_self.launch_all_windows(tags={window_name})
-                elif cmd == 'stop':
-                    if window_name == '':
-                        tmux_self.stop_all_windows()
-                    else:
-                        tmux_self.stop_window(window_name)
-                elif cmd == 'stop-tag':
-                    tmux_self.stop_all_windows(tags={window_name})
-                elif cmd == 'terminate':
-                        tmux_self.kill_all_windows()
-                        sleep(1)
-                        tmux_self.init()
-
-                sleep(1)
-                self.sendJSON(self.on_status())
-
-            def on_status(self, payload=None):
-                debug('status-requested: ')
-
-                res = {
-                    'windows': {},
-                    'method': 'update_status'
-                }
-                for w in tmux_self.config['windows']:
-                    res['windows'][w['name']] = tmux_self.is_running(w['name'])
-
-                return res
-
-                # return {'button_outcome': True}
-
-        log.startLogging(sys.stdout)
-        wsFactory = WebSocketServerFactory()
-        wsFactory.protocol = TMuxWSProtocol
-        wsResource = WebSocketResource(wsFactory)
-        staticResource = File(
-            path.realpath(
-                path.join(
-                    path.dirname(__file__),
-                    'www/static'
-                )
-            )
-        )
-
-        app = TMuxWebServer()
-
-        # create a Twisted Web WSGI resource for our Flask server
-        wsgiResource = WSGIResource(reactor, reactor.getThreadPool(), app.wsgifunc())
-
-        # create a root resource serving everything via WSGI/Flask, but
-        # the path "/ws" served by our WebSocket stuff
-        rootResource = WSGIRootResource(wsgiResource, {
-            b'ws': wsResource,
-            b'static': staticResource
-        })
-
-        # create a Twisted Web Site and run everything
-        site = Site(rootResource)
-
-        reactor.listenTCP(port, site)
-        reactor.run()        # kill everything when server dies
-        if not keepalive:
-            self.kill_all_windows()
-
-def main():
+    def grep(self, pattern, tags=set([]), windows=None, tail=None,
+             ignore_case=False):
+        """Search the recent output of all panes of the selected windows.
+
+        Returns a list of matches with window, pane, line and text; raises
+        InvalidPattern if ``pattern`` is not a valid regular expression.
+        """
+        import re
+        from .capture import DEFAULT_TAIL, list_panes, capture_panes, \
+            grep_captures
+        try:
+            regex = re.compile(pattern, re.I if ignore_case else 0)
+        except re.error as e:
+            raise InvalidPattern('invalid pattern %r: %s' % (pattern, e))
+        selected = set()
+        for winconf in self.config['windows']:
+            if windows:
+                if winconf['name'] not in windows:
+                    continue
+            elif tags and not set(winconf.get('tags', [])).intersection(tags):
+                continue
+            selected.add(winconf['name'])
+        panes = [p for p in list_panes(self.server, self.session_name)
+                 if p[0] in selected]
+        captures = capture_panes(self.server, panes, tail or DEFAULT_TAIL)
+        return grep_captures(regex, captures)
+
+    def has_output_limit(self):
+        return 'output_limit' in self.config or any(
+            'output_limit' in w for w in self.config['windows'])
+
+    def start_output_guard(self):
+        """Watch the output rates of the panes and enforce output_limit."""
+        from .outrate import OutputGuard
+        if getattr(self, 'output_guard', None) is None:
+            self.output_guard = OutputGuard(self).start()
+        return self.output_guard
+
+    def output_rates(self, seconds=2.0):
+        """Bytes per second written to each pane, highest first.
+
+        Taken from the output guard if one is running, otherwise measured
+        for ``seconds``.
+        """
+        guard = getattr(self, 'output_guard', None)
+        if guard is not None and guard.rates:
+            rates = list(guard.rates.values())
+        else:
+            from .outrate import OutputMonitor
+            from .capture import list_panes
+            monitor = OutputMonitor(self.session_name)
+            monitor.start()
+            try:
+                sleep(seconds)
+                sample, _ = monitor.sample()
+            finally:
+                monitor.stop()
+            rates = [{'window': window, 'pane': index,
+                      'rate': sample.get(pane_id, 0.0), 'action': None}
+                     for window, index, pane_id in list_panes(
+                         self.server, self.session_name)]
+        return sorted(rates, key=lambda r: -r['rate'])
+
+    def watch_ready(self, window_name):
+        """Start watching the output of a window for its ``ready_when``,
+        with the control mode client shared by all windows."""
+        from .outrate import OutputMonitor
+        with self._monitor_lock:
+            if self._ready_monitor is None:
+                self._ready_monitor = OutputMonitor(self.session_name)
+            monitor = self._ready_monitor
+            if not monitor.alive():
+                monitor.start()
+                # output before the client is attached would be missed
+                monitor.attached.wait(5)
+        watch = self.ready_watch(window_name)
+        monitor.watch(watch.pane_ids(), watch)
+        return watch
+
+    def ready_watch(self, window_name):
+        """The :class:`tmule.ready.ReadyWatch` of a window, not fed with
+        any output yet."""
+        from .capture import list_panes
+        from .ready import ReadyWatch, ready_conditions
+        # ready_when numbers panes by their place in panes:, not by their
+        # pane_index (which starts at tmux's pane-base-index)
+        panes = sorted((index, pane_id) for window, index, pane_id in
+                       list_panes(self.server, self.session_name)
+                       if window == window_name)
+        pane_ids = dict((no, pane_id) for no, (_, pane_id) in enumerate(panes))
+        winconf = self.window_config(window_name)
+        typed = {}
+        if not self._is_direct(winconf):
+            # the shell echoes what is typed into it
+            init = (self._pane_init_cmd() or '').splitlines()
+            typed = dict((no, init + cmd.splitlines())
+                         for no, cmd in enumerate(winconf['panes']))
+        return ReadyWatch(window_name, ready_conditions(winconf), pane_ids,
+                          typed)
+
+    def unwatch_ready(self, watch):
+        with self._monitor_lock:
+            monitor = self._ready_monitor
+            if monitor is None:
+                return
+            monitor.unwatch(watch)
+            if not monitor.watchers:
+                monitor.stop()
+                self._ready_monitor = None
+
+    def _check_script(self, winconf):
+        """The script running the ``check`` of a window, and its env."""
+        from .context import window_context
+        check_cmd = '\n'
+        env = None
+        if 'init_cmd' in self.config:
+            if self.config.get('env_cache'):
+                from .envcache import snapshot
+                env = snapshot(self.config['init_cmd'])
+            else:
+                check_cmd += self.config['init_cmd'] + '\n'
+        # checks run in the environment and directory of their window
+        variables, cwd = window_context(
+            self.config, winconf, dirname(abspath(self.configfile)))
+        if variables:
+            env = dict(env if env is not None else os.environ, **variables)
+        if cwd:
+            from shlex import quote
+            check_cmd = '\ncd %s || exit 1' % quote(cwd) + check_cmd
+        check_cmd += winconf['check']
+        return check_cmd, env
+
+    def _run_check(self, winconf):
+        from subprocess import call
+        check_cmd, env = self._check_script(winconf)
+        return call(
+            check_cmd, executable='/bin/bash', shell=True, stdout=None,
+            stdin=None, env=env) == 0
+
+    def _pane_init_cmd(self):
+        """What prepares a pane before its command (None if nothing)."""
+        if 'init_cmd' not in self.config:
+            return None
+        if self.config.get('env_cache'):
+            from shlex import quote
+            from .envcache import env_file
+            return 'source %s' % quote(env_file(self.config['init_cmd']))
+        return self.config['init_cmd']
+
+    def _server(self, port=9999, keepalive=True, projects=()):
+        """Run the web server for this and the configs in ``projects``."""
+        import asyncio
+        from twisted.internet import asyncioreactor
+        from .core import use_loop
+        # twisted runs on the loop of the core, which the websocket
+        # handlers await operations on
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        asyncioreactor.install(loop)
+        use_loop(loop)
+        from .projects import Projects
+        from .webserver import serve
+        tmuxes = [self] + [TMux(configfile=c, sleep_sec=self.sleep_sec)
+                           for c in projects]
+        serve(Projects(tmuxes), port, keepalive)
+
+
+def build_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--config", '-c', type=str,
                         default='tmule.yaml',
@@ -461,6 +723,26 @@ def main():
     parser.add_argument("--wait", '-W', type=float,
                          default=0.0,
                          help="Seconds to wait between launching windows. Default: 1.0")
+    parser.add_argument("--no-daemon", action='store_true',
+                        help="Do not use a running tmuled daemon, "
+                        "always control tmux directly.")
+    parser.add_argument("--lock-timeout", type=float,
+                        default=None,
+                        help="Seconds to wait for a session or window busy "
+                        "with another tmule process, 0 to fail at once. "
+                        "Default: wait (a plan or terminate up to 120 s)")
+    parser.add_argument("--record", type=str,
+                        default=None, metavar='TRACE',
+                        help="Record all tmux commands and process queries "
+                        "into this trace file.")
+    parser.add_argument("--replay", type=str,
+                        default=None, metavar='TRACE',
+                        help="Run against a recorded trace instead of tmux "
+                        "and the real processes.")
+    parser.add_argument("--latency-scale", type=float,
+                        default=1.0,
+                        help="Factor for the recorded durations of calls "
+                        "when replaying, 0 for no delays. Default: 1.0")
 
     subparsers = parser.add_subparsers(dest='cmd',
                                        help='sub-command help')
@@ -474,6 +756,20 @@ def main():
                                default=[],
                                help="Tag of windows to be launched, "
                                "can be repeated several times.")
+    parser_launch.add_argument("--dry-run", '-n', action='store_true',
+                               help="Only print what would be done.")
+    parser_launch.add_argument("--batch", '-b', type=int,
+                               default=1,
+                               help="Number of windows launched at the "
+                               "same time. Default: 1")
+    parser_launch.add_argument("--on-failure", type=str,
+                               choices=['abort', 'continue', 'rollback'],
+                               default=None,
+                               help="What to do when a window fails its "
+                               "check. Default: on_failure of the config, "
+                               "or abort")
+    parser_launch.add_argument("--json", action='store_true',
+                               help="Print the outcome as JSON.")
     parser_stop = subparsers.add_parser('stop', help='stop windows(s)')
     parser_stop.add_argument("--window", '-w', type=str,
                              default="",
@@ -483,6 +779,10 @@ def main():
                              default=[],
                              help="Tag of windows to be stopped, "
                              "can be repeated several times.")
+    parser_stop.add_argument("--dry-run", '-n', action='store_true',
+                             help="Only print what would be done.")
+    parser_stop.add_argument("--json", action='store_true',
+                             help="Print the outcome as JSON.")
     parser_relaunch = subparsers.add_parser('relaunch',
                                             help='relaunch windows(s)')
     parser_relaunch.add_argument("--window", '-w', type=str,
@@ -493,13 +793,67 @@ def main():
                                  default=[],
                                  help="Tag of windows to be relaunched, "
                                  "can be repeated several times.")
+    parser_relaunch.add_argument("--dry-run", '-n', action='store_true',
+                                 help="Only print what would be done.")
+    parser_relaunch.add_argument("--batch", '-b', type=int,
+                                 default=1,
+                                 help="Number of windows restarted at the "
+                                 "same time, waiting for their checks "
+                                 "before the next. Default: 1")
+    parser_relaunch.add_argument("--on-failure", type=str,
+                                 choices=['abort', 'continue', 'rollback'],
+                                 default=None,
+                                 help="What to do when a window fails its "
+                                 "check. Default: on_failure of the "
+                                 "config, or abort")
+    parser_relaunch.add_argument("--json", action='store_true',
+                                 help="Print the outcome as JSON.")
+    subparsers.add_parser('resume',
+                          help='launch the windows that were running before '
+                          'tmux (or the machine) went down')
     subparsers.add_parser('terminate', help='kill window(s)')
+    parser_journal = subparsers.add_parser(
+        'journal', help='show the latest operations on the session')
+    parser_journal.add_argument("--lines", '-n', type=int,
+                                default=20,
+                                help="Number of entries. Default: 20")
     parser_server = subparsers.add_parser('server', help='run web server')
     parser_server.add_argument("--port", '-p', type=int,
                                  default=9999,
                                  help="Port to run the server on (default: 9999)")
     parser_server.add_argument("--keepalive", '-k', action='store_true',
                                  help="When quitting the server, shall the session be kept alive? (default: session terminated)")
+    parser_server.add_argument("--project", '-P', action='append',
+                               default=[],
+                               help="Config file of a further project "
+                               "(session) to serve, can be repeated.")
+
+    parser_grep = subparsers.add_parser(
+        'grep', help='search the output of all panes')
+    parser_grep.add_argument("pattern", type=str,
+                             help="Regular expression to search for.")
+    parser_grep.add_argument("--window", '-w', type=str,
+                             action='append', default=[],
+                             help="Window to search, can be repeated. "
+                             "Default: ALL")
+    parser_grep.add_argument("--tag", '-t',
+                             action='append',
+                             default=[],
+                             help="Tag of windows to be searched, "
+                             "can be repeated several times.")
+    parser_grep.add_argument("--tail", '-n', type=int,
+                             default=None,
+                             help="Number of lines of each pane's history "
+                             "to search. Default: 1000")
+    parser_grep.add_argument("--ignore-case", '-i', action='store_true',
+                             help="Match case-insensitively.")
+
+    parser_rates = subparsers.add_parser(
+        'rates', help='show how fast the panes write output')
+    parser_rates.add_argument("--seconds", type=float,
+                              default=2.0,
+                              help="Seconds to measure for, unless a "
+                              "daemon watches the output. Default: 2.0")
 
     parser_pids = subparsers.add_parser('pids', help='pids of processes')
     parser_pids.add_argument(
@@ -513,52 +867,125 @@ def main():
                              required=True,
                              help="Window to be checked.")
 
-    args = parser.parse_args()
+    return parser
 
-    tmux = TMux(
-        session_name=args.session,
-        configfile=args.config,
-        sleep_sec=args.wait)
 
-    if args.init:
-        tmux.init()
+def run_command(tmux, args):
+    """Run the sub-command given in ``args`` on ``tmux``.
 
+    Returns the text to be printed (or None), so that the same code serves
+    the CLI in direct mode and the tmuled daemon.
+    """
+    import json
+    from pprint import pformat
+    from .exc import PlanFailed
     if args.cmd == 'list':
-        print(pformat(tmux.list_windows()))
-    elif args.cmd == 'launch':
-        if args.window == '':
-            tmux.launch_all_windows(tags=set(args.tag))
-            pass
-        else:
-            tmux.launch_window(args.window)
-    elif args.cmd == 'stop':
-        if args.window == '':
-            tmux.stop_all_windows(tags=set(args.tag))
-        else:
-            tmux.stop_window(args.window)
-    elif args.cmd == 'relaunch':
-        if args.window == '':
-            tmux.stop_all_windows(tags=set(args.tag))
-            sleep(1)
-            tmux.launch_all_windows(tags=set(args.tag))
-        else:
-            tmux.stop_window(args.window)
-            sleep(1)
-            tmux.launch_window(args.window)
+        return pformat(tmux.list_windows())
+    elif args.cmd in ('launch', 'stop', 'relaunch'):
+        plan = tmux.plan(args.cmd, set(args.tag),
+                         [args.window] if args.window else None,
+                         getattr(args, 'batch', 1))
+        if args.dry_run:
+            return plan.format()
+        outcome = tmux.execute(plan, getattr(args, 'on_failure', None))
+        output = json.dumps(outcome.to_dict(), sort_keys=True) \
+            if args.json else None
+        if not outcome.ok:
+            raise PlanFailed(outcome, output)
+        return output
+    elif args.cmd == 'resume':
+        tmux.resume()
+    elif args.cmd == 'journal':
+        return '\n'.join('%s pid %d %s %s%s%s' % (
+            datetime.fromtimestamp(e['time']).strftime('%Y-%m-%d %H:%M:%S'),
+            e['pid'], e['op'], e['phase'],
+            ' ' + e['window'] if 'window' in e else '',
+            ': ' + e['error'] if 'error' in e else '')
+            for e in tmux.journal.tail(args.lines))
     elif args.cmd == 'terminate':
         tmux.kill_all_windows()
     elif args.cmd == 'running':
-        print(tmux.is_running(args.window))
-    elif args.cmd == 'server':
-        tmux._server(args.port, args.keepalive)
+        return str(tmux.is_running(args.window))
+    elif args.cmd == 'grep':
+        matches = tmux.grep(args.pattern, tags=set(args.tag),
+                            windows=set(args.window), tail=args.tail,
+                            ignore_case=args.ignore_case)
+        return '\n'.join('%s.%d:%d: %s' % (
+            m['window'], m['pane'], m['line'], m['text']) for m in matches)
+    elif args.cmd == 'rates':
+        return '\n'.join('%s.%d: %.1f kB/s%s' % (
+            r['window'], r['pane'], r['rate'] / 1024.0,
+            ' (%s)' % r['action'] if r['action'] else '')
+            for r in tmux.output_rates(args.seconds))
     elif args.cmd == 'pids':
         if args.window == '':
-            print(pformat(tmux.get_children_pids_all_windows()))
+            return pformat(tmux.get_children_pids_all_windows())
         else:
-            print(pformat(tmux.get_children_pids_window(args.window)))
+            return pformat(tmux.get_children_pids_window(args.window))
     else:
         error('unknown command %s', args.cmd)
 
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    if not (args.no_daemon or args.record or args.replay) and \
+            args.cmd != 'server':
+        from .daemon import call_daemon
+        reply = call_daemon(args)
+        if reply is not None:
+            if reply.get('output') is not None:
+                print(reply['output'])
+            if reply.get('error'):
+                error(reply['error'])
+                sys.exit(reply.get('exit_code', 1))
+            return
+
+    try:
+        tmux = TMux(
+            session_name=args.session,
+            configfile=args.config,
+            sleep_sec=args.wait)
+    except ConfigError as e:
+        error('invalid configuration:\n%s' % e)
+        sys.exit(1)
+
+    tmux.lock_timeout = args.lock_timeout
+    if args.record:
+        from .trace import Recorder
+        Recorder(args.record).install(tmux)
+    elif args.replay:
+        from .trace import Replayer
+        Replayer(args.replay, args.latency_scale).install(tmux)
+    try:
+        # 'list', 'journal' and dry runs only need the configuration, not a
+        # tmux server
+        if args.init and args.cmd not in ('list', 'journal') and \
+                not getattr(args, 'dry_run', False):
+            tmux.init()
+
+        if args.cmd == 'server':
+            tmux._server(args.port, args.keepalive, args.project)
+        else:
+            output = run_command(tmux, args)
+            if output is not None:
+                print(output)
+    except ConfigError as e:
+        error('invalid configuration:\n%s' % e)
+        sys.exit(1)
+    except TMuleException as e:
+        if getattr(e, 'output', None) is not None:
+            print(e.output)
+        error(str(e))
+        sys.exit(getattr(e, 'exit_code', 1))
+    finally:
+        # let the clean ups and hooks of what was done finish (the core
+        # only exists if a command needed it)
+        if 'tmule.core' in sys.modules:
+            sys.modules['tmule.core'].shutdown()
+        tmux.hooks.wait()
+
     # windows_to_launch = [
     #     'htop', 'navigation', 'speech', 'ui', 'pnp', 'dataset'
     # ]
@@ -583,6 +1010,32 @@ def test_tmule_file():
     assert('test' in windows)
     tmux.kill_all_windows()
 
+def test_init_during_plan():
+    from threading import Event, Thread
+    tmux = TMux(
+        session_name="nose_test",
+        configfile='tmule.yaml',
+        sleep_sec=0)
+    tmux.init()
+    held, done = Event(), Event()
+
+    def plan():
+        # a plan holds the session shared while its windows launch
+        with tmux.session_lock('launch', shared=True):
+            held.set()
+            done.wait()
+    Thread(target=plan).start()
+    held.wait()
+    try:
+        # a complete session is not locked by looking at it
+        tmux.lock_timeout = 0
+        tmux.init()
+    finally:
+        done.set()
+        tmux.lock_timeout = None
+    tmux.kill_all_windows()
+
+
 def test_tmule_include():
     tmux = TMux(
         session_name="nose_test",
@@ -595,5 +1048,37 @@ def test_tmule_include():
     tmux.kill_all_windows()
 
 
+def test_package_api():
+    import tmule
+    assert tmule.TMux is TMux and tmule.build_parser is build_parser
+
+
+def test_startup_imports():
+    # the CLI must not pull in the heavy dependencies before a sub-command
+    # needs them, and stay within a startup budget (in microseconds)
+    from subprocess import run, PIPE
+    budget = 100000
+    r = run([sys.executable, '-X', 'importtime', '-c', 'import tmule.tmule'],
+            stderr=PIPE, universal_newlines=True,
+            cwd=dirname(dirname(abspath(__file__))))
+    imported = {}
+    for line in r.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, cumulative, name = line[len('import time:'):].split('|')
+            if cumulative.strip().isdigit():
+                imported[name.strip()] = int(cumulative)
+    for heavy in ['libtmux', 'psutil', 'yaml', 'twisted', 'autobahn', 'web']:
+        assert heavy not in imported, '%s imported at startup' % heavy
+    assert imported['tmule.tmule'] < budget
+    # nor does a command that needs no core start one
+    r = run([sys.executable, '-c', 'import sys\n'
+             'from tmule.tmule import main\n'
+             'main(["--no-daemon", "-c", "tmule.yaml", "list"])\n'
+             'assert "asyncio" not in sys.modules, "asyncio imported"'],
+            stderr=PIPE, universal_newlines=True,
+            cwd=dirname(dirname(abspath(__file__))))
+    assert r.returncode == 0, r.stderr
+
+
 if __name__ == "__main__":
     main()
@@ -159,15 +159,18 @@ class TMux():
         t = self.tmux('has-session', '-t', session)
         return t.returncode == 0
 
-    def ensure_session(self, session):
+    def ensure_session(self, session, history_limit=None):
         if not self.has_session(session):
             self.tmux(
                 'new-session', '-d',
                 '-s', session,
                 '-n', "__init__")
-            self.tmux(
-                'set-option',
-                'history-limit', '100000')
+            # scrollback costs memory in every pane, keep tmux's default
+            # unless asked for
+            if history_limit:
+                self.tmux(
+                    'set-option', '-t', session,
+                    'history-limit', str(history_limit))
 
     def list_windows(self):
         self.ensure_session('__tmule-control__')
@@ -0,0 +1,374 @@
+"""Recording and replaying what TMuLE asks tmux and the system.
+
+With ``--record FILE`` every tmux command (with its output, exit code and
+duration) and every query about processes (children of a pane, ``check``
+commands, terminating and scheduling processes) is written to a trace,
+JSON lines, gzipped if the name ends in ``.gz``. With ``--replay FILE``
+TMuLE runs without tmux: the same calls are answered from the trace, each
+after its recorded duration times ``--latency-scale`` (0 for no delay at
+all), and nothing is done to real processes. That makes slow launches or
+status queries seen on a robot reproducible (and profilable, e.g. with
+``python -m cProfile -m tmule.tmule --replay ...``) on any machine.
+
+The trace also holds the state of the session when recording started and
+the output of panes that ``ready_when`` was watched for. A replay starts
+from that state, in a state file and journal of its own (in a temporary
+directory removed at exit), feeds the recorded output to the ``ready_when``
+of the windows instead of attaching a tmux client, and runs no hooks.
+
+Calls are matched by kind and arguments, in the order they were recorded;
+a call that differs (e.g. by a timestamp in keys sent to a pane) takes the
+next recorded call of the same tmux command instead.
+"""
+from __future__ import absolute_import
+
+import atexit
+import gzip
+import json
+import os
+import sys
+from collections import defaultdict, deque
+from logging import info, warning
+from threading import Lock, Thread
+from time import time, sleep
+
+TRACE_VERSION = 1
+
+# TMux methods standing for process queries, and whether they return
+# something to be replayed
+PROCESS_CALLS = {
+    '_get_children_pids': True,
+    '_run_check': True,
+    '_terminate': False,
+    'apply_scheduling': False,
+}
+
+
+def _open(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't')
+    return open(path, mode)
+
+
+def _server_args(args):
+    # socket and config file options of the tmux client, which may differ
+    # between recording and replay
+    args = list(args)
+    while args and str(args[0])[:2] in ('-L', '-S', '-f', '-2', '-8'):
+        args.pop(0)
+    return [str(a) for a in args]
+
+
+def _args(args, kwargs):
+    # windows' configurations are represented by their names
+    args = [a['name'] if hasattr(a, 'get') and 'name' in a else a
+            for a in args]
+    return args + [kwargs] if kwargs else args
+
+
+def _libtmux_modules():
+    import libtmux.common
+    return [m for name, m in list(sys.modules.items())
+            if name.startswith('libtmux') and hasattr(m, 'tmux_cmd')]
+
+
+class Trace(object):
+    """Base of recorder and replayer: hooks into libtmux and a TMux."""
+
+    def install(self, tmux=None):
+        import libtmux.common
+        self._tmux_cmd = libtmux.common.tmux_cmd
+        transport = self._transport()
+        for module in _libtmux_modules():
+            if module.tmux_cmd is self._tmux_cmd:
+                module.tmux_cmd = transport
+        if tmux is not None:
+            # checks and terminations go through the methods below instead
+            # of tmule.core's asynchronous ones
+            tmux.tracing = True
+            for name, returns in PROCESS_CALLS.items():
+                setattr(tmux, name, self._process_call(
+                    name, getattr(tmux, name), returns))
+            if tmux.state is not None:
+                self._install_session(tmux)
+        return self
+
+
+class Recorder(Trace):
+
+    def __init__(self, path):
+        self.path = path
+        self.start = time()
+        self.lock = Lock()
+        self.entries = []
+        # written when everything else is done, clean up threads included
+        atexit.register(self.close)
+
+    def record(self, kind, args, started, **fields):
+        entry = dict(fields, k=kind, a=args, t=round(started - self.start, 6),
+                     d=round(time() - started, 6))
+        with self.lock:
+            self.entries.append(entry)
+
+    def _transport(self):
+        recorder = self
+        tmux_cmd = self._tmux_cmd
+
+        def recording_tmux_cmd(*args):
+            started = time()
+            proc = tmux_cmd(*args)
+            recorder.record('tmux', _server_args(args), started,
+                            o=proc.stdout, e=proc.stderr, r=proc.returncode)
+            return proc
+        return recording_tmux_cmd
+
+    def _process_call(self, name, method, returns):
+        def recording_call(*args, **kwargs):
+            started = time()
+            result = method(*args, **kwargs)
+            self.record(name, _args(args, kwargs), started,
+                        **({'o': result} if returns else {}))
+            return result
+        return recording_call
+
+    def _install_session(self, tmux):
+        # the state a replay starts from
+        self.record('state', [], time(),
+                    o=json.loads(json.dumps(tmux.state.data)))
+        watch_ready, unwatch_ready = tmux.watch_ready, tmux.unwatch_ready
+        # watch -> [seconds since it started, pane id, output] of its panes
+        outputs = {}
+
+        def recording_watch_ready(window_name):
+            watch = watch_ready(window_name)
+            started = time()
+            output = outputs[watch] = []
+            watch.tap = lambda pane, data: output.append([
+                round(time() - started, 6), pane,
+                data.decode('utf-8', 'replace')])
+            return watch
+
+        def recording_unwatch_ready(watch):
+            unwatch_ready(watch)
+            self.record('ready_output', [watch.window_name], time(),
+                        o=outputs.pop(watch, []))
+        tmux.watch_ready = recording_watch_ready
+        tmux.unwatch_ready = recording_unwatch_ready
+
+    def close(self):
+        with self.lock:
+            entries, self.entries = self.entries, []
+        if not entries:
+            return
+        with _open(self.path, 'w') as f:
+            f.write(json.dumps({'k': 'trace', 'version': TRACE_VERSION,
+                                'argv': sys.argv, 'time': self.start}) + '\n')
+            for entry in sorted(entries, key=lambda e: e['t']):
+                f.write(json.dumps(entry, separators=(',', ':')) + '\n')
+        info('recorded %d calls to %s' % (len(entries), self.path))
+
+
+class ReplayedCmd(object):
+    """A recorded tmux command, looking like ``libtmux.common.tmux_cmd``."""
+
+    def __init__(self, args, entry):
+        self.cmd = ['tmux'] + list(args)
+        self.stdout = entry.get('o', [])
+        self.stderr = entry.get('e', [])
+        self.returncode = entry.get('r', 0)
+
+
+class Replayer(Trace):
+
+    def __init__(self, path, latency_scale=1.0):
+        self.path = path
+        self.latency_scale = latency_scale
+        self.lock = Lock()
+        self.exact = defaultdict(deque)
+        self.by_command = defaultdict(deque)
+        self.replayed = 0
+        self.missing = 0
+        self.latency = 0.0
+        with _open(path, 'r') as f:
+            header = json.loads(f.readline())
+            if header.get('version') != TRACE_VERSION:
+                raise ValueError('%s is not a trace of this version' % path)
+            for line in f:
+                entry = json.loads(line)
+                entry['used'] = False
+                self.exact[self._key(entry['k'], entry['a'])].append(entry)
+                self.by_command[self._command(entry['k'], entry['a'])]\
+                    .append(entry)
+        self.start = time()
+        atexit.register(self.report)
+
+    @staticmethod
+    def _key(kind, args):
+        return kind, json.dumps(args)
+
+    @staticmethod
+    def _command(kind, args):
+        # the output of one window stands in for no other window's
+        if kind in ('tmux', 'ready_output'):
+            return kind, args[0] if args else ''
+        return kind, ''
+
+    def _take(self, queue):
+        while queue and queue[0]['used']:
+            queue.popleft()
+        if queue:
+            entry = queue.popleft()
+            entry['used'] = True
+            return entry
+
+    def lookup(self, kind, args):
+        """The recorded call standing for ``kind(args)``, after its delay."""
+        args = json.loads(json.dumps(args))
+        with self.lock:
+            entry = self._take(self.exact[self._key(kind, args)]) or \
+                self._take(self.by_command[self._command(kind, args)])
+            if entry is None:
+                self.missing += 1
+            else:
+                self.replayed += 1
+                self.latency += entry['d']
+        if entry is None:
+            warning('%s %s not in trace %s' % (kind, args, self.path))
+            return {}
+        if self.latency_scale > 0:
+            sleep(entry['d'] * self.latency_scale)
+        return entry
+
+    def _transport(self):
+        def replayed_tmux_cmd(*args):
+            args = _server_args(args)
+            return ReplayedCmd(args, self.lookup('tmux', args))
+        return replayed_tmux_cmd
+
+    def _process_call(self, name, method, returns):
+        def replayed_call(*args, **kwargs):
+            entry = self.lookup(name, _args(args, kwargs))
+            if returns:
+                return entry.get('o', [] if name == '_get_children_pids'
+                                 else False)
+        return replayed_call
+
+    def _install_session(self, tmux):
+        import shutil
+        import tempfile
+        from .journal import Journal
+        from .state import StateFile
+        directory = tempfile.mkdtemp(prefix='tmule-replay-')
+        atexit.register(shutil.rmtree, directory, True)
+        path = os.path.join(directory, 'state.json')
+        entry = self.lookup('state', [])
+        if 'o' in entry:
+            with open(path, 'w') as f:
+                json.dump(entry['o'], f)
+        tmux.state = StateFile(tmux.session_name, path)
+        tmux.journal = Journal(tmux.session_name,
+                               os.path.join(directory, 'journal'))
+        tmux.hooks.run = self._run_hook
+        tmux.watch_ready = lambda window_name: self._watch_ready(
+            tmux, window_name)
+        tmux.unwatch_ready = lambda watch: None
+
+    def _run_hook(self, hook, payload):
+        info('not running %s hook %r of %s in a replay' % (
+            payload['event'], hook, payload['window']))
+
+    def _watch_ready(self, tmux, window_name):
+        watch = tmux.ready_watch(window_name)
+        output = self.lookup('ready_output', [window_name]).get('o', [])
+
+        def feed():
+            started = time()
+            for at, pane, data in output:
+                if self.latency_scale > 0:
+                    sleep(max(0, started + at * self.latency_scale - time()))
+                if pane in watch.matchers:
+                    watch(pane, data.encode('utf-8'))
+        if self.latency_scale > 0:
+            Thread(target=feed, daemon=True).start()
+        else:
+            feed()
+        return watch
+
+    def report(self):
+        info('replayed %d calls (%d not in trace) in %.3fs, recorded '
+             'latency %.3fs scaled by %g' % (
+                 self.replayed, self.missing, time() - self.start,
+                 self.latency, self.latency_scale))
+
+
+def test_replay():
+    import os
+    import tempfile
+    fd, path = tempfile.mkstemp(suffix='.trace.gz')
+    os.close(fd)
+    recorder = Recorder(path)
+    started = time()
+    recorder.record('tmux', ['list-panes', '-F', '#{pane_pid}'], started,
+                    o=['42'], e=[], r=0)
+    recorder.record('_get_children_pids', [42], started, o=[43, 44])
+    recorder.record('tmux', ['send-keys', '-t', '%1', '# at 10:00'], started,
+                    o=[], e=[], r=0)
+    recorder.close()
+    replayer = Replayer(path, latency_scale=0)
+    os.unlink(path)
+    cmd = replayer._transport()
+    assert cmd('-Lother', 'list-panes', '-F', '#{pane_pid}').stdout == ['42']
+    children = replayer._process_call('_get_children_pids', None, True)
+    assert children(42) == [43, 44]
+    # differs by the time only
+    assert cmd('send-keys', '-t', '%1', '# at 11:00').returncode == 0
+    assert replayer.missing == 0
+    cmd('kill-server')
+    assert replayer.missing == 1
+    atexit.unregister(replayer.report)
+
+
+def test_replay_session():
+    import tempfile
+    from libtmux import Server
+    from .tmule import TMux
+    d = tempfile.mkdtemp()
+    done = os.path.join(d, 'hook.done')
+    configfile = os.path.join(d, 'tmule.yaml')
+    with open(configfile, 'w') as f:
+        f.write('session: replayed\nwindows:\n- name: nav\n  panes: [nav]\n'
+                '  ready_when: [{regex: odom}, {regex: (?i)READY}]\n'
+                '  hooks: {on_ready: touch %s}\n' % done)
+    path = os.path.join(d, 'session.trace')
+    recorder = Recorder(path)
+    started = time()
+    recorder.record('state', [], started, o={
+        'config_hash': None, 'windows': {'nav': {'desired': 'running'}}})
+    recorder.record('tmux', ['list-panes', '-s', '-t', 'replayed', '-F',
+                             '#{pane_index} #{pane_id} #{window_name}'],
+                    started, o=['0 %3 nav'], e=[], r=0)
+    recorder.record('ready_output', ['nav'], started,
+                    o=[[0.1, '%3', 'odom ready\r\n']])
+    recorder.close()
+    atexit.unregister(recorder.close)
+    tmux = TMux(configfile=configfile)
+    state = tmux.state.path
+    replayer = Replayer(path, latency_scale=0).install(tmux)
+    try:
+        tmux.server = Server()
+        # state and journal of the replay only
+        assert tmux.state.path != state and not os.path.exists(state)
+        assert tmux.state.running_windows() == ['nav']
+        watch = tmux.watch_ready('nav')
+        assert watch.ready.is_set()
+        tmux.unwatch_ready(watch)
+        tmux.hooks.emit('ready', 'nav')
+        tmux.hooks.wait()
+        assert not os.path.exists(done)
+        assert [e['phase'] for e in tmux.journal.since(None)[0]] == [
+            'pending', 'done']
+        assert replayer.missing == 0
+    finally:
+        for module in _libtmux_modules():
+            module.tmux_cmd = replayer._tmux_cmd
+        atexit.unregister(replayer.report)
@@ -0,0 +1,347 @@
+"""The TMuLE web server: dashboard, log and websocket control of projects.
+
+With a single project everything is served from the root (``/``, ``/log``,
+``/ws``) as before. With several projects, the root lists them and each is
+served below its session name (``/<session>/``, ``/<session>/log``,
+``/<session>/status``, ``/<session>/grep``, ``/<session>/ws``).
+
+The dashboard page itself is static; it loads the windows of its project
+from ``windows`` (JSON) and renders only the rows in view, so that configs
+with hundreds of windows stay responsive. Over the websocket, only changes
+of window states are sent.
+"""
+from __future__ import absolute_import
+
+import asyncio
+import json
+import sys
+from hashlib import sha1
+from logging import debug
+from os import path
+
+import web
+
+from autobahn.twisted.resource import WebSocketResource, WSGIRootResource
+from autobahn.twisted.websocket import WebSocketServerFactory
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.python import log
+from twisted.web import http
+from twisted.web.resource import EncodingResourceWrapper
+from twisted.web.server import Site, GzipEncoderFactory
+from twisted.web.static import File
+from twisted.web.wsgi import WSGIResource
+
+from .core import get_core, execute, kill_all, stop_window
+from .exc import InvalidPattern
+from .ws_protocol import JsonWSProtocol, enable_compression
+
+WWW_DIR = path.realpath(path.join(path.dirname(__file__), 'www'))
+
+# static assets worth compressing (fonts like woff are compressed already)
+_COMPRESSIBLE = {'.html', '.js', '.css', '.map', '.svg', '.ttf', '.eot',
+                 '.json', '.txt'}
+
+
+def _renderer():
+    return web.template.render(WWW_DIR, base='base', globals=globals())
+
+
+def project_app(projects, name):
+    """The web.py application of one project."""
+    app = web.auto_application()
+    renderer = _renderer()
+    tmux = projects[name]
+
+    class Home(app.page):
+        path = ''
+
+        def GET(self):
+            # relative links of the dashboard need the trailing slash
+            raise web.seeother('/')
+
+    class Index(app.page):
+        path = '/'
+
+        def GET(self):
+            ws_uri = '%s://%s%sws' % (
+                'ws' if web.ctx['protocol'] == 'http' else 'wss',
+                web.ctx['host'],
+                web.ctx['homepath'] + web.ctx['path']
+            )
+            web.modified(etag=sha1(('%s %s' % (ws_uri, path.getmtime(
+                path.join(WWW_DIR, 'index.html')))).encode('utf-8')
+            ).hexdigest())
+            return renderer.index(ws_uri)
+
+    class Windows(app.page):
+        path = '/windows'
+
+        def GET(self):
+            old_hash = tmux.config_hash
+            tmux.load_config()
+            if (tmux.config_hash != old_hash or
+                    not projects.server.has_session(tmux.session_name)):
+                projects.init(name)
+                projects.invalidate(name)
+            web.header('Content-Type', 'application/json')
+            web.modified(etag=tmux.config_hash)
+            return json.dumps(window_metadata(tmux))
+
+    class Log(app.page):
+        path = '/log'
+
+        def GET(self):
+            lines = projects.server.cmd(
+                'capture-pane', '-p', '-C', '-S', '-100000',
+                '-t', tmux.session_name).stdout
+            return '\n'.join(lines)
+
+    class Grep(app.page):
+        path = '/grep'
+
+        def GET(self):
+            i = web.input(pattern='', tag=[], window=[], tail=None, i='')
+            try:
+                matches = tmux.grep(
+                    i.pattern, tags=set(i.tag), windows=set(i.window),
+                    tail=int(i.tail) if i.tail else None,
+                    ignore_case=i.i not in ('', '0', 'false'))
+            except InvalidPattern as e:
+                raise web.badrequest(str(e))
+            web.header('Content-Type', 'application/json')
+            return json.dumps(matches)
+
+    class Rates(app.page):
+        path = '/rates'
+
+        def GET(self):
+            web.header('Content-Type', 'application/json')
+            return json.dumps(tmux.output_rates())
+
+    class Core(app.page):
+        path = '/core'
+
+        def GET(self):
+            # threads at work for this server, in the core and in twisted
+            pool = reactor.getThreadPool()
+            stats = dict(get_core().stats(), wsgi={
+                'max': pool.max, 'workers': pool.workers,
+                'working': len(pool.working)})
+            web.header('Content-Type', 'application/json')
+            return json.dumps(stats)
+
+    class Status(app.page):
+        path = '/status'
+
+        def GET(self):
+            web.header('Content-Type', 'application/json')
+            return json.dumps(projects.status(name))
+
+    return app
+
+
+def window_metadata(tmux):
+    """What the dashboard needs to know about the windows of ``tmux``."""
+    return {
+        'session': tmux.session_name,
+        'tags': sorted(tmux.known_tags),
+        'windows': [{
+            'name': w['name'],
+            'tags': list(w.get('tags', [])),
+            'panes': len(w['panes']),
+            'skip': bool(w.get('skip', False)),
+        } for w in tmux.config['windows']]
+    }
+
+
+def projects_app(projects):
+    """The web.py application listing all projects."""
+    app = web.auto_application()
+    renderer = _renderer()
+
+    class Index(app.page):
+        path = '/'
+
+        def GET(self):
+            return renderer.projects(projects.names())
+
+    return app
+
+
+def protocol(projects, name):
+    """The websocket protocol class controlling project ``name``."""
+    tmux = projects[name]
+
+    class TMuxWSProtocol(JsonWSProtocol):
+
+        def onOpen(self):
+            super(TMuxWSProtocol, self).onOpen()
+            # window states as last sent to this client
+            self.sent = {}
+
+        def on_button(self, payload):
+            debug('button pressed: %s' % payload)
+            # runs on the core's loop, which is the reactor's: nothing here
+            # may block it
+            get_core().spawn(self.button(payload['id'], payload['cmd']))
+
+        async def button(self, window_name, cmd):
+            core = get_core()
+            if cmd == 'launch':
+                if window_name == '':
+                    await execute(tmux, tmux.plan('launch'))
+                else:
+                    await core.blocking(tmux.launch_window, window_name)
+            elif cmd == 'launch-tag':
+                await execute(tmux, tmux.plan('launch', {window_name}))
+            elif cmd == 'stop':
+                if window_name == '':
+                    await execute(tmux, tmux.plan('stop'))
+                else:
+                    await stop_window(tmux, window_name)
+            elif cmd == 'stop-tag':
+                await execute(tmux, tmux.plan('stop', {window_name}))
+            elif cmd == 'terminate':
+                await kill_all(tmux)
+                await asyncio.sleep(1)
+                await core.blocking(projects.init, name)
+
+            await asyncio.sleep(1)
+            projects.invalidate(name)
+            self.sendJSON(self._changes(
+                await core.blocking(projects.status, name)))
+
+        def on_status(self, payload=None):
+            debug('status-requested: ')
+            # the status is found out by processes and tmux commands, off
+            # the reactor; the reply is sent when it is there
+            status = asyncio.ensure_future(
+                get_core().blocking(projects.status, name))
+            return Deferred.fromFuture(status).addCallback(
+                self._changes, bool(payload and payload.get('full')))
+
+        def _changes(self, status, full=False):
+            if full:
+                self.sent = {}
+            changed = dict((w, running) for w, running in status.items()
+                           if self.sent.get(w) != running)
+            self.sent.update(changed)
+            return {
+                'windows': changed,
+                'method': 'update_status'
+            }
+
+    return TMuxWSProtocol
+
+
+class StaticFile(File):
+    """Static assets, validated by ETag and gzip compressed where useful."""
+
+    _gzip = GzipEncoderFactory()
+
+    def render_GET(self, request):
+        self.restat(False)
+        if self.exists() and not self.isdir():
+            st = self.getsize(), self.getModificationTime()
+            request.setHeader(b'cache-control', b'no-cache')
+            request.setHeader(b'vary', b'accept-encoding')
+            if request.setETag(b'"%x-%x"' % (st[0], int(st[1] * 1000))) \
+                    is http.CACHED:
+                return b''
+        return File.render_GET(self, request)
+
+    render_HEAD = render_GET
+
+    def getChild(self, name, request):
+        child = File.getChild(self, name, request)
+        if (isinstance(child, File) and child.isfile() and
+                path.splitext(child.basename())[1] in _COMPRESSIBLE and
+                request.getHeader(b'range') is None):
+            return EncodingResourceWrapper(child, [self._gzip])
+        return child
+
+
+class _ProjectResource(WSGIRootResource):
+    # "/<session>" without the slash goes to the application, which
+    # redirects, instead of failing in twisted
+    def render(self, request):
+        return self._wsgiResource.render(request)
+
+
+def serve(projects, port=9999, keepalive=True):
+    """Serve ``projects`` on ``port`` until the reactor stops."""
+    log.startLogging(sys.stdout)
+    projects.init()
+    for name in projects.names():
+        if projects[name].has_output_limit():
+            projects[name].start_output_guard()
+    static = StaticFile(path.join(WWW_DIR, 'static'))
+    pool = reactor.getThreadPool()
+
+    def resource(name):
+        factory = enable_compression(WebSocketServerFactory())
+        factory.protocol = protocol(projects, name)
+        app = WSGIResource(reactor, pool, project_app(projects, name).wsgifunc())
+        return _ProjectResource(
+            EncodingResourceWrapper(app, [GzipEncoderFactory()]),
+            {b'ws': WebSocketResource(factory), b'static': static})
+
+    names = projects.names()
+    if len(names) == 1:
+        root = resource(names[0])
+    else:
+        children = dict((n.encode('utf-8'), resource(n)) for n in names)
+        children[b'static'] = static
+        root = WSGIRootResource(
+            WSGIResource(reactor, pool, projects_app(projects).wsgifunc()),
+            children)
+
+    async def shut_down():
+        # kill everything when the server dies, while the loop still runs
+        if not keepalive:
+            for name in names:
+                await kill_all(projects[name])
+        await get_core().drain()
+
+    # on Ctrl-C and SIGTERM too
+    reactor.addSystemEventTrigger(
+        'before', 'shutdown',
+        lambda: Deferred.fromFuture(get_core().spawn(shut_down())))
+    reactor.listenTCP(port, Site(root))
+    reactor.run()
+
+
+def test_serve_returns():
+    # the server shuts down on SIGTERM, killing its windows on the way
+    import os
+    import signal
+    import socket
+    import tempfile
+    from subprocess import Popen, TimeoutExpired
+    from time import sleep
+    config = os.path.join(tempfile.mkdtemp(), 'serve.yaml')
+    with open(config, 'w') as f:
+        f.write('session: nose_serve\nwindows:\n'
+                '- name: w\n  panes: [sleep 100]\n')
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    server = Popen([sys.executable, '-m', 'tmule.tmule', '--no-daemon',
+                    '-c', config, 'server', '--port', str(port)],
+                   cwd=path.dirname(path.dirname(path.abspath(__file__))))
+    try:
+        for _ in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', port), 1).close()
+                break
+            except OSError:
+                sleep(0.1)
+        server.send_signal(signal.SIGTERM)
+        assert server.wait(30) == 0
+    except TimeoutExpired:
+        assert False, 'server did not exit'
+    finally:
+        if server.poll() is None:
+            server.kill()
@@ -1,52 +1,142 @@
 #!/usr/bin/env python3
+"""Websocket protocol exchanging dicts, by default as JSON text frames.
+
+Clients may negotiate a compact binary encoding by offering the websocket
+subprotocol ``tmule.msgpack`` or ``tmule.cbor`` (available if the msgpack or
+cbor2 module is installed); ``tmule.json`` or no subprotocol at all gives
+JSON. Frames are compressed with permessage-deflate if the client offers it
+(see ``enable_compression``). With the ``options`` method a client can turn
+off the ``_query`` echo in responses (``"echo": false``, the default with
+binary encodings) and have messages batched (``"batch": <seconds>``) into
+one ``{"_batch": [...]}`` frame.
+"""
 
 from __future__ import print_function
 
-from os import path
-from uuid import uuid4
+from itertools import count
 
 from json import loads, dumps
 from pprint import pformat
 
 from autobahn.twisted.websocket import WebSocketServerProtocol, \
     WebSocketServerFactory
+from autobahn.websocket.compress import PerMessageDeflateOffer, \
+    PerMessageDeflateOfferAccept
 
 from autobahn.twisted.resource import WebSocketResource, WSGIRootResource
+from twisted.internet.defer import Deferred
 from twisted.python import log
 
+
+def _codecs():
+    # subprotocol -> (encode, decode, binary)
+    codecs = {
+        'tmule.json': (lambda d: dumps(d).encode('utf-8'),
+                       lambda b: loads(b.decode('utf-8')), False)
+    }
+    try:
+        import msgpack
+        codecs['tmule.msgpack'] = (
+            msgpack.packb, lambda b: msgpack.unpackb(b, raw=False), True)
+    except ImportError:
+        pass
+    try:
+        import cbor2
+        codecs['tmule.cbor'] = (cbor2.dumps, cbor2.loads, True)
+    except ImportError:
+        pass
+    return codecs
+
+
+CODECS = _codecs()
+
+
+def _accept_deflate(offers):
+    for offer in offers:
+        if isinstance(offer, PerMessageDeflateOffer):
+            return PerMessageDeflateOfferAccept(offer)
+
+
+def enable_compression(factory):
+    """Accept permessage-deflate on the connections of ``factory``."""
+    factory.setProtocolOptions(perMessageCompressionAccept=_accept_deflate)
+    return factory
+
+
 class JsonWSProtocol(WebSocketServerProtocol):
 
     def onConnect(self, request):
         log.msg("Client connecting: {0}".format(request.peer))
+        self.subprotocol = 'tmule.json'
+        for p in request.protocols:
+            if p in CODECS:
+                self.subprotocol = p
+                return p
 
     def onOpen(self):
         log.msg("WebSocket connection open.")
         self.wait_responses = {}
+        self._encode, self._decode, self._binary = CODECS[self.subprotocol]
+        # binary clients are new, they do not need their queries back
+        self.echo = not self._binary
+        self.batch = 0
+        self._queue = []
+        self._ids = count()
+
+    def on_options(self, payload):
+        if 'echo' in payload:
+            self.echo = bool(payload['echo'])
+        if 'batch' in payload:
+            self.flush()
+            self.batch = float(payload['batch'] or 0)
+        return {'echo': self.echo, 'batch': self.batch,
+                'subprotocol': self.subprotocol}
 
     def sendJSON(self, data, callback=None):
-        data = data.copy()
-        data['_id'] = str(uuid4())
+        data = dict(data, _id=next(self._ids))
         if callback:
             self.wait_responses[data['_id']] = callback
-        buf = dumps(data)
-        self.sendMessage(buf.encode('utf-8'), False)
+        if self.batch > 0:
+            if not self._queue:
+                from twisted.internet import reactor
+                reactor.callLater(self.batch, self.flush)
+            self._queue.append(data)
+        else:
+            self.sendMessage(self._encode(data), self._binary)
+
+    def flush(self):
+        """Send the queued messages, as one frame."""
+        if self._queue:
+            queue, self._queue = self._queue, []
+            self.sendMessage(self._encode({'_batch': queue}), self._binary)
 
     def onMessage(self, payload, isBinary):
-        # Debug
-        if isBinary:
-            log.msg("Binary message received: {0} bytes".format(len(payload)))
+        try:
+            payload = self._decode(payload)
+        except Exception as e:
+            log.err(e, 'cannot decode message of %d bytes' % len(payload))
+            return
+        for message in payload.get('_batch', [payload]):
+            self._handle(message)
+
+    def _handle(self, payload):
+        result = self._dispatch(payload)
+        if isinstance(result, Deferred):
+            # a handler working off the reactor answers when it is done
+            result.addCallback(self._respond, payload)
+            result.addErrback(log.err)
         else:
-            message_text = payload.decode('utf8')
-            payload = loads(message_text)
-            result = self._dispatch(payload)
-            if result:
-                try:
-                    r = result.copy()
-                    r['_response_to'] = payload['_id']
+            self._respond(result, payload)
+
+    def _respond(self, result, payload):
+        if result:
+            try:
+                r = dict(result, _response_to=payload['_id'])
+                if self.echo:
                     r['_query'] = payload
-                    self.sendJSON(r)
-                except Exception as e:
-                    log.err(e)
+                self.sendJSON(r)
+            except Exception as e:
+                log.err(e)
 
     def _dispatch(self, payload):
         if 'method' in payload:
@@ -64,8 +154,7 @@ class JsonWSProtocol(WebSocketServerProtocol):
                 method = self.wait_responses.pop(payload['_response_to'])
                 method(payload)
 
-            log.msg('got a response to %s for method %s' %
-                 (payload['_response_to'], payload['_query']['method']))
+            log.msg('got a response to %s' % payload['_response_to'])
         else:
             log.err("don't know what to do with message %s" % pformat(payload))
 
@@ -73,6 +162,7 @@ class JsonWSProtocol(WebSocketServerProtocol):
         log.err('should be overwritten')
 
     def onClose(self, wasClean, code, reason):
+        self._queue = []
         log.msg("WebSocket connection closed: {0}".format(reason))
 
 
@@ -82,3 +172,7 @@ class EchoJSONProtocol(JsonWSProtocol):
         return payload
 
 
+def test_codecs():
+    message = {'method': 'update_status', 'windows': {'a': True}, '_id': 1}
+    for name, (encode, decode, binary) in CODECS.items():
+        assert decode(encode(message)) == message, name
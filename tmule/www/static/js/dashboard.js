@@ -0,0 +1,152 @@
+// The TMuLE dashboard: the windows are loaded as JSON, grouped by tag and
+// only the rows scrolled into view are rendered. Status messages only
+// carry the windows whose state changed.
+
+var ROW_HEIGHT = 40;
+
+var dashboard = {
+  meta: {'windows': [], 'tags': []},
+  rows: [],
+  status: {},
+  filter: ''
+};
+
+function escape_html(s) {
+  return String(s).replace(/[&<>"']/g, function(c) {
+    return {'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;',
+            "'": '&#39;'}[c];
+  });
+}
+
+function check() {
+  send({'method': 'status'});
+}
+
+function dashboard_init() {
+  $('#windows').on('scroll', render_rows);
+  $(window).on('resize', render_rows);
+  $('#filter').on('input', function() {
+    dashboard.filter = $(this).val().toLowerCase();
+    build_rows();
+  });
+  $('#windows').on('click', 'button', function() {
+    send({
+      'method': 'button',
+      'id': $(this).attr('data-id'),
+      'cmd': $(this).attr('data-cmd')
+    });
+  });
+  $.getJSON('windows', function(meta) {
+    dashboard.meta = meta;
+    build_rows();
+  });
+}
+
+function matches(w, group) {
+  var f = dashboard.filter;
+  if (f == '') {
+    return true;
+  }
+  if (w['name'].toLowerCase().indexOf(f) >= 0) {
+    return true;
+  }
+  return group != null && group.toLowerCase().indexOf(f) >= 0;
+}
+
+// rows are group headers followed by their windows; windows with several
+// tags show up in each of their groups, untagged ones at the end
+function build_rows() {
+  var groups = {};
+  var untagged = [];
+  var shown = {};
+  dashboard.meta['windows'].forEach(function(w) {
+    if (w['tags'].length == 0) {
+      if (matches(w, null)) {
+        untagged.push(w);
+        shown[w['name']] = true;
+      }
+    }
+    w['tags'].forEach(function(t) {
+      if (matches(w, t)) {
+        (groups[t] = groups[t] || []).push(w);
+        shown[w['name']] = true;
+      }
+    });
+  });
+  var rows = [];
+  dashboard.meta['tags'].forEach(function(t) {
+    if (groups[t]) {
+      rows.push({'group': t, 'count': groups[t].length});
+      groups[t].forEach(function(w) { rows.push({'window': w}); });
+    }
+  });
+  if (untagged.length > 0) {
+    rows.push({'group': null, 'count': untagged.length});
+    untagged.forEach(function(w) { rows.push({'window': w}); });
+  }
+  dashboard.rows = rows;
+  $('#counts').text(Object.keys(shown).length + ' of ' +
+                    dashboard.meta['windows'].length + ' windows');
+  $('#spacer').css('height', rows.length * ROW_HEIGHT);
+  render_rows();
+}
+
+function buttons(id, launch, stop) {
+  return '<div class="btn-group" role="group">' +
+    '<button type="button" class="btn btn-xs btn-success" data-id="' +
+    escape_html(id) + '" data-cmd="' + launch + '">Launch</button>' +
+    '<button type="button" class="btn btn-xs btn-danger" data-id="' +
+    escape_html(id) + '" data-cmd="' + stop + '">Stop</button></div>';
+}
+
+function state_class(name) {
+  if (!(name in dashboard.status)) {
+    return '';
+  }
+  return dashboard.status[name] ? ' running' : ' stopped';
+}
+
+function render_rows() {
+  var view = $('#windows');
+  var first = Math.floor(view.scrollTop() / ROW_HEIGHT);
+  var last = Math.min(dashboard.rows.length,
+                      first + Math.ceil(view.height() / ROW_HEIGHT) + 1);
+  var html = [];
+  for (var i = first; i < last; i++) {
+    var row = dashboard.rows[i];
+    var top = 'style="top: ' + (i * ROW_HEIGHT) + 'px"';
+    if ('group' in row) {
+      var title = row['group'] == null ? 'untagged' :
+        'tag "' + escape_html(row['group']) + '"';
+      html.push('<div class="row-item group" ' + top + '>' + title +
+                ' (' + row['count'] + ')' +
+                (row['group'] == null ? '' :
+                 buttons(row['group'], 'launch-tag', 'stop-tag')) +
+                '</div>');
+    } else {
+      var w = row['window'];
+      html.push('<div class="row-item window' + state_class(w['name']) +
+                '" data-window="' + escape_html(w['name']) + '" ' + top +
+                '>' + escape_html(w['name']) + ' <small><i>' +
+                escape_html(w['tags'].join(', ')) + '</i></small>' +
+                buttons(w['name'], 'launch', 'stop') + '</div>');
+    }
+  }
+  view.children('.row-item').remove();
+  view.append(html.join(''));
+}
+
+function _update_status(payload) {
+  var changed = payload['windows'];
+  for (var name in changed) {
+    dashboard.status[name] = changed[name];
+  }
+  // only the changed windows that are rendered at all need touching
+  $('#windows .window').each(function() {
+    var name = $(this).attr('data-window');
+    if (name in changed) {
+      $(this).toggleClass('running', changed[name]);
+      $(this).toggleClass('stopped', !changed[name]);
+    }
+  });
+}
@@ -40,6 +40,24 @@ function _update_html(payload) {
 
 
 
+function handle_message(payload) {
+  if ("method" in payload) {
+    var method = '_' + payload['method'];
+    console.log('dispatch message ' + payload['_id'] + ' to function ' + method);
+    result = executeFunctionByName(method, window, payload);
+    if (result != null) {
+      result['_response_to'] = payload['_id'];
+      result['_query'] = payload;
+      //console.log("function " + method + " returned " + JSON.stringify(result, null, 2));
+      send(result);
+    }
+  } else if ("_response_to" in payload) {
+    console.log('got a response to message ' + payload['_response_to']);
+  } else {
+    console.log("don't know what to do with message " + JSON.stringify(payload));
+  }
+}
+
 function webnsock_init(uri="") {
   if (uri == "") {
     var host_name = window.location.hostname;
@@ -52,20 +70,10 @@ function webnsock_init(uri="") {
     if (typeof e.data == "string") {
       var payload = JSON.parse(e.data);
       //console.log("payload= " + JSON.stringify(payload, null, 2));
-      if ("method" in payload) {
-        var method = '_' + payload['method'];
-        console.log('dispatch message ' + payload['_id'] + ' to function ' + method);
-        result = executeFunctionByName(method, window, payload);
-        if (result != null) {
-          result['_response_to'] = payload['_id'];
-          result['_query'] = payload;
-          //console.log("function " + method + " returned " + JSON.stringify(result, null, 2));
-          send(result);
-        }
-      } else if ("_response_to" in payload) {
-        console.log('got a response to message ' + payload['_response_to']);
-      } else {
-        console.log("don't know what to do with message " + e.data);
+      // the server may batch several messages into one frame
+      var messages = ("_batch" in payload) ? payload["_batch"] : [payload];
+      for (var i = 0; i < messages.length; i++) {
+        handle_message(messages[i]);
       }
     } else {
       var arr = new Uint8Array(e.data);